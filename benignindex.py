@@ -0,0 +1,129 @@
+# benignindex.py
+# Sat Oct 17 20:48:09 PDT 2026
+#
+# The ngrams of a clean corpus, aka every distinct uint64 ngram id that
+# extractors.ngram_ids finds in at least one benign file, with the number of
+# benign files it's in. It's built once and memory mapped by mmlcs.py
+# --benign, which drops the ngrams that are in too many benign files from the
+# top k so substrings of common library code never make it into the db. Most
+# ngrams are in some benign file at n=3, so dropping all of them would leave
+# nothing.
+#
+# Layout, all little endian:
+#   header  magic, version, n, #files, #ids
+#   ids     #ids sorted uint64
+#   dfs     #ids uint32, the number of files each id is in
+
+from __future__ import print_function
+
+# stdlib imports
+import argparse
+import glob
+import multiprocessing
+import os
+import struct
+import sys
+import time
+
+# 3rd party imports
+import numpy as np
+
+# local imports
+from extractors import (ngram_ids)
+from filefuncs import (arrayFunc, arrayMultiFunc, tableSize, READ_OPTS_DEFAULT)
+
+MAGIC = 'MMLCSBGN'
+VERSION = 1
+HEADER_FORMAT = '<8sIIQQ'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+NUM_CORES = multiprocessing.cpu_count()
+
+def writeIndex(filename, n, num_files, frequencies):
+  """Writes the (sorted distinct ngram ids, document frequencies) of
+  num_files benign files as a benign index"""
+  (ids, dfs) = frequencies
+  with open(filename, 'wb') as f:
+    f.write(struct.pack(HEADER_FORMAT, MAGIC, VERSION, n, num_files, len(ids)))
+    f.write(ids.astype('<u8').tobytes())
+    f.write(dfs.astype('<u4').tobytes())
+
+def readIndex(filename):
+  """Memory maps a benign index, returns (n, number of files, (sorted ids,
+  document frequencies))"""
+  with open(filename, 'rb') as f:
+    header = f.read(HEADER_SIZE)
+  assert len(header) == HEADER_SIZE, '%s is not a benign index' % filename
+  (magic, version, n, num_files, num_ids) = struct.unpack(HEADER_FORMAT, header)
+  assert magic == MAGIC, '%s is not a benign index' % filename
+  assert version == VERSION, 'unsupported benign index version %d' % version
+  if num_ids == 0:
+    # can't memory map nothing
+    return (n, num_files, (np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.uint32)))
+  return (n, num_files, (
+    np.memmap(filename, dtype='<u8', mode='r', offset=HEADER_SIZE, shape=(num_ids,)),
+    np.memmap(filename, dtype='<u4', mode='r', offset=HEADER_SIZE + 8 * num_ids, shape=(num_ids,))
+  ))
+
+def withoutBenign(table, benign, max_df):
+  """Returns an ngram table without the keys that are in more than max_df
+  files of the benign (ids, dfs) frequencies. Both are sorted, so every key
+  is a binary search into the memory mapped ids."""
+  (keys, counts) = table[:2]
+  (benign_ids, benign_dfs) = benign
+  if len(benign_ids) == 0 or len(keys) == 0:
+    return (keys, counts)
+  pos = np.searchsorted(benign_ids, keys)
+  pos[pos == len(benign_ids)] = 0
+  keep = (benign_ids[pos] != keys) | (benign_dfs[pos] <= max_df)
+  return (keys[keep], counts[keep])
+
+def maxBenignDf(num_files, fraction):
+  "The most benign files an ngram can be in before it's dropped"
+  return int(fraction * num_files)
+
+def main(path_regex, outfile, N, use_multi):
+  start = time.time()
+  filenames = glob.glob(path_regex)
+  print("Indexing %d files using %d cores looking for %d-grams" % (
+    len(filenames),
+    NUM_CORES if use_multi else 1,
+    N
+  ))
+  table_size = tableSize(N)
+  if not use_multi:
+    (_, _, frequencies) = arrayFunc((filenames, ngram_ids, [N], table_size, READ_OPTS_DEFAULT))
+  else:
+    (_, _, frequencies) = arrayMultiFunc((filenames, ngram_ids, [N], table_size, READ_OPTS_DEFAULT))
+  writeIndex(outfile, N, len(filenames), frequencies)
+  now = time.time()
+  print("[+] Writing %d benign ngrams of %d files to %s complete; time elapsed: %1.3f" % (
+    len(frequencies[0]),
+    len(filenames),
+    outfile,
+    now - start
+  ))
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(
+    description='Builds the index of benign ngrams that mmlcs.py --benign reads'
+  )
+  parser.add_argument(
+    'input_dir',
+    help='Where the clean files are stored'
+  )
+  parser.add_argument(
+    'output',
+    help='Where to write the index'
+  )
+  parser.add_argument('-n', help='The value of n for n-grams, same as mmlcs.py', type=int, default=3)
+  parser.add_argument(
+    '-m',
+    '--multi',
+    action='store_true',
+    help='Toggles whether or not to use multiple cores'
+  )
+  args = parser.parse_args()
+  if not os.path.isdir(args.input_dir):
+    print("%s is not a directory" % args.input_dir, file=sys.stderr)
+    sys.exit(-1)
+  main(os.path.join(args.input_dir, '*'), args.output, args.n, args.multi)
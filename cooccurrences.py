@@ -9,98 +9,151 @@ from __future__ import print_function
 
 # stdlib imports
 import argparse
+import itertools
 import json
 import multiprocessing
+import os
 import random
+import shutil
 import sys
+import tempfile
 import time
 
-# TODO mergeSort isn't really mergeSort
-from sorting import (mergeSort, multiMergeSort)
+# 3rd party imports
+import numpy as np
 
-# TODO use it from mmlcs
-def __hist_cmp(x, y):
-  if x[1] > y[1]:
-    return 1
-  elif x[1] < y[1]:
-    return -1
-  else:
-    return 0
+# local imports
+from filefuncs import (mergeCounts, publishArrays, resolve, unpublish)
+from minhash import (signatures, bands, similarPairs, clusters)
+from sorting import (externalSort, valueKey, DESCENDING)
+from tabulardb import (isTable, readTable, hexDigests)
+
+NUM_CORES = multiprocessing.cpu_count()
+# how many substr pairs sparseCooccurr counts at a time
+PAIR_BLOCK_SIZE = 1 << 24
+# multiCooccurr splits the pair space, and the files, into this many parts
+#  per core, so a slow one doesn't hold everything up
+PARTITIONS_PER_CORE = 4
+# how similar files have to be to share a cluster, unless given
+JACCARD_DEFAULT = 0.5
+# Knuth's multiplicative hash, spreads consecutive ids across partitions
+PARTITION_HASH_MULTIPLIER = 0x9e3779b97f4a7c15
 
 # TODO use it from mmlcs
-def sortedHist(hist, minT=0):
-  "Actually returns a sorted list of (key, value) tuples"
-  tuples = hist.items()
+def sortedHist(hist, minT=0, limit=None):
+  """Actually returns a sorted list of (key, value) tuples. With a limit, only
+  that many of the biggest, without ever holding the whole sorted list."""
+  tuples = hist.iteritems()
   if minT > 0:
-    tuples = filter(lambda kvtuple: kvtuple[1] > minT, tuples)
-  # True implies reverse=True, aka DESCENDING
-  return mergeSort(tuples, __hist_cmp, True)
+    tuples = itertools.ifilter(lambda kvtuple: kvtuple[1] > minT, tuples)
+  return list(itertools.islice(externalSort(tuples, valueKey, DESCENDING), limit))
+
+def _rank(hexes):
+  """Returns (sorted hexes, new ids) where new ids maps each index of hexes to
+  its index in sorted hexes, so comparing ids is comparing hashes"""
+  order = np.argsort(np.array(hexes), kind='mergesort')
+  ranks = np.empty(len(hexes), dtype=np.int64)
+  ranks[order] = np.arange(len(hexes), dtype=np.int64)
+  return ([hexes[i] for i in order.tolist()], ranks)
+
+def csrArrays(rows, cols, num_rows, num_cols):
+  """Returns (indptr, indices) arrays for the distinct (row, col) pairs, so
+  the cols of row r are indices[indptr[r] : indptr[r+1]], sorted"""
+  keys = np.unique(rows.astype(np.int64) * num_cols + cols)
+  rows = keys // num_cols
+  indices = (keys - rows * num_cols).astype(np.int32)
+  indptr = np.zeros(num_rows + 1, dtype=np.int64)
+  np.cumsum(np.bincount(rows, minlength=num_rows), out=indptr[1:])
+  return (indptr, indices)
+
+def incidence(file_ids, substr_ids, num_files, num_substrs):
+  """Returns (file_to_substr, substr_to_file), the file/substr relation as
+  CSR (indptr, indices) arrays in both directions"""
+  file_to_substr = csrArrays(file_ids, substr_ids, num_files, num_substrs)
+  substr_to_file = csrArrays(substr_ids, file_ids, num_substrs, num_files)
+  return (file_to_substr, substr_to_file)
+
+def readTableFile(input_db):
+  "Same as readFile, but for a binary tabular db"
+  (file_digests, substr_digests, file_ids, substr_ids, _) = readTable(input_db)
+  (file_hexes, file_ranks) = _rank(hexDigests(file_digests))
+  (substr_hexes, substr_ranks) = _rank(hexDigests(substr_digests))
+  (file_to_substr, substr_to_file) = incidence(
+    file_ranks[file_ids],
+    substr_ranks[substr_ids],
+    len(file_hexes),
+    len(substr_hexes)
+  )
+  return (len(file_ids), file_hexes, substr_hexes, file_to_substr, substr_to_file)
 
 def readFile(input_db):
-  num_lines_read = 0
-  file_to_substr = {}
-  substr_to_file = {}
+  """Returns (number of rows, file hashes, substr hashes, file_to_substr,
+  substr_to_file). Hashes are interned as dense ids in sorted order, which
+  index the two hash lists, and the relation between them is a pair of CSR
+  arrays, see incidence."""
+  if isTable(input_db):
+    return readTableFile(input_db)
+  file_col = []
+  substr_col = []
   with open(input_db) as f:
     for l in f:
       # TODO how can wer verify the input format?
       # TODO not using file_offset
       (file_hash, substr_hash, file_offset) = l.strip().split("\t")
-      if file_hash in file_to_substr:
-        file_to_substr[file_hash].add(substr_hash)
-      else:
-        file_to_substr[file_hash] = set([substr_hash])
-      if substr_hash in substr_to_file:
-        substr_to_file[substr_hash].add(file_hash)
-      else:
-        substr_to_file[substr_hash] = set([file_hash])
-      num_lines_read += 1
-    return (num_lines_read, file_to_substr, substr_to_file)
+      file_col.append(file_hash)
+      substr_col.append(substr_hash)
+  file_hexes = sorted(set(file_col))
+  substr_hexes = sorted(set(substr_col))
+  file_index = dict((h, i) for (i, h) in enumerate(file_hexes))
+  substr_index = dict((h, i) for (i, h) in enumerate(substr_hexes))
+  (file_to_substr, substr_to_file) = incidence(
+    np.fromiter((file_index[h] for h in file_col), dtype=np.int64, count=len(file_col)),
+    np.fromiter((substr_index[h] for h in substr_col), dtype=np.int64, count=len(substr_col)),
+    len(file_hexes),
+    len(substr_hexes)
+  )
+  return (len(file_col), file_hexes, substr_hexes, file_to_substr, substr_to_file)
+
+def _row(csr, i):
+  (indptr, indices) = csr
+  return indices[indptr[i] : indptr[i + 1]]
 
 def bruteForceCooccurr(file_to_substr, substr_to_file):
   cooccurrences = {}
-  for file_hash in file_to_substr:
-    substr_list = list(file_to_substr[file_hash])
-    substr_list.sort()
+  for file_id in xrange(len(file_to_substr[0]) - 1):
+    # already sorted, so every pair is (smaller id, bigger id)
+    substr_list = _row(file_to_substr, file_id).tolist()
     # this is the really expensive loop
     for i in range(len(substr_list)):
       for j in range(i+1, len(substr_list)):
-        # sorting co-occurrence since order doesn't matter
-        if substr_list[i] < substr_list[j]:
-          pair = (substr_list[i], substr_list[j])
-        else:
-          pair = (substr_list[j], substr_list[i])
+        pair = (substr_list[i], substr_list[j])
         if pair in cooccurrences:
-          cooccurrences[pair].add(file_hash)
+          cooccurrences[pair].add(file_id)
         else:
-          cooccurrences[pair] = set([file_hash])
+          cooccurrences[pair] = set([file_id])
   return cooccurrences
 
 def topKCooccurr(file_to_substr, substr_to_file, topKSubstrs):
-  topKSet = set(map(lambda item: item[0], topKSubstrs))
+  topKMask = np.zeros(len(substr_to_file[0]) - 1, dtype=bool)
+  topKMask[[item[0] for item in topKSubstrs]] = True
   cooccurrences = {}
-  for file_hash in file_to_substr:
-    substr_list = list(file_to_substr[file_hash])
-    substr_list.sort()
-    substr_list = filter(lambda substr: substr in topKSet, substr_list)
+  for file_id in xrange(len(file_to_substr[0]) - 1):
+    substr_list = _row(file_to_substr, file_id)
+    substr_list = substr_list[topKMask[substr_list]].tolist()
     # this is the really expensive loop
     for i in range(len(substr_list)):
       for j in range(i+1, len(substr_list)):
-        # sorting co-occurrence since order doesn't matter
-        if substr_list[i] < substr_list[j]:
-          pair = (substr_list[i], substr_list[j])
-        else:
-          pair = (substr_list[j], substr_list[i])
+        pair = (substr_list[i], substr_list[j])
         if pair in cooccurrences:
-          cooccurrences[pair].add(file_hash)
+          cooccurrences[pair].add(file_id)
         else:
-          cooccurrences[pair] = set([file_hash])
+          cooccurrences[pair] = set([file_id])
   return cooccurrences
 
 def sampledCooccurr(file_to_substr, substr_to_file, sampling_rate):
   cooccurrences = {}
-  for file_hash in file_to_substr:
-    substr_list = list(file_to_substr[file_hash])
-    substr_list.sort()
+  for file_id in xrange(len(file_to_substr[0]) - 1):
+    substr_list = _row(file_to_substr, file_id).tolist()
     n_samples = int(float(len(substr_list)) / sampling_rate)
     for k in range(n_samples):
       i, j = None, None
@@ -113,69 +166,321 @@ def sampledCooccurr(file_to_substr, substr_to_file, sampling_rate):
       else:
         pair = (substr_list[j], substr_list[i])
       if pair in cooccurrences:
-        cooccurrences[pair].add(file_hash)
+        cooccurrences[pair].add(file_id)
       else:
-        cooccurrences[pair] = set([file_hash])
+        cooccurrences[pair] = set([file_id])
   return cooccurrences
 
-def genericCooccurr(file_to_substr, substr_to_file, sampling_rate, top_k, topKSubstrs):
-  if sampling_rate != 0:
+def _entryRows(file_to_substr):
+  "Returns the file id of every entry of a CSR relation"
+  (indptr, indices) = file_to_substr
+  return np.repeat(np.arange(len(indptr) - 1), np.diff(indptr))
+
+def _maskedRows(file_to_substr, mask):
+  "Returns a CSR relation with only the substr ids that are set in mask"
+  (indptr, indices) = file_to_substr
+  keep = mask[indices]
+  rows = _entryRows(file_to_substr)[keep]
+  new_indptr = np.zeros(len(indptr), dtype=np.int64)
+  np.cumsum(np.bincount(rows, minlength=len(indptr) - 1), out=new_indptr[1:])
+  return (new_indptr, indices[keep])
+
+def _laterCounts(file_to_substr, lo=0, hi=None):
+  """Returns how many entries come after each entry in its row, for the
+  entries of the files in [lo, hi). Rows are sorted, so that's how many pairs
+  each entry is the first id of."""
+  (indptr, indices) = file_to_substr
+  if hi is None:
+    hi = len(indptr) - 1
+  rows = np.repeat(np.arange(lo, hi), np.diff(indptr[lo : hi + 1]))
+  return indptr[rows + 1] - np.arange(indptr[lo], indptr[hi]) - 1
+
+def _pairKeys(indices, entries, counts, num_substrs):
+  """Returns first * num_substrs + second as an int64 array, for every pair
+  whose first id is one of entries, given how many entries come after each
+  of them in its row"""
+  total = counts.sum()
+  # for each entry, the offsets 1..counts of the entries after it
+  steps = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts) + 1
+  seconds = indices[np.repeat(entries, counts) + steps]
+  return np.repeat(indices[entries].astype(np.int64), counts) * num_substrs + seconds
+
+def sparseCooccurr(file_to_substr, substr_to_file, minT=0, topKSubstrs=None,
+    block_size=PAIR_BLOCK_SIZE):
+  """Returns a dict of (substr id, substr id) to the number of files with
+  both, for every pair in more than minT files. This is the upper triangle of
+  X^T X, where X is the file x substr incidence matrix. The pairs are
+  generated a block of first substr ids at a time, each block about
+  block_size pairs, and counted by sorting, so no file sets are kept."""
+  if topKSubstrs is not None:
+    topKMask = np.zeros(len(substr_to_file[0]) - 1, dtype=bool)
+    topKMask[[item[0] for item in topKSubstrs]] = True
+    file_to_substr = _maskedRows(file_to_substr, topKMask)
+  (indptr, indices) = file_to_substr
+  num_substrs = len(substr_to_file[0]) - 1
+  later = _laterCounts(file_to_substr)
+  # entries grouped by substr id, aka the first id of their pairs
+  order = np.argsort(indices, kind='mergesort')
+  firsts = indices[order]
+  pairs_before = np.zeros(len(order) + 1, dtype=np.int64)
+  np.cumsum(later[order], out=pairs_before[1:])
+  cooccurrence_counts = {}
+  lo = 0
+  while lo < len(order):
+    hi = np.searchsorted(pairs_before, pairs_before[lo] + block_size, side='right') - 1
+    # never split the entries of one substr id across blocks
+    hi = np.searchsorted(firsts, firsts[max(hi, lo + 1) - 1], side='right')
+    block = order[lo : hi]
+    lo = hi
+    keys = _pairKeys(indices, block, later[block], num_substrs)
+    if len(keys) == 0:
+      continue
+    (keys, key_counts) = np.unique(keys, return_counts=True)
+    above = key_counts > minT
+    for (key, count) in itertools.izip(keys[above].tolist(), key_counts[above].tolist()):
+      cooccurrence_counts[(key // num_substrs, key % num_substrs)] = count
+  return cooccurrence_counts
+
+def _partitions(firsts, num_partitions):
+  "Hashes first substr ids to partitions, so a partition isn't one id range"
+  with np.errstate(over='ignore'):
+    hashes = firsts.astype(np.uint64) * np.uint64(PARTITION_HASH_MULTIPLIER)
+  return ((hashes >> np.uint64(32)) % np.uint64(num_partitions)).astype(np.int64)
+
+def _mapPairs(tupleargs):
+  """Counts the pairs of the files in [lo, hi) of a published CSR relation,
+  and writes one (keys, counts) partial per partition of the pair space to
+  out_dir. Returns the partitions it wrote."""
+  (lo, hi, csr_ref, num_substrs, num_partitions, out_dir, block_size) = tupleargs
+  (indptr, indices) = resolve([csr_ref])[0]
+  # only the entries of this task's files, not the whole relation
+  later = _laterCounts((indptr, indices), lo, hi)
+  # Map<partition, list<(keys, counts)>>
+  partials = {}
+  start = indptr[lo]
+  end = indptr[hi]
+  pairs_before = np.zeros(end - start + 1, dtype=np.int64)
+  np.cumsum(later, out=pairs_before[1:])
+  i = 0
+  while i < end - start:
+    j = max(i + 1, np.searchsorted(pairs_before, pairs_before[i] + block_size, side='right') - 1)
+    keys = _pairKeys(indices, np.arange(start + i, start + j), later[i : j], num_substrs)
+    i = j
+    if len(keys) == 0:
+      continue
+    (keys, counts) = np.unique(keys, return_counts=True)
+    parts = _partitions(keys // num_substrs, num_partitions)
+    for part in np.unique(parts).tolist():
+      mask = parts == part
+      partials.setdefault(part, []).append( (keys[mask], counts[mask].astype(np.int64)) )
+  for part in partials:
+    (keys, counts) = mergeCounts(partials[part])
+    np.save(
+      os.path.join(out_dir, '%d-%d.npy' % (part, lo)),
+      np.vstack((keys.astype(np.int64), counts))
+    )
+  return partials.keys()
+
+def _reducePairs(tupleargs):
+  "Sums the partials of one partition, and returns the pairs above minT"
+  (paths, minT) = tupleargs
+  partials = []
+  for path in paths:
+    partial = np.load(path)
+    partials.append( (partial[0], partial[1]) )
+    os.remove(path)
+  (keys, counts) = mergeCounts(partials)
+  above = counts > minT
+  return (keys[above].astype(np.int64), counts[above])
+
+def _fileRanges(file_to_substr, num_ranges):
+  "Splits files into about num_ranges ranges with the same number of pairs"
+  lens = np.diff(file_to_substr[0])
+  pairs_before = np.zeros(len(lens) + 1, dtype=np.int64)
+  np.cumsum(lens * (lens - 1) / 2, out=pairs_before[1:])
+  targets = np.linspace(0, pairs_before[-1], num_ranges + 1)[1:-1]
+  bounds = np.unique(np.concatenate((
+    [0],
+    np.searchsorted(pairs_before, targets),
+    [len(lens)]
+  )))
+  return zip(bounds[:-1].tolist(), bounds[1:].tolist())
+
+def multiCooccurr(file_to_substr, substr_to_file, minT=0, topKSubstrs=None,
+    pool=None, block_size=PAIR_BLOCK_SIZE):
+  """Same as sparseCooccurr, but files are sharded across the workers of pool.
+  Each worker counts the pairs of its files and writes them out partitioned
+  by a hash of the first substr id, then every partition is summed on its
+  own, so no process ever holds every pair, only the ones above minT."""
+  if topKSubstrs is not None:
+    topKMask = np.zeros(len(substr_to_file[0]) - 1, dtype=bool)
+    topKMask[[item[0] for item in topKSubstrs]] = True
+    file_to_substr = _maskedRows(file_to_substr, topKMask)
+  num_substrs = len(substr_to_file[0]) - 1
+  num_partitions = NUM_CORES * PARTITIONS_PER_CORE
+  own_pool = pool is None
+  if own_pool:
+    pool = multiprocessing.Pool(NUM_CORES)
+  # workers memory map the relation, instead of unpickling it per task
+  csr_ref = publishArrays(file_to_substr)
+  out_dir = tempfile.mkdtemp(prefix='mmlcs-pairs-')
+  try:
+    tasks = [
+      (lo, hi, csr_ref, num_substrs, num_partitions, out_dir, block_size)
+      for (lo, hi) in _fileRanges(file_to_substr, NUM_CORES * PARTITIONS_PER_CORE)
+    ]
+    # Map<partition, list<path>>
+    paths = {}
+    for ((lo, _, _, _, _, _, _), parts) in zip(tasks, pool.map(_mapPairs, tasks, 1)):
+      for part in parts:
+        paths.setdefault(part, []).append(os.path.join(out_dir, '%d-%d.npy' % (part, lo)))
+    cooccurrence_counts = {}
+    for (keys, counts) in pool.imap_unordered(_reducePairs, [(paths[part], minT) for part in paths]):
+      for (key, count) in itertools.izip(keys.tolist(), counts.tolist()):
+        cooccurrence_counts[(key // num_substrs, key % num_substrs)] = count
+  finally:
+    unpublish(csr_ref)
+    shutil.rmtree(out_dir)
+    if own_pool:
+      pool.close()
+      pool.join()
+  return cooccurrence_counts
+
+def minHashCooccurr(file_to_substr, substr_to_file, threshold):
+  """Returns a dict of (substr id, substr id) to the number of files with
+  both, but only for pairs whose file sets have an estimated Jaccard
+  similarity of at least threshold. Candidate pairs come from LSH over the
+  MinHash signatures of the file sets, so most pairs are never looked at."""
+  sigs = signatures(substr_to_file)
+  (num_bands, rows_per_band) = bands(sigs.shape[1], threshold)
+  cooccurrence_counts = {}
+  for (i, j) in similarPairs(sigs, threshold, num_bands, rows_per_band):
+    cooccurrence_counts[(i, j)] = np.intersect1d(
+      _row(substr_to_file, i),
+      _row(substr_to_file, j),
+      assume_unique=True
+    ).size
+  return cooccurrence_counts
+
+def fileClusters(file_to_substr, threshold):
+  """Returns the cluster id of every file, where files with an estimated
+  Jaccard similarity of at least threshold between their substr sets, or a
+  chain of such files between them, share a cluster"""
+  sigs = signatures(file_to_substr)
+  (num_bands, rows_per_band) = bands(sigs.shape[1], threshold)
+  return clusters(sigs, threshold, num_bands, rows_per_band)
+
+def genericCooccurr(file_to_substr, substr_to_file, sampling_rate, top_k, topKSubstrs,
+    use_multi=False, minT=0, pool=None):
+  """Returns a dict of (substr id, substr id) to the set of files with both,
+  or with use_multi, to the number of files with both, for the pairs in more
+  than minT files, counted by multiCooccurr on pool"""
+  if use_multi:
+    assert sampling_rate == 0, 'sampling is not supported on multiple cores'
+    if top_k == 0:
+      topKSubstrs = None
+    return multiCooccurr(file_to_substr, substr_to_file, minT, topKSubstrs, pool)
+  elif sampling_rate != 0:
     return sampledCooccurr(file_to_substr, substr_to_file, sampling_rate)
   elif top_k != 0 and topKSubstrs is not None:
     return topKCooccurr(file_to_substr, substr_to_file, topKSubstrs)
   else:
     return bruteForceCooccurr(file_to_substr, substr_to_file)
 
-def main(input_db, tabular, sampling_rate, top_k):
+def main(input_db, tabular, sampling_rate, top_k, sparse=False, use_multi=False,
+    jaccard=None):
   start = time.time()
-  (num_lines_read, file_to_substr, substr_to_file) = readFile(input_db)
+  (num_lines_read, file_hexes, substr_hexes, file_to_substr, substr_to_file) = \
+    readFile(input_db)
   now = time.time()
   print("[+] Reading %d lines, %d file hashes, and %d substr hashes complete; time elapsed: %1.3f" % (
     num_lines_read,
-    len(file_to_substr),
-    len(substr_to_file),
+    len(file_hexes),
+    len(substr_hexes),
     now - start
   ), file=sys.stderr)
   start = now
   if top_k != 0:
-    substrCounts = {}
-    for substr in substr_to_file:
-      substrCounts[substr] = len(substr_to_file[substr])
-    topKSubstrs = sortedHist(substrCounts, 1)[:top_k]
+    # Map<substr id, number of files>
+    substrCounts = dict(enumerate(np.diff(substr_to_file[0]).tolist()))
+    topKSubstrs = sortedHist(substrCounts, 1, top_k)
     now = time.time()
     print("[+] Done sorting %d substr occurrences; time elapsed: %1.3f" % (len(topKSubstrs), now - start), file=sys.stderr)
   else:
     topKSubstrs = None
     start = now
-  # TODO use "indexed" substr occurrences
-  cooccurrences = genericCooccurr(file_to_substr, substr_to_file, sampling_rate, top_k, topKSubstrs)
-  now = time.time()
-  print("[+] Reading %d co-occurrences; time elapsed: %1.3f" % (len(cooccurrences), now - start), file=sys.stderr)
-  start = now
-  cooccurrence_counts = {}
-  for cooccur in cooccurrences:
-    cooccurrence_counts[cooccur] = len(cooccurrences[cooccur])
   # TODO dont use a constant
   # TODO really dont use a constant
   if sampling_rate != 0:
-    cooccur_sorted_hist = sortedHist(cooccurrence_counts, 1)
+    minT = 1
   elif top_k != 0:
-    cooccur_sorted_hist = sortedHist(cooccurrence_counts, 1)
+    minT = 1
+  else:
+    minT = 10
+  if jaccard is not None:
+    # only the counts of pairs with similar file sets
+    cooccurrence_counts = minHashCooccurr(file_to_substr, substr_to_file, jaccard)
+    now = time.time()
+    print("[+] Counting %d similar co-occurrences; time elapsed: %1.3f" % (len(cooccurrence_counts), now - start), file=sys.stderr)
+    start = now
+  elif use_multi or sparse:
+    # only the counts, without a set of files per pair
+    if use_multi:
+      cooccurrence_counts = genericCooccurr(file_to_substr, substr_to_file, sampling_rate,
+        top_k, topKSubstrs, use_multi, minT)
+    else:
+      cooccurrence_counts = sparseCooccurr(file_to_substr, substr_to_file, minT, topKSubstrs)
+    now = time.time()
+    print("[+] Counting %d co-occurrences; time elapsed: %1.3f" % (len(cooccurrence_counts), now - start), file=sys.stderr)
+    start = now
   else:
-    cooccur_sorted_hist = sortedHist(cooccurrence_counts, 10)
+    # TODO use "indexed" substr occurrences
+    cooccurrences = genericCooccurr(file_to_substr, substr_to_file, sampling_rate, top_k, topKSubstrs)
+    now = time.time()
+    print("[+] Reading %d co-occurrences; time elapsed: %1.3f" % (len(cooccurrences), now - start), file=sys.stderr)
+    start = now
+    cooccurrence_counts = {}
+    for cooccur in cooccurrences:
+      cooccurrence_counts[cooccur] = len(cooccurrences[cooccur])
+  cooccur_sorted_hist = sortedHist(cooccurrence_counts, minT)
   now = time.time()
   print("[+] Done sorting %d co-occurrences; time elapsed: %1.3f" % (len(cooccur_sorted_hist), now - start), file=sys.stderr)
   start = now
   if not tabular:
-    print(json.dumps(cooccur_sorted_hist[:20]))
+    print(json.dumps([
+      ((substr_hexes[pair[0]], substr_hexes[pair[1]]), count)
+      for (pair, count) in cooccur_sorted_hist[:20]
+    ]))
   else:
     for i in range(len(cooccur_sorted_hist)):
       print("%s\t%s\t%d" % (
-        cooccur_sorted_hist[i][0][0],
-        cooccur_sorted_hist[i][0][1],
+        substr_hexes[cooccur_sorted_hist[i][0][0]],
+        substr_hexes[cooccur_sorted_hist[i][0][1]],
         cooccur_sorted_hist[i][1]
       ))
 
+def clusterMain(input_db, jaccard):
+  start = time.time()
+  (num_lines_read, file_hexes, substr_hexes, file_to_substr, substr_to_file) = \
+    readFile(input_db)
+  now = time.time()
+  print("[+] Reading %d lines, %d file hashes, and %d substr hashes complete; time elapsed: %1.3f" % (
+    num_lines_read,
+    len(file_hexes),
+    len(substr_hexes),
+    now - start
+  ), file=sys.stderr)
+  start = now
+  file_clusters = fileClusters(file_to_substr, jaccard)
+  now = time.time()
+  print("[+] Clustering %d files into %d clusters; time elapsed: %1.3f" % (
+    len(file_clusters),
+    len(set(file_clusters)),
+    now - start
+  ), file=sys.stderr)
+  for i in range(len(file_clusters)):
+    print("%s\t%s" % (file_hexes[file_clusters[i]], file_hexes[i]))
+
 if __name__ == '__main__':
   parser = argparse.ArgumentParser(
     description='Approximates co-occurences amongst long common substrings'
@@ -199,10 +504,46 @@ if __name__ == '__main__':
     '--topk',
     type=int
   )
+  parser.add_argument(
+    '-x',
+    '--sparse',
+    action='store_true',
+    help='Only count co-occurrences, as a blocked sparse product, instead of keeping the files of every pair'
+  )
+  parser.add_argument(
+    '-m',
+    '--multi',
+    action='store_true',
+    help='Count co-occurrences on multiple cores, implies --sparse'
+  )
+  parser.add_argument(
+    '-j',
+    '--jaccard',
+    type=float,
+    help='Only count pairs of substrs whose file sets are at least this similar, found with MinHash LSH'
+  )
+  parser.add_argument(
+    '--clusters',
+    action='store_true',
+    help='Instead of co-occurrences, print a cluster id for every file, grouping files whose substr sets are at least --jaccard similar'
+  )
   args = parser.parse_args()
   sampling_rate = args.samplingrate if args.samplingrate is not None else 0
   top_k = args.topk if args.topk is not None else 0
   if sampling_rate != 0 and top_k != 0:
     print("Cant have both sampling_rate (%d) and top k (%d)" % (sampling_rate, top_k), file=sys.stderr)
     sys.exit(-1)
-  main(args.input_db, args.tabular, sampling_rate, top_k)
+  if sampling_rate != 0 and (args.sparse or args.multi):
+    print("Cant sample (%d) with sparse counting" % sampling_rate, file=sys.stderr)
+    sys.exit(-1)
+  if args.jaccard is not None and not 0 < args.jaccard <= 1:
+    print("Jaccard similarity %f should be in (0, 1]" % args.jaccard, file=sys.stderr)
+    sys.exit(-1)
+  if args.jaccard is not None and (sampling_rate != 0 or top_k != 0):
+    print("Cant filter by jaccard similarity and sample or use top k", file=sys.stderr)
+    sys.exit(-1)
+  if args.clusters:
+    clusterMain(args.input_db, args.jaccard if args.jaccard is not None else JACCARD_DEFAULT)
+  else:
+    main(args.input_db, args.tabular, sampling_rate, top_k, args.sparse, args.multi,
+      args.jaccard)
@@ -0,0 +1,177 @@
+# corpusindex.py
+# Sat Oct 17 15:21:47 PDT 2026
+#
+# Everything an incremental run needs to remember about the files it already
+# processed, in a single SQLite file: the ngram ids of every file keyed by its
+# hash, the document frequencies of every ngram, and the substring occurances
+# extracted from every file. The files with an ngram are found from the
+# compressed ids of the files, an inverted table of them is many times the
+# size of the corpus. Digests are passed around as hex everywhere else,
+# but stored raw, like in store.py.
+
+import binascii
+import sqlite3
+import zlib
+
+import numpy as np
+
+# SQLite limits how many parameters a single statement can have
+LOOKUP_BATCH_SIZE = 500
+
+def _raw(hex_hash):
+  return sqlite3.Binary(binascii.unhexlify(hex_hash))
+
+def packIds(ids):
+  """Serializes a sorted uint64 array of distinct ids. The gaps between sorted
+  ids are small, so they compress a lot better than the ids themselves."""
+  gaps = np.ediff1d(ids, to_begin=ids[:1]).astype(np.uint64)
+  return sqlite3.Binary(zlib.compress(gaps.tobytes()))
+
+def unpackIds(blob):
+  "The inverse of packIds"
+  gaps = np.frombuffer(zlib.decompress(blob), dtype=np.uint64)
+  return np.cumsum(gaps, dtype=np.uint64)
+
+def openIndex(path, n):
+  """Returns a connection to the index at path, creating it if needed. An
+  index only ever holds ngrams of a single size."""
+  conn = sqlite3.connect(path)
+  conn.text_factory = str
+  # the index can be rebuilt from the samples, so favor speed over durability
+  conn.execute('PRAGMA journal_mode = WAL')
+  conn.execute('PRAGMA synchronous = OFF')
+  conn.execute(
+    'CREATE TABLE IF NOT EXISTS meta ('
+    '  key TEXT PRIMARY KEY,'
+    '  value BLOB NOT NULL'
+    ')'
+  )
+  # path is NULL once the file at path changed, so it can't be re-read
+  conn.execute(
+    'CREATE TABLE IF NOT EXISTS files ('
+    '  hash BLOB PRIMARY KEY,'
+    '  path TEXT,'
+    '  size INTEGER NOT NULL,'
+    '  mtime REAL NOT NULL,'
+    '  ngrams BLOB NOT NULL'
+    ')'
+  )
+  conn.execute('CREATE INDEX IF NOT EXISTS files_path ON files (path)')
+  conn.execute(
+    'CREATE TABLE IF NOT EXISTS occurances ('
+    '  file_hash BLOB NOT NULL,'
+    '  substr_hash BLOB NOT NULL,'
+    '  offset INTEGER NOT NULL'
+    ')'
+  )
+  conn.execute(
+    'CREATE INDEX IF NOT EXISTS occurances_file_hash ON occurances (file_hash)'
+  )
+  conn.execute('INSERT OR IGNORE INTO meta (key, value) VALUES (?, ?)', ('n', str(n)))
+  conn.commit()
+  (stored_n,) = conn.execute('SELECT value FROM meta WHERE key = ?', ('n',)).fetchone()
+  assert int(stored_n) == n, 'index %s holds %s-grams, not %d-grams' % (path, stored_n, n)
+  return conn
+
+def indexedFiles(conn):
+  "Returns a dict of path to (size, mtime) for every indexed file"
+  ret = {}
+  for (path, size, mtime) in conn.execute(
+      'SELECT path, size, mtime FROM files WHERE path IS NOT NULL'):
+    ret[path] = (size, mtime)
+  return ret
+
+def knownHashes(conn, hex_hashes):
+  "Returns the set of hex_hashes that are already indexed"
+  hex_hashes = list(hex_hashes)
+  ret = set()
+  for i in xrange(0, len(hex_hashes), LOOKUP_BATCH_SIZE):
+    batch = hex_hashes[i : i + LOOKUP_BATCH_SIZE]
+    rows = conn.execute(
+      'SELECT hash FROM files WHERE hash IN (%s)' % ','.join('?' * len(batch)),
+      [_raw(hex_hash) for hex_hash in batch]
+    )
+    for (raw_hash,) in rows:
+      ret.add(binascii.hexlify(raw_hash))
+  return ret
+
+def putFile(conn, hex_hash, path, size, mtime, ids=None):
+  """Records that the file at path has hex_hash. Whatever was at path before
+  is unlinked from it. The ngram ids can only be omitted when hex_hash is
+  already indexed, in which case only its path is updated."""
+  conn.execute('UPDATE files SET path = NULL WHERE path = ?', (path,))
+  if ids is None:
+    conn.execute(
+      'UPDATE files SET path = ?, size = ?, mtime = ? WHERE hash = ?',
+      (path, size, mtime, _raw(hex_hash))
+    )
+  else:
+    conn.execute(
+      'INSERT INTO files (hash, path, size, mtime, ngrams) VALUES (?, ?, ?, ?, ?)',
+      (_raw(hex_hash), path, size, mtime, packIds(ids))
+    )
+
+def filesWithAny(conn, ids):
+  """Yields (hex hash, path) for every file that still has a path and
+  contains any of the sorted ids"""
+  if len(ids) == 0:
+    return
+  for (raw_hash, path, blob) in conn.execute(
+      'SELECT hash, path, ngrams FROM files WHERE path IS NOT NULL'):
+    file_ids = unpackIds(blob)
+    # both are sorted, so look up the smaller in the bigger
+    if len(file_ids) < len(ids):
+      found = np.searchsorted(ids, file_ids)
+      hit = ids[np.minimum(found, len(ids) - 1)] == file_ids
+    else:
+      found = np.searchsorted(file_ids, ids)
+      hit = file_ids[np.minimum(found, len(file_ids) - 1)] == ids
+    if hit.any():
+      yield (binascii.hexlify(raw_hash), path)
+
+def getFrequencies(conn):
+  """Returns the document frequencies of every indexed ngram, as a (sorted
+  ids, counts) tuple of arrays like filefuncs.mergeCounts"""
+  keys = conn.execute('SELECT value FROM meta WHERE key = ?', ('keys',)).fetchone()
+  counts = conn.execute('SELECT value FROM meta WHERE key = ?', ('counts',)).fetchone()
+  if keys is None:
+    return (np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.int64))
+  return (
+    unpackIds(keys[0]),
+    np.frombuffer(zlib.decompress(counts[0]), dtype=np.int64)
+  )
+
+def putFrequencies(conn, frequencies):
+  (keys, counts) = frequencies
+  conn.execute(
+    'INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+    ('keys', packIds(keys))
+  )
+  conn.execute(
+    'INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+    ('counts', sqlite3.Binary(zlib.compress(counts.astype(np.int64).tobytes())))
+  )
+
+def putOccurances(conn, file_hashes, substr_indexes):
+  """Replaces every occurance of the files in file_hashes with substr_indexes,
+  a list of (file hash, substr hash, index) tuples"""
+  file_hashes = list(file_hashes)
+  for i in xrange(0, len(file_hashes), LOOKUP_BATCH_SIZE):
+    batch = file_hashes[i : i + LOOKUP_BATCH_SIZE]
+    conn.execute(
+      'DELETE FROM occurances WHERE file_hash IN (%s)' % ','.join('?' * len(batch)),
+      [_raw(hex_hash) for hex_hash in batch]
+    )
+  conn.executemany(
+    'INSERT INTO occurances (file_hash, substr_hash, offset) VALUES (?, ?, ?)',
+    ((_raw(file_hash), _raw(sub_hash), index)
+      for (file_hash, sub_hash, index) in substr_indexes)
+  )
+
+def getOccurances(conn):
+  "Returns every (file hash, substr hash, index) tuple in the index"
+  return [
+    (binascii.hexlify(file_hash), binascii.hexlify(sub_hash), index)
+    for (file_hash, sub_hash, index) in conn.execute(
+      'SELECT file_hash, substr_hash, offset FROM occurances ORDER BY rowid')
+  ]
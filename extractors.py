@@ -2,15 +2,77 @@
 # Trevor Pottinger
 # Sun May 17 09:58:11 PDT 2015
 
+import numpy as np
+
+from sketch import (estimate)
+
+# ngrams up to this many bytes are packed losslessly into a uint64, bigger
+#  ones get a Rabin-Karp hash, which two different ngrams can share
+MAX_PACKED_N = 8
+# has to be odd so it's invertible modulo 2**64
+ROLLING_BASE = 0x100000001b3
+ROLLING_MASK = (1 << 64) - 1
+# substrings_list only extends over ngrams found in more files than this
+# TODO math.log(len(hist))
+MIN_FILE_COUNT = 10
+# RFC does max substring make sense?
+# max_file_count makes sense when <10% samples cluster
+# TODO this probably depends on expected results
+MIN_SUBSTRING_LEN = 8
+
+# ngram tables of ids below this get an exact bitmap as their prefilter,
+#  which covers every packed ngram for n <= 3
+EXACT_BITMAP_BITS = 1 << 24
+BLOOM_BITS_PER_KEY = 16
+# one per hash, two keeps a miss down to a couple of bit tests
+BLOOM_MULTIPLIERS = [0x9e3779b97f4a7c15, 0xc2b2ae3d27d4eb4f]
+# If only these could be an enum
+PREFILTER_EXACT = 0
+PREFILTER_BLOOM = 1
+
+def _inverse(a):
+  "Multiplicative inverse of an odd a modulo 2**64, via Newton's method"
+  x = a
+  for _ in range(6):
+    x = (x * (2 - a * x)) & ROLLING_MASK
+  return x
+
+ROLLING_BASE_INVERSE = _inverse(ROLLING_BASE)
+
+# Every extractor takes a bytestring, an mmap or a buffer, all of which slice
+#  into bytestrings without copying the whole input. Slices of a memoryview are
+#  memoryviews though, which aren't hashable, so the extractors that key things
+#  by slices copy each slice they need, never the whole window.
+
+def _grams(data, n):
+  "Yields the ngram at every offset as a bytestring"
+  if isinstance(data, memoryview):
+    for i in xrange(len(data) - n + 1):
+      yield data[i : i + n].tobytes()
+  else:
+    for i in xrange(len(data) - n + 1):
+      # python slicing is the best
+      yield data[i : i + n]
+
+def _slice(data, start, end):
+  "A single slice as a bytestring, without copying the rest of the input"
+  if isinstance(data, memoryview):
+    return data[start : end].tobytes()
+  return data[start : end]
+
+def _byte_array(data):
+  "Returns a zero copy uint8 array over any of the supported inputs"
+  if isinstance(data, memoryview):
+    return np.asarray(data, dtype=np.uint8)
+  return np.frombuffer(data, dtype=np.uint8)
+
 def ngrams(data, n):
   "Expects a bytestring and returns a histogram of ngrams"
   assert n >= 0, 'n must be greater than zero: %d' % n
   if n > len(data):
     return {}
   hist = {}
-  for i in xrange(len(data) - n + 1):
-    # python slicing is the best
-    gram = data[i : i + n]
+  for gram in _grams(data, n):
     if gram in hist:
       hist[gram] += 1
     else:
@@ -18,49 +80,37 @@ def ngrams(data, n):
   return hist
 
 def substrings(data, n, hist):
-  """Assumes hist is a bunch of ngrams. It could be a set or a dict (as long as
-  it supports the `in` syntax for membership testing. Although the current
-  implementation requires a dict so counts can be constant over a substr"""
-  assert n >= 0, 'n must be greater than zero: %d' % n
-  assert len(hist) > 0, 'hist must be non-empty'
-  if n > len(data):
-    return {}
+  """Assumes hist is a bunch of ngrams, either a dict of ngram bytestrings or
+  an ngram table, see ngram_counts. The counts are needed so they can be
+  constant over a substr"""
   subs = {}
-  i = 0
-  while i < len(data) - n + 1:
-    gram = data[i : i + n]
-    if gram in hist:
-      # select longest substring in hist
-      end = i + n
-      count = hist[gram]
-      for j in xrange(i + 1, len(data) - n + 1):
-        jgram = data[j : j + n]
-        # RFC how should we handle changes in the hist value, aka count for
-        #  that ngram? increases are interesting, decreases are unhelpful(?)
-        if jgram in hist and hist[jgram] == count:
-          end += 1
-        else:
-          break
-      # TODO use a constant instead of 4?
-      if end - i >= 4:
-        sub = data[i : end]
-        if sub in subs:
-          subs[sub] += 1
-        else:
-          subs[sub] = 1
-        i = end
-    # if only python had real for loops and that bug wouldn't have happened..
-    i += 1
+  for (sub, _) in substrings_offsets(data, n, hist):
+    if sub in subs:
+      subs[sub] += 1
+    else:
+      subs[sub] = 1
   return subs
 
+def substrings_offsets(data, n, hist):
+  """Like substrings, but returns a list of (substring, index) of every one of
+  them, in order, instead of counting them"""
+  assert n >= 0, 'n must be greater than zero: %d' % n
+  assert _hist_len(hist) > 0, 'hist must be non-empty'
+  if n > len(data):
+    return []
+  counts = ngram_counts(data, n, hist)
+  # TODO use a constant instead of 3?
+  return [
+    (_slice(data, start, end), start)
+    for (start, end) in _substring_spans(counts, n, 0, 3, True)
+  ]
+
 def ngrams_set_generator(data, n):
   assert n >= 0, 'n must be greater than zero: %d' % n
   if n > len(data):
     return set()
   seen = set()
-  for i in xrange(len(data) - n + 1):
-    # python slicing is the best
-    gram = data[i : i + n]
+  for gram in _grams(data, n):
     if gram in seen:
       continue
     else:
@@ -69,53 +119,251 @@ def ngrams_set_generator(data, n):
   return seen
 
 def substrings_list(data, n, hist, require_equal_counts=True):
-  """Assumes hist is a bunch of ngrams. It could be a set or a dict (as long as
-  it supports the `in` syntax for membership testing. Although the current
-  implementation requires a dict so counts can be constant over a substr.
-  Returns a list of (substring, index)."""
+  """Assumes hist is a bunch of ngrams, either a dict of ngram bytestrings or
+  an ngram table, see ngram_counts. The counts are needed so they can be
+  constant over a substr. Returns a list of (substring, index)."""
   assert n >= 0, 'n must be greater than zero: %d' % n
-  assert len(hist) > 0, 'hist must be non-empty'
+  assert _hist_len(hist) > 0, 'hist must be non-empty'
   if n > len(data):
     return []
+  # absent ngrams have a count of 0, which never passes min_file_count
+  counts = ngram_counts(data, n, hist)
+  return _extend_substrings(data, n, counts, require_equal_counts)
+
+def _substring_spans(counts, n, min_count, min_len, require_equal_counts):
+  """Yields the (start, end) of every substring that the greedy extension
+  keeps: from each offset whose ngram count is above min_count, extend over
+  the following ngrams with the same count (or any count above min_count),
+  keep the substring if it's longer than min_len, and move on past its end.
+  Runs of ngrams are found all at once from where the counts change, and
+  only runs that are long enough are visited at all, since a shorter one
+  never moves the next offset past the start of the next run."""
+  counts = np.asarray(counts)
+  if len(counts) == 0:
+    return
+  valid = counts > min_count
+  if require_equal_counts:
+    changes = counts[1:] != counts[:-1]
+  else:
+    changes = valid[1:] != valid[:-1]
+  starts = np.concatenate(([0], np.flatnonzero(changes) + 1))
+  lasts = np.append(starts[1:] - 1, len(counts) - 1)
+  # a substring from the middle of a run is shorter, so never long enough if
+  #  the whole run isn't
+  keep = valid[starts] & (lasts + n - starts > min_len)
+  resume = 0
+  for (start, last) in zip(starts[keep].tolist(), lasts[keep].tolist()):
+    if last < resume:
+      continue
+    # the previous substring may have ended in the middle of this run
+    start = max(start, resume)
+    end = last + n
+    if end - start > min_len:
+      yield (start, end)
+      # substrings don't overlap, nor touch
+      resume = end + 1
+
+def _extend_substrings(data, n, counts, require_equal_counts):
+  "substrings_list given the count of the ngram at every offset"
   subs = []
   seen = set()
-  i = 0
-  # TODO math.log(len(hist))
-  min_file_count = 10
-  # RFC does max substring make sense?
-  # max_file_count makes sense when <10% samples cluster
-  # TODO this probably depends on expected results
-  min_substring_len = 8
-  while i < len(data) - n + 1:
-    gram = data[i : i + n]
-    if gram not in hist or hist[gram] <= min_file_count:
-      i += 1  # ugh now we increment i in two places.. for loops would fix this
+  for (start, end) in _substring_spans(counts, n, MIN_FILE_COUNT,
+      MIN_SUBSTRING_LEN, require_equal_counts):
+    sub = _slice(data, start, end)
+    if sub not in seen:
+      # TODO hash the sub here?
+      subs.append( (sub, start) )
+      seen.add(sub)
+    else:
+      # RFC should we include multiple occurances?
+      pass
+  return subs
+
+def multi_substrings_list(data, ns, hists, require_equal_counts=True, starts=None):
+  """Like substrings_list for each of ns, with a matching list of ngram
+  tables. An empty table extracts nothing instead of failing. With starts,
+  each n only extracts from its start on. Returns a list of lists of
+  (substring, index), in the order of ns."""
+  subs = []
+  for (k, (n, hist)) in enumerate(zip(ns, hists)):
+    start = starts[k] if starts is not None else 0
+    if n > len(data) - start or _hist_len(hist) == 0:
+      subs.append([])
       continue
-    # select longest substring in hist
-    end = i + n
-    count = hist[gram]
-    for j in xrange(i + 1, len(data) - n + 1):
-      jgram = data[j : j + n]
-      # RFC how should we handle changes in the hist value, aka count for
-      #  that ngram? increases are interesting, decreases are unhelpful(?)
-      #if jgram in hist and hist[jgram] == count:
-      # Or does a dynamic threshhold make more sense?
-      if jgram in hist and \
-          ((not require_equal_counts and hist[jgram] > min_file_count) or \
-           (require_equal_counts and hist[jgram] == count)):
-        end += 1
-      else:
-        break
-    if end - i > min_substring_len:
-      sub = data[i : end]
-      if sub not in seen:
-        # TODO hash the sub here?
-        subs.append( (sub, i) )
-        seen.add(sub)
-      else:
-        # RFC should we include multiple occurances?
-        pass
-      i = end
-    # if only python had real for loops and that bug wouldn't have happened..
-    i += 1
+    part = buffer(data, start) if start > 0 else data
+    counts = table_lookup(hist, ngram_id_array(part, n))
+    subs.append([
+      (sub, start + index)
+      for (sub, index) in _extend_substrings(part, n, counts, require_equal_counts)
+    ])
   return subs
+
+def gram_id(gram):
+  "Returns the same uint64 id for a single ngram that ngram_id_array does"
+  h = 0
+  if len(gram) <= MAX_PACKED_N:
+    for c in gram:
+      h = (h << 8) | ord(c)
+  else:
+    for c in gram:
+      h = (h * ROLLING_BASE + ord(c)) & ROLLING_MASK
+  return h
+
+def ngram_id_array(data, n):
+  """Expects a bytestring, or any of the other supported inputs, and returns
+  a uint64 array with the id of the ngram starting at every offset. Small
+  ngrams are packed big endian, so ids sort like the ngrams do. Bigger ones
+  are hashed, so an ngram table of them can't tell two ngrams with the same
+  hash apart. Some pair of k distinct ngrams collides with a chance of about
+  k**2 / 2**65, and then one gets counted as the other."""
+  assert n > 0, 'n must be greater than zero: %d' % n
+  if n > len(data):
+    return np.zeros(0, dtype=np.uint64)
+  d = _byte_array(data).astype(np.uint64)
+  m = len(d) - n + 1
+  if n <= MAX_PACKED_N:
+    ids = d[:m].copy()
+    for k in range(1, n):
+      ids <<= np.uint64(8)
+      ids |= d[k : k + m]
+    return ids
+  # hash_i = sum(d[t] * B**(i+n-1-t)) for t in [i, i+n), computed from prefix
+  #  sums of d[t] * B**-t so every window is O(1) instead of O(n)
+  with np.errstate(over='ignore'):
+    powers = np.empty(len(d) + 1, dtype=np.uint64)
+    powers[0] = 1
+    powers[1:] = ROLLING_BASE
+    np.cumprod(powers, out=powers)
+    inverse_powers = np.empty(len(d), dtype=np.uint64)
+    inverse_powers[0] = 1
+    inverse_powers[1:] = ROLLING_BASE_INVERSE
+    np.cumprod(inverse_powers, out=inverse_powers)
+    prefix = np.zeros(len(d) + 1, dtype=np.uint64)
+    np.cumsum(d * inverse_powers, out=prefix[1:])
+    return (prefix[n:] - prefix[:m]) * powers[n - 1 : n - 1 + m]
+
+def ngram_ids(data, n):
+  """Like ngrams_set_generator, but returns a sorted array of distinct uint64
+  ngram ids instead of a set of bytestrings"""
+  return np.unique(ngram_id_array(data, n))
+
+def multi_ngram_ids(data, ns):
+  """Like ngram_ids for each of ns, in one pass over data. Packed ids of n + 1
+  are the ids of n shifted by a byte, so each packed n extends the previous
+  one instead of starting over. Returns a list of arrays in the order of ns."""
+  d = _byte_array(data).astype(np.uint64)
+  packed = set(n for n in ns if n <= MAX_PACKED_N)
+  ret = {}
+  ids = d
+  for k in xrange(1, max(packed) + 1 if len(packed) > 0 else 1):
+    m = len(d) - k + 1
+    if m <= 0:
+      break
+    if k > 1:
+      ids = (ids[:m] << np.uint64(8)) | d[k - 1 : k - 1 + m]
+    if k in packed:
+      ret[k] = np.unique(ids)
+  return [ret[n] if n in ret else ngram_ids(data, n) for n in ns]
+
+def sketched_ngram_ids(data, n, sketch, min_count):
+  """Like ngram_ids, but only the ids whose estimated count in a Count-Min
+  sketch, see sketch.py, is above min_count"""
+  ids = ngram_ids(data, n)
+  return ids[estimate(sketch, ids) > min_count]
+
+def _sorted_grams(hist):
+  """Returns (sorted ids, counts, grams) of a dict of ngram bytestrings to
+  counts, where grams is an (ids, n) uint8 array of the bytes of each id"""
+  grams = hist.keys()
+  n = len(grams[0]) if len(grams) > 0 else 1
+  assert all(len(gram) == n for gram in grams), 'ngrams must all be %d bytes' % n
+  joined = ''.join(grams)
+  # every ngram starts a multiple of n into them all joined
+  keys = ngram_id_array(joined, n)[::n]
+  counts = np.fromiter((hist[gram] for gram in grams), dtype=np.int64, count=len(grams))
+  order = np.argsort(keys, kind='mergesort')
+  matrix = np.frombuffer(joined, dtype=np.uint8).reshape(len(grams), n)
+  return (keys[order], counts[order], matrix[order])
+
+def hist_table(hist):
+  """Turns a dict of ngram bytestrings to counts into an ngram table, a tuple
+  of (sorted uint64 ids, int64 counts) arrays"""
+  (keys, counts, _) = _sorted_grams(hist)
+  return (keys, counts)
+
+def _bloom_positions(ids, log2_bits):
+  "The bit of every id for each Bloom filter hash, multiply shift style"
+  shift = np.uint64(64 - log2_bits)
+  with np.errstate(over='ignore'):
+    return [
+      ((ids * np.uint64(multiplier)) >> shift).astype(np.int64)
+      for multiplier in BLOOM_MULTIPLIERS
+    ]
+
+def with_prefilter(table):
+  """Returns an ngram table with a prefilter, a bit array that table_lookup
+  tests before searching the keys. Small ids get one exact bit each, others
+  get a Bloom filter of BLOOM_BITS_PER_KEY bits per key."""
+  (keys, counts) = table[:2]
+  if len(keys) == 0 or int(keys[-1]) < EXACT_BITMAP_BITS:
+    marks = np.zeros(int(keys[-1]) + 1 if len(keys) > 0 else 1, dtype=bool)
+    marks[keys.astype(np.int64)] = True
+    params = np.array([PREFILTER_EXACT, 0], dtype=np.int64)
+  else:
+    log2_bits = max(6, int(np.ceil(np.log2(BLOOM_BITS_PER_KEY * len(keys)))))
+    marks = np.zeros(1 << log2_bits, dtype=bool)
+    for pos in _bloom_positions(keys, log2_bits):
+      marks[pos] = True
+    params = np.array([PREFILTER_BLOOM, log2_bits], dtype=np.int64)
+  return (keys, counts, np.packbits(marks), params)
+
+def _prefilter_hits(bits, params, ids):
+  "Returns a mask of the ids that may be in the prefiltered table"
+  if params[0] == PREFILTER_EXACT:
+    hits = ids < np.uint64(8 * len(bits))
+    pos = np.where(hits, ids, 0).astype(np.int64)
+    return hits & ((bits[pos >> 3] >> (7 - (pos & 7))) & 1).astype(bool)
+  hits = np.ones(len(ids), dtype=bool)
+  for pos in _bloom_positions(ids, params[1]):
+    hits &= ((bits[pos >> 3] >> (7 - (pos & 7))) & 1).astype(bool)
+  return hits
+
+def table_lookup(table, ids):
+  """Returns the count for each of ids in an ngram table, or 0 if it's
+  missing. Tables from with_prefilter only search the keys for ids that pass
+  the prefilter."""
+  (keys, counts) = table[:2]
+  if len(keys) == 0:
+    return np.zeros(len(ids), dtype=np.int64)
+  if len(table) > 2:
+    hits = np.flatnonzero(_prefilter_hits(table[2], table[3], ids))
+    ret = np.zeros(len(ids), dtype=np.int64)
+    ret[hits] = table_lookup(table[:2], ids[hits])
+    return ret
+  pos = np.minimum(np.searchsorted(keys, ids), len(keys) - 1)
+  return np.where(keys[pos] == ids, counts[pos], 0)
+
+def ngram_counts(data, n, hist):
+  """Returns an int64 array with the count in hist of the ngram at every
+  offset, or 0 if it's missing. hist is either a dict keyed by ngram
+  bytestrings, or an ngram table keyed by the ids from ngram_id_array. A dict
+  is looked up like a table, but it has the bytes, so the hashed ngrams that
+  hit are compared to the bytes they hit and a colliding hash never counts."""
+  if not isinstance(hist, dict):
+    return table_lookup(hist, ngram_id_array(data, n))
+  if n > len(data) or len(hist) == 0:
+    return np.zeros(max(0, len(data) - n + 1), dtype=np.int64)
+  (keys, counts, grams) = _sorted_grams(hist)
+  ids = ngram_id_array(data, n)
+  pos = np.minimum(np.searchsorted(keys, ids), len(keys) - 1)
+  hits = keys[pos] == ids
+  if n > MAX_PACKED_N:
+    at = np.flatnonzero(hits)
+    windows = _byte_array(data)[at[:, np.newaxis] + np.arange(n)]
+    hits[at] = (windows == grams[pos[at]]).all(axis=1)
+  return np.where(hits, counts[pos], 0)
+
+def _hist_len(hist):
+  if isinstance(hist, dict):
+    return len(hist)
+  return len(hist[0])
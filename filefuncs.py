@@ -2,25 +2,319 @@
 # Trevor Pottinger
 # Sun May 17 10:08:28 PDT 2015
 
+from __future__ import print_function
+
+import cPickle
 import hashlib
+import mmap
 import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+from sketch import (newSketch, addIds)
 
 NUM_CORES = multiprocessing.cpu_count()
+# how many pending ids arrayFunc buffers before folding them into its counts
+MERGE_BATCH_SIZE = 1 << 24
+# ids below this can be counted in a flat table instead of being sorted, which
+#  is every packed ngram for n <= 3
+MAX_TABLE_SIZE = 1 << 24
+# below table size / this many ids, np.unique beats zeroing and scanning the
+#  table
+TABLE_MERGE_RATIO = 8
+# the scheduler hands workers at most this many files, or bytes, at a time
+TASK_MAX_FILES = 8
+TASK_MAX_BYTES = 1 << 26
+# cachingArrayFunc keeps up to this many bytes of files in memory, the rest
+#  are read again
+CACHE_MEMORY_SIZE = 1 << 28
+# by default files are read whole, aka a single window
+READ_OPTS_DEFAULT = {'chunk_size': None, 'overlap': 0, 'mmap': False}
+
+# scheduledMap only prints worker stats above 0, see setVerbosity
+_verbosity = 0
+
+def setVerbosity(verbosity):
+  global _verbosity
+  _verbosity = verbosity
+
+def _mappedWindows(f, chunk_size, overlap, hasher):
+  """Same as readWindows, but every window is an mmap or a buffer over one,
+  so workers share the page cache instead of holding private copies"""
+  size = os.fstat(f.fileno()).st_size
+  if size == 0:
+    # can't mmap an empty file
+    yield (0, '')
+    return
+  # don't close this explicitly, buffers and arrays over it keep it alive
+  mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+  for tup in bufferWindows(mapped, chunk_size, overlap, hasher):
+    yield tup
+
+def bufferWindows(data, chunk_size, overlap, hasher=None):
+  """Same as readWindows, but over data that's already in memory, every
+  window is a buffer over it instead of a copy"""
+  if chunk_size is None:
+    if hasher is not None:
+      hasher.update(data)
+    yield (0, data)
+    return
+  size = len(data)
+  offset = 0
+  while offset < size:
+    start = max(0, offset - overlap)
+    end = min(size, offset + chunk_size)
+    if hasher is not None:
+      hasher.update(buffer(data, offset, end - offset))
+    yield (start, buffer(data, start, end - start))
+    offset = end
+
+def readWindows(filename, read_opts=READ_OPTS_DEFAULT, hasher=None):
+  """Yields (offset, window) tuples that cover the file. With a chunk_size,
+  each window is at most chunk_size + overlap bytes and starts with the last
+  overlap bytes of the previous one, so nothing up to overlap + 1 bytes long
+  gets split. If a hasher is given, it sees every byte exactly once."""
+  chunk_size = read_opts['chunk_size']
+  overlap = read_opts['overlap']
+  if chunk_size is not None:
+    assert overlap < chunk_size, 'overlap %d must be smaller than chunk size %d' % (overlap, chunk_size)
+  with open(filename, 'rb') as f:
+    if read_opts.get('mmap', False):
+      for tup in _mappedWindows(f, chunk_size, overlap, hasher):
+        yield tup
+      return
+    if chunk_size is None:
+      blob = f.read()
+      if hasher is not None:
+        hasher.update(blob)
+      yield (0, blob)
+      return
+    offset = 0
+    tail = ''
+    while True:
+      chunk = f.read(chunk_size)
+      if len(chunk) == 0 and offset > 0:
+        break
+      if hasher is not None:
+        hasher.update(chunk)
+      window = tail + chunk
+      # don't hold on to two windows at once
+      tail = None
+      yield (offset - (len(window) - len(chunk)), window)
+      if len(chunk) == 0:
+        break
+      tail = window[-overlap:] if overlap > 0 else ''
+      offset += len(chunk)
+
+def tableSize(n):
+  """The size of a flat table of every packed id of an n byte ngram, or None
+  if it's bigger than MAX_TABLE_SIZE, see mergeCounts"""
+  if (1 << (8 * n)) <= MAX_TABLE_SIZE:
+    return 1 << (8 * n)
+  return None
+
+def mergeCounts(partials, table_size=None):
+  """Takes a list of (sorted distinct ids, counts) tuples and returns a single
+  (sorted distinct ids, summed counts) tuple. If every id is below table_size
+  and there are enough of them, the counts are summed in a flat table,
+  otherwise the ids are concatenated and reduced with np.unique."""
+  if len(partials) == 0:
+    return (np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.int64))
+  num_ids = sum(len(partial[0]) for partial in partials)
+  if table_size is not None and num_ids * TABLE_MERGE_RATIO >= table_size:
+    # document frequencies are bounded by the number of files
+    table = np.zeros(table_size, dtype=np.int32)
+    for (keys, counts) in partials:
+      # keys are distinct within a partial, so there are no lost updates
+      table[keys.astype(np.int64)] += counts
+    keys = np.flatnonzero(table)
+    return (keys.astype(np.uint64), table[keys].astype(np.int64))
+  keys = np.concatenate([partial[0] for partial in partials])
+  counts = np.concatenate([partial[1] for partial in partials])
+  (keys, inverse) = np.unique(keys, return_inverse=True)
+  counts = np.bincount(inverse, weights=counts, minlength=len(keys))
+  return (keys, counts.astype(np.int64))
+
+class Published(object):
+  """A handle to a large read only object that was written to disk once by
+  publish or publishArrays. Passing the handle in a worker's args only pickles
+  a path, and each worker process loads the object the first time it sees
+  the handle."""
+  def __init__(self, path, num_arrays=None):
+    self.path = path
+    self.num_arrays = num_arrays
+
+# Map<path, object>, the objects this process already loaded
+_published = {}
+
+def publish(obj):
+  "Returns a Published handle for obj, call unpublish when done with it"
+  (fd, path) = tempfile.mkstemp(prefix='mmlcs-', suffix='.pickle')
+  with os.fdopen(fd, 'wb') as f:
+    cPickle.dump(obj, f, cPickle.HIGHEST_PROTOCOL)
+  # the publishing process doesn't need to read it back
+  _published[path] = obj
+  return Published(path)
+
+def publishArrays(arrays):
+  """Like publish, but for a tuple of numpy arrays. Workers memory map them
+  read only, so every process shares a single copy in the page cache."""
+  path = tempfile.mkdtemp(prefix='mmlcs-')
+  for i in range(len(arrays)):
+    np.save(os.path.join(path, '%d.npy' % i), arrays[i])
+  _published[path] = tuple(arrays)
+  return Published(path, len(arrays))
+
+def unpublish(handle):
+  _published.pop(handle.path, None)
+  if handle.num_arrays is None:
+    os.remove(handle.path)
+  else:
+    shutil.rmtree(handle.path)
+
+def _load(handle):
+  if handle.num_arrays is None:
+    with open(handle.path, 'rb') as f:
+      return cPickle.load(f)
+  return tuple(
+    np.load(os.path.join(handle.path, '%d.npy' % i), mmap_mode='r')
+    for i in range(handle.num_arrays)
+  )
+
+def resolve(args):
+  """Returns args with every Published handle replaced by its object, along
+  with the handles in any list of args"""
+  resolved = []
+  for arg in args:
+    if isinstance(arg, list):
+      arg = resolve(arg)
+    elif isinstance(arg, Published):
+      if arg.path not in _published:
+        # anything that was unpublished since is garbage now
+        for path in _published.keys():
+          if not os.path.exists(path):
+            del _published[path]
+        _published[arg.path] = _load(arg)
+      arg = _published[arg.path]
+    resolved.append(arg)
+  return resolved
+
+def _batches(filenames):
+  """Returns lists of filenames, largest files first. Each list is at most
+  TASK_MAX_FILES files or TASK_MAX_BYTES bytes, unless it's one big file."""
+  sized = [(os.path.getsize(filename), filename) for filename in filenames]
+  sized.sort(reverse=True)
+  batches = []
+  batch = []
+  batch_bytes = 0
+  for (size, filename) in sized:
+    if len(batch) > 0 and \
+        (len(batch) >= TASK_MAX_FILES or batch_bytes + size > TASK_MAX_BYTES):
+      batches.append(batch)
+      batch = []
+      batch_bytes = 0
+    batch.append(filename)
+    batch_bytes += size
+  if len(batch) > 0:
+    batches.append(batch)
+  return batches
+
+def _timedCall(tupleargs):
+  "Runs func(args) and returns (pid, seconds elapsed, bytes read, result)"
+  func = tupleargs[0]
+  args = tupleargs[1]
+  start = time.time()
+  num_bytes = sum(os.path.getsize(filename) for filename in args[0])
+  result = func(args)
+  return (os.getpid(), time.time() - start, num_bytes, result)
+
+def scheduledMap(func, filenames, rest, pool=None):
+  """Runs func((batch,) + rest) for every batch from _batches on a pool and
+  yields the results in the order of the batches, so merges don't depend on
+  which worker finished first. Since the biggest files go first and tasks are
+  small, workers stay busy until the very end. With a verbosity, prints how
+  busy each worker was once everything is done. If no pool is given, a
+  temporary one is created."""
+  tasks = [(func, (batch,) + tuple(rest)) for batch in _batches(filenames)]
+  start = time.time()
+  # Map<pid, [tasks, seconds busy, bytes read]>
+  stats = {}
+  own_pool = pool is None
+  if own_pool:
+    pool = multiprocessing.Pool(NUM_CORES)
+  # workers still take the next task as soon as they're done, imap only holds
+  #  results back until the ones before them are in
+  for (pid, elapsed, num_bytes, result) in pool.imap(_timedCall, tasks, 1):
+    if pid not in stats:
+      stats[pid] = [0, 0.0, 0]
+    stats[pid][0] += 1
+    stats[pid][1] += elapsed
+    stats[pid][2] += num_bytes
+    yield result
+  if own_pool:
+    pool.close()
+    pool.join()
+  wall = time.time() - start
+  if _verbosity == 0:
+    return
+  for pid in sorted(stats):
+    print("[+] Worker %d: %d tasks, %d bytes, busy %1.3f of %1.3f seconds (%1.1f%%)" % (
+      pid,
+      stats[pid][0],
+      stats[pid][2],
+      stats[pid][1],
+      wall,
+      100.0 * stats[pid][1] / wall if wall > 0 else 100.0
+    ))
 
 def simpleFunc(tupleargs):
+  """func returns a dict whose keys are what's counted, or a list of (key,
+  index) tuples. Lists get the same owned range handling as hashedFunc, so
+  a key cut off by the end of a window isn't counted along with the whole
+  key from the next one."""
   filenames = tupleargs[0]
   func = tupleargs[1]
-  args = tupleargs[2]
+  args = resolve(tupleargs[2])
+  read_opts = tupleargs[3] if len(tupleargs) > 3 else READ_OPTS_DEFAULT
   # RFC are these actually useful?
   raw_lens = []
   extracted_lens = []
   common_extracted = {}
   for filename in filenames:
     # TODO process batch at a time
-    blob = open(filename).read()
-    # this is returning a dict of <key, count>, should we be using counts?
-    hist = func(blob, *args)
-    raw_lens.append(len(blob))
+    raw_len = 0
+    hist = None
+    file_size = os.path.getsize(filename)
+    # where the previous window's last key ended
+    resume = 0
+    for (offset, window) in readWindows(filename, read_opts):
+      raw_len = offset + len(window)
+      if offset + len(window) >= file_size:
+        owned_end = file_size
+      else:
+        owned_end = offset + len(window) - read_opts['overlap']
+      (window, offset) = _resumed(window, offset, resume)
+      # this is returning a dict of <key, count>, should we be using counts?
+      window_hist = func(window, *args)
+      if isinstance(window_hist, list):
+        owned = {}
+        for (key, index) in window_hist:
+          index += offset
+          if index >= owned_end:
+            break
+          resume = index + len(key) + 1
+          owned[key] = owned.get(key, 0) + 1
+        window_hist = owned
+      if hist is None:
+        hist = window_hist
+      else:
+        # only the keys matter, so union them
+        hist.update(window_hist)
+    raw_lens.append(raw_len)
     extracted_lens.append(len(hist))
     # this is essentially a second pass over the file...
     for k in hist:
@@ -31,92 +325,536 @@ def simpleFunc(tupleargs):
     # should we have a debug statement per processed file?
   return (raw_lens, extracted_lens, common_extracted)
 
-def multiFunc(tupleargs):
+def multiFunc(tupleargs, pool=None):
   filenames = tupleargs[0]
   func = tupleargs[1]
   args = tupleargs[2]
-  filename_partitions = []
-  # TODO I don't think this partitioning is correct, we should assert
-  #  len(filenames) == sum(len(results_processed))
-  partition_size = len(filenames) / NUM_CORES
-  for i in range(NUM_CORES+1):
-    filename_partitions.append([
-      filenames[i*partition_size:(i+1)*partition_size],
-      func,
-      args
-    ])
-  pool = multiprocessing.Pool(NUM_CORES)
-  result_partitions = pool.map(simpleFunc, filename_partitions)
-  # not sure why these next two lines are necessary
-  pool.close()
-  pool.join()
-  # now to join all the results
+  read_opts = tupleargs[3] if len(tupleargs) > 3 else READ_OPTS_DEFAULT
   raw_lens = []
   extracted_lens = []
   common_extracted = {}
-  for i in range(NUM_CORES):
-    raw_lens.extend(result_partitions[i][0])
-    extracted_lens.extend(result_partitions[i][1])
-    partial_common_extracted = result_partitions[i][2]
+  # results are merged as they arrive, so the order of raw_lens and
+  #  extracted_lens doesn't match filenames
+  for result in scheduledMap(simpleFunc, filenames, [func, args, read_opts], pool):
+    raw_lens.extend(result[0])
+    extracted_lens.extend(result[1])
+    partial_common_extracted = result[2]
     # this is essentially doing another pass over a really big string
     for k in partial_common_extracted:
       if k in common_extracted:
         common_extracted[k] += partial_common_extracted[k]
       else:
         common_extracted[k] = partial_common_extracted[k]
-  # does this preserve order of the results?..
+  assert len(raw_lens) == len(filenames), 'Read %d of %d files' % (len(raw_lens), len(filenames))
   return (raw_lens, extracted_lens, common_extracted)
 
+def _resumed(window, offset, resume):
+  """The part of a window from resume on, and where it starts. A greedy
+  extractor run from there finds what it would have over the whole file,
+  instead of restarting mid substring at the start of the window."""
+  if resume <= offset:
+    return (window, offset)
+  # a buffer, so mmap windows aren't copied
+  return (buffer(window, min(resume - offset, len(window))), resume)
+
+def _ownedSubstrs(result_inds, offset, owned_end, resume, seen, hash_func,
+    substr_content, file_indexes):
+  """Adds the substrings of one window that it owns to file_indexes and
+  substr_content, skipping ones already seen in the file. Returns where the
+  last one ended, the resume of the next window."""
+  for tup in result_inds:
+    index = offset + tup[1]
+    if index < resume or index >= owned_end:
+      continue
+    resume = index + len(tup[0]) + 1
+    # TODO can we avoid using hex digest, and just use raw?
+    sub_hash = hashlib.new(hash_func, tup[0]).hexdigest()
+    if sub_hash in seen:
+      continue
+    seen.add(sub_hash)
+    if sub_hash not in substr_content:
+      substr_content[sub_hash] = tup[0]
+    file_indexes.append( (sub_hash, index) )
+  return resume
+
 def hashedFunc(tupleargs):
+  """The optional fifth arg are read opts for readWindows. When reading in
+  chunks, each window only keeps substrings that start before the trailing
+  overlap, since the next window sees those with more context."""
   filenames = tupleargs[0]
   func = tupleargs[1]
   hash_func = tupleargs[2]
-  args = tupleargs[3]
+  args = resolve(tupleargs[3])
+  read_opts = tupleargs[4] if len(tupleargs) > 4 else READ_OPTS_DEFAULT
   # Map<hash, content>
   substr_content = {}
   # List<Tuple<file hash, substr hash, index>>
   substr_indexes = []
   for filename in filenames:
     # TODO process batch at a time
-    blob = open(filename).read()
-    # TODO can we avoid using hex digest, and just use raw?
-    file_hash = hashlib.new(hash_func, blob).hexdigest()
-    result_inds = func(blob, *args)
-    #subs_inds = substrings_list(blob, N, dict(sorted_common_ngrams[:top_k_index]))
-    for tup in result_inds:
-      sub_hash = hashlib.new(hash_func, tup[0]).hexdigest()
-      if sub_hash not in substr_content:
-        substr_content[sub_hash] = tup[0]
-      substr_indexes.append( (file_hash, sub_hash, tup[1]) )
+    file_size = os.path.getsize(filename)
+    hasher = hashlib.new(hash_func)
+    # the file hash isn't known until the last window was read
+    file_indexes = []
+    seen = set()
+    # where the previous window's last substring ended
+    resume = 0
+    for (offset, window) in readWindows(filename, read_opts, hasher):
+      if offset + len(window) >= file_size:
+        owned_end = file_size
+      else:
+        owned_end = offset + len(window) - read_opts['overlap']
+      (window, offset) = _resumed(window, offset, resume)
+      result_inds = func(window, *args)
+      resume = _ownedSubstrs(result_inds, offset, owned_end, resume, seen,
+        hash_func, substr_content, file_indexes)
+      result_inds = None
+    file_hash = hasher.hexdigest()
+    for (sub_hash, index) in file_indexes:
+      substr_indexes.append( (file_hash, sub_hash, index) )
     # TODO len substr, entropy substr, .. aka metadata
   return (substr_content, substr_indexes)
 
-def hashedMultiFunc(tupleargs):
+def hashedMultiFunc(tupleargs, pool=None):
   filenames = tupleargs[0]
   func = tupleargs[1]
   hash_func = tupleargs[2]
   args = tupleargs[3]
-  filename_partitions = []
-  partition_size = len(filenames) / NUM_CORES
-  for i in range(NUM_CORES+1):
-    filename_partitions.append([
-      filenames[i*partition_size:(i+1)*partition_size],
-      func,
-      hash_func,
-      args
-    ])
-  pool = multiprocessing.Pool(NUM_CORES)
-  result_partitions = pool.map(hashedFunc, filename_partitions)
-  # not sure why these next two lines are necessary
-  pool.close()
-  pool.join()
+  read_opts = tupleargs[4] if len(tupleargs) > 4 else READ_OPTS_DEFAULT
   substr_content = {}
   substr_indexes = []
-  for i in range(NUM_CORES+1):
-    partial_substr_content = result_partitions[i][0]
-    partial_substr_indexes = result_partitions[i][1]
+  for result in scheduledMap(hashedFunc, filenames, [func, hash_func, args, read_opts], pool):
+    partial_substr_content = result[0]
+    partial_substr_indexes = result[1]
     for hash_key in partial_substr_content:
       if hash_key not in substr_content:
         substr_content[hash_key] = partial_substr_content[hash_key]
     substr_indexes.extend(partial_substr_indexes)
   return (substr_content, substr_indexes)
+
+def hashedListsFunc(tupleargs):
+  """Like hashedFunc, but func returns a list of results per window, one per
+  extraction, like one per n. Each extraction keeps its own substrings as if
+  hashedFunc had read every file just for it, but files are only read once.
+  func takes a starts keyword, the index each extraction resumes at.
+  Returns (substr_content, list of substr_indexes, one per extraction)."""
+  filenames = tupleargs[0]
+  func = tupleargs[1]
+  hash_func = tupleargs[2]
+  args = resolve(tupleargs[3])
+  read_opts = tupleargs[4] if len(tupleargs) > 4 else READ_OPTS_DEFAULT
+  substr_content = {}
+  substr_indexes = None
+  for filename in filenames:
+    file_size = os.path.getsize(filename)
+    hasher = hashlib.new(hash_func)
+    file_indexes = None
+    for (offset, window) in readWindows(filename, read_opts, hasher):
+      if offset + len(window) >= file_size:
+        owned_end = file_size
+      else:
+        owned_end = offset + len(window) - read_opts['overlap']
+      if file_indexes is None:
+        results = func(window, *args)
+      else:
+        # each extraction resumes where its own last substring ended
+        results = func(window, *args, starts=[max(0, resume - offset) for resume in resumes])
+      if file_indexes is None:
+        file_indexes = [[] for _ in results]
+        seens = [set() for _ in results]
+        resumes = [0] * len(results)
+      for (k, result_inds) in enumerate(results):
+        resumes[k] = _ownedSubstrs(result_inds, offset, owned_end, resumes[k],
+          seens[k], hash_func, substr_content, file_indexes[k])
+      results = None
+    file_hash = hasher.hexdigest()
+    if substr_indexes is None:
+      substr_indexes = [[] for _ in file_indexes]
+    for (k, indexes) in enumerate(file_indexes):
+      for (sub_hash, index) in indexes:
+        substr_indexes[k].append( (file_hash, sub_hash, index) )
+  return (substr_content, substr_indexes if substr_indexes is not None else [])
+
+def hashedListsMultiFunc(tupleargs, pool=None):
+  filenames = tupleargs[0]
+  func = tupleargs[1]
+  hash_func = tupleargs[2]
+  args = tupleargs[3]
+  read_opts = tupleargs[4] if len(tupleargs) > 4 else READ_OPTS_DEFAULT
+  substr_content = {}
+  substr_indexes = []
+  for result in scheduledMap(hashedListsFunc, filenames, [func, hash_func, args, read_opts], pool):
+    for hash_key in result[0]:
+      if hash_key not in substr_content:
+        substr_content[hash_key] = result[0][hash_key]
+    for (k, partial_substr_indexes) in enumerate(result[1]):
+      if k == len(substr_indexes):
+        substr_indexes.append([])
+      substr_indexes[k].extend(partial_substr_indexes)
+  return (substr_content, substr_indexes)
+
+def _distinctIds(window_ids):
+  if len(window_ids) == 1:
+    return window_ids[0]
+  return np.unique(np.concatenate(window_ids))
+
+def _fileIds(filename, func, args, read_opts, hasher=None, parts=None):
+  """Returns (raw_len, ids), the sorted distinct ids func returns for any
+  window of filename. If func returns a list of id arrays, one per
+  extraction, so is ids. If a hasher is given, it sees every byte, and if a
+  list of parts is, every byte gets appended to it."""
+  raw_len = 0
+  window_ids = []
+  for (offset, window) in readWindows(filename, read_opts, hasher):
+    if parts is not None:
+      # windows overlap, only the bytes past the previous one are new
+      parts.append(str(buffer(window, max(0, raw_len - offset))))
+    window_ids.append(func(window, *args))
+    raw_len = offset + len(window)
+  if isinstance(window_ids[0], list):
+    return (raw_len, [
+      _distinctIds([ids[k] for ids in window_ids])
+      for k in xrange(len(window_ids[0]))
+    ])
+  return (raw_len, _distinctIds(window_ids))
+
+def arrayFunc(tupleargs):
+  """Like simpleFunc, but func returns a sorted array of distinct uint64 ids
+  and the document frequencies come back as a (ids, counts) tuple of arrays.
+  The optional fourth arg is a table size to pass to mergeCounts, and the
+  optional fifth are read opts for readWindows."""
+  filenames = tupleargs[0]
+  func = tupleargs[1]
+  args = resolve(tupleargs[2])
+  table_size = tupleargs[3] if len(tupleargs) > 3 else None
+  read_opts = tupleargs[4] if len(tupleargs) > 4 else READ_OPTS_DEFAULT
+  raw_lens = []
+  extracted_lens = []
+  common_extracted = mergeCounts([])
+  pending = []
+  pending_len = 0
+  for filename in filenames:
+    (raw_len, ids) = _fileIds(filename, func, args, read_opts)
+    raw_lens.append(raw_len)
+    extracted_lens.append(len(ids))
+    pending.append( (ids, np.ones(len(ids), dtype=np.int64)) )
+    pending_len += len(ids)
+    if pending_len > MERGE_BATCH_SIZE:
+      common_extracted = mergeCounts([common_extracted] + pending, table_size)
+      pending = []
+      pending_len = 0
+  common_extracted = mergeCounts([common_extracted] + pending, table_size)
+  return (raw_lens, extracted_lens, common_extracted)
+
+def arrayMultiFunc(tupleargs, pool=None):
+  filenames = tupleargs[0]
+  func = tupleargs[1]
+  args = tupleargs[2]
+  table_size = tupleargs[3] if len(tupleargs) > 3 else None
+  read_opts = tupleargs[4] if len(tupleargs) > 4 else READ_OPTS_DEFAULT
+  raw_lens = []
+  extracted_lens = []
+  common_extracted = mergeCounts([])
+  pending = []
+  pending_len = 0
+  for result in scheduledMap(arrayFunc, filenames, [func, args, table_size, read_opts], pool):
+    raw_lens.extend(result[0])
+    extracted_lens.extend(result[1])
+    pending.append(result[2])
+    pending_len += len(result[2][0])
+    if pending_len > MERGE_BATCH_SIZE:
+      common_extracted = mergeCounts([common_extracted] + pending, table_size)
+      pending = []
+      pending_len = 0
+  # the partials are already sorted and distinct, so this is one big merge
+  common_extracted = mergeCounts([common_extracted] + pending, table_size)
+  assert len(raw_lens) == len(filenames), 'Read %d of %d files' % (len(raw_lens), len(filenames))
+  return (raw_lens, extracted_lens, common_extracted)
+
+def arraysFunc(tupleargs):
+  """Like arrayFunc, but func returns a list of sorted id arrays per window,
+  one per extraction, like one per n, and so does the fourth arg of table
+  sizes. Returns (raw_lens, extracted_lens, list of (ids, counts) tuples),
+  where extracted_lens are summed over the extractions."""
+  filenames = tupleargs[0]
+  func = tupleargs[1]
+  args = resolve(tupleargs[2])
+  table_sizes = tupleargs[3]
+  read_opts = tupleargs[4] if len(tupleargs) > 4 else READ_OPTS_DEFAULT
+  raw_lens = []
+  extracted_lens = []
+  common_extracted = [mergeCounts([]) for _ in table_sizes]
+  pending = [[] for _ in table_sizes]
+  pending_len = 0
+  for filename in filenames:
+    (raw_len, extraction_ids) = _fileIds(filename, func, args, read_opts)
+    raw_lens.append(raw_len)
+    extracted_len = 0
+    for (k, ids) in enumerate(extraction_ids):
+      extracted_len += len(ids)
+      pending[k].append( (ids, np.ones(len(ids), dtype=np.int64)) )
+    extraction_ids = None
+    extracted_lens.append(extracted_len)
+    pending_len += extracted_len
+    if pending_len > MERGE_BATCH_SIZE:
+      for k in xrange(len(table_sizes)):
+        common_extracted[k] = mergeCounts([common_extracted[k]] + pending[k], table_sizes[k])
+      pending = [[] for _ in table_sizes]
+      pending_len = 0
+  for k in xrange(len(table_sizes)):
+    common_extracted[k] = mergeCounts([common_extracted[k]] + pending[k], table_sizes[k])
+  return (raw_lens, extracted_lens, common_extracted)
+
+def arraysMultiFunc(tupleargs, pool=None):
+  filenames = tupleargs[0]
+  func = tupleargs[1]
+  args = tupleargs[2]
+  table_sizes = tupleargs[3]
+  read_opts = tupleargs[4] if len(tupleargs) > 4 else READ_OPTS_DEFAULT
+  raw_lens = []
+  extracted_lens = []
+  common_extracted = [mergeCounts([]) for _ in table_sizes]
+  pending = [[] for _ in table_sizes]
+  pending_len = 0
+  for result in scheduledMap(arraysFunc, filenames, [func, args, table_sizes, read_opts], pool):
+    raw_lens.extend(result[0])
+    extracted_lens.extend(result[1])
+    for k in xrange(len(table_sizes)):
+      pending[k].append(result[2][k])
+      pending_len += len(result[2][k][0])
+    if pending_len > MERGE_BATCH_SIZE:
+      for k in xrange(len(table_sizes)):
+        common_extracted[k] = mergeCounts([common_extracted[k]] + pending[k], table_sizes[k])
+      pending = [[] for _ in table_sizes]
+      pending_len = 0
+  for k in xrange(len(table_sizes)):
+    common_extracted[k] = mergeCounts([common_extracted[k]] + pending[k], table_sizes[k])
+  assert len(raw_lens) == len(filenames), 'Read %d of %d files' % (len(raw_lens), len(filenames))
+  return (raw_lens, extracted_lens, common_extracted)
+
+def hashedArrayFunc(tupleargs):
+  """Like arrayFunc, but keeps the ids of each file apart instead of counting
+  them. Returns a list of (filename, file hash, sorted distinct ids). The
+  optional fifth arg are read opts for readWindows."""
+  filenames = tupleargs[0]
+  func = tupleargs[1]
+  hash_func = tupleargs[2]
+  args = resolve(tupleargs[3])
+  read_opts = tupleargs[4] if len(tupleargs) > 4 else READ_OPTS_DEFAULT
+  ret = []
+  for filename in filenames:
+    hasher = hashlib.new(hash_func)
+    (_, ids) = _fileIds(filename, func, args, read_opts, hasher)
+    ret.append( (filename, hasher.hexdigest(), ids) )
+  return ret
+
+def hashedArrayMultiFunc(tupleargs, pool=None):
+  filenames = tupleargs[0]
+  func = tupleargs[1]
+  hash_func = tupleargs[2]
+  args = tupleargs[3]
+  read_opts = tupleargs[4] if len(tupleargs) > 4 else READ_OPTS_DEFAULT
+  ret = []
+  for result in scheduledMap(hashedArrayFunc, filenames, [func, hash_func, args, read_opts], pool):
+    ret.extend(result)
+  assert len(ret) == len(filenames), 'Read %d of %d files' % (len(ret), len(filenames))
+  return ret
+
+def cachingArrayFunc(tupleargs):
+  """Like arrayFunc, but the hash of every file, and the bytes of as many
+  files as fit in cache memory size, are kept in a cache, so a later pass
+  doesn't hash them again, or read the cached ones at all. Packed ids take 4
+  to 8 bytes per byte, while func rebuilds them from the bytes for free.
+  Takes (filenames, func, hash_func, args, table_size, read opts, cache
+  memory size) and returns (raw_lens, extracted_lens, common_extracted,
+  cache entries), where each entry is a (file hash, filename, bytes or None)
+  tuple."""
+  filenames = tupleargs[0]
+  func = tupleargs[1]
+  hash_func = tupleargs[2]
+  args = resolve(tupleargs[3])
+  table_size = tupleargs[4]
+  read_opts = tupleargs[5]
+  cache_memory_size = tupleargs[6]
+  raw_lens = []
+  extracted_lens = []
+  common_extracted = mergeCounts([])
+  cache_entries = []
+  cached_size = 0
+  pending = []
+  pending_len = 0
+  for filename in filenames:
+    hasher = hashlib.new(hash_func)
+    parts = None
+    if cached_size + os.path.getsize(filename) <= cache_memory_size:
+      parts = []
+    (raw_len, ids) = _fileIds(filename, func, args, read_opts, hasher, parts)
+    if parts is not None:
+      cache_entries.append( (hasher.hexdigest(), filename, ''.join(parts)) )
+      cached_size += raw_len
+      parts = None
+    else:
+      cache_entries.append( (hasher.hexdigest(), filename, None) )
+    raw_lens.append(raw_len)
+    extracted_lens.append(len(ids))
+    pending.append( (ids, np.ones(len(ids), dtype=np.int64)) )
+    pending_len += len(ids)
+    if pending_len > MERGE_BATCH_SIZE:
+      common_extracted = mergeCounts([common_extracted] + pending, table_size)
+      pending = []
+      pending_len = 0
+  common_extracted = mergeCounts([common_extracted] + pending, table_size)
+  return (raw_lens, extracted_lens, common_extracted, cache_entries)
+
+def cachingArrayMultiFunc(tupleargs, pool=None):
+  """Workers don't share memory, and pickling bytes to the parent and back
+  costs more than reading the files again, so only the hashes are cached"""
+  filenames = tupleargs[0]
+  table_size = tupleargs[4]
+  raw_lens = []
+  extracted_lens = []
+  common_extracted = mergeCounts([])
+  cache_entries = []
+  pending = []
+  pending_len = 0
+  for result in scheduledMap(cachingArrayFunc, filenames, list(tupleargs[1:6]) + [0], pool):
+    raw_lens.extend(result[0])
+    extracted_lens.extend(result[1])
+    cache_entries.extend(result[3])
+    pending.append(result[2])
+    pending_len += len(result[2][0])
+    if pending_len > MERGE_BATCH_SIZE:
+      common_extracted = mergeCounts([common_extracted] + pending, table_size)
+      pending = []
+      pending_len = 0
+  common_extracted = mergeCounts([common_extracted] + pending, table_size)
+  assert len(raw_lens) == len(filenames), 'Read %d of %d files' % (len(raw_lens), len(filenames))
+  return (raw_lens, extracted_lens, common_extracted, cache_entries)
+
+def cachedHashedFunc(tupleargs):
+  """Like hashedFunc, but over the cache entries of cachingArrayFunc instead
+  of the original files. Cached bytes aren't read again, and no file is
+  hashed again."""
+  cache_entries = tupleargs[0]
+  func = tupleargs[1]
+  hash_func = tupleargs[2]
+  args = resolve(tupleargs[3])
+  read_opts = tupleargs[4] if len(tupleargs) > 4 else READ_OPTS_DEFAULT
+  substr_content = {}
+  substr_indexes = []
+  for (file_hash, filename, data) in cache_entries:
+    if data is not None:
+      file_size = len(data)
+      windows = bufferWindows(data, read_opts['chunk_size'], read_opts['overlap'])
+    else:
+      file_size = os.path.getsize(filename)
+      windows = readWindows(filename, read_opts)
+    file_indexes = []
+    seen = set()
+    resume = 0
+    for (offset, window) in windows:
+      if offset + len(window) >= file_size:
+        owned_end = file_size
+      else:
+        owned_end = offset + len(window) - read_opts['overlap']
+      (window, offset) = _resumed(window, offset, resume)
+      result_inds = func(window, *args)
+      resume = _ownedSubstrs(result_inds, offset, owned_end, resume, seen,
+        hash_func, substr_content, file_indexes)
+      result_inds = None
+    for (sub_hash, index) in file_indexes:
+      substr_indexes.append( (file_hash, sub_hash, index) )
+  return (substr_content, substr_indexes)
+
+def _cachedHashedTask(tupleargs):
+  "cachedHashedFunc over (filenames, Map<filename, file hash>, ...)"
+  hashes = resolve([tupleargs[1]])[0]
+  cache_entries = [(hashes[filename], filename, None) for filename in tupleargs[0]]
+  return cachedHashedFunc((cache_entries,) + tuple(tupleargs[2:]))
+
+def cachedHashedMultiFunc(tupleargs, pool=None):
+  "The entries of cachingArrayMultiFunc never hold bytes, only hashes"
+  cache_entries = tupleargs[0]
+  # workers load the hashes once, instead of unpickling them per task
+  hashes_ref = publish(dict(
+    (filename, file_hash) for (file_hash, filename, _) in cache_entries
+  ))
+  filenames = [filename for (_, filename, _) in cache_entries]
+  substr_content = {}
+  substr_indexes = []
+  for result in scheduledMap(_cachedHashedTask, filenames, [hashes_ref] + list(tupleargs[1:]), pool):
+    for hash_key in result[0]:
+      if hash_key not in substr_content:
+        substr_content[hash_key] = result[0][hash_key]
+    substr_indexes.extend(result[1])
+  unpublish(hashes_ref)
+  return (substr_content, substr_indexes)
+
+def _workerSketch(sketch_dir, shape):
+  """The sketch of this worker in sketch_dir, memory mapped so it's added to
+  across tasks and only merged once"""
+  filename = os.path.join(sketch_dir, '%d.sketch' % os.getpid())
+  mode = 'r+' if os.path.exists(filename) else 'w+'
+  return np.memmap(filename, dtype=np.int32, mode=mode, shape=shape)
+
+def sketchFunc(tupleargs):
+  """Like arrayFunc, but the document frequencies of the ids go into a
+  Count-Min sketch with the given (depth, width) shape, so memory stays the
+  same however many distinct ids there are. The optional fifth arg are read
+  opts for readWindows. With a sixth arg, a sketch dir, the ids are added to
+  this worker's sketch in it, see sketchMultiFunc, and no sketch is
+  returned."""
+  filenames = tupleargs[0]
+  func = tupleargs[1]
+  args = resolve(tupleargs[2])
+  shape = tupleargs[3]
+  read_opts = tupleargs[4] if len(tupleargs) > 4 else READ_OPTS_DEFAULT
+  sketch_dir = tupleargs[5] if len(tupleargs) > 5 else None
+  raw_lens = []
+  extracted_lens = []
+  if sketch_dir is None:
+    counts = newSketch(*shape)
+  else:
+    counts = _workerSketch(sketch_dir, shape)
+  pending = []
+  pending_len = 0
+  for filename in filenames:
+    (raw_len, ids) = _fileIds(filename, func, args, read_opts)
+    raw_lens.append(raw_len)
+    extracted_lens.append(len(ids))
+    pending.append(ids)
+    pending_len += len(ids)
+    if pending_len > MERGE_BATCH_SIZE:
+      addIds(counts, np.concatenate(pending))
+      pending = []
+      pending_len = 0
+  if pending_len > 0:
+    addIds(counts, np.concatenate(pending))
+  if sketch_dir is not None:
+    counts.flush()
+    counts = None
+  return (raw_lens, extracted_lens, counts)
+
+def sketchMultiFunc(tupleargs, pool=None):
+  """Every worker adds to its own sketch in a temp dir instead of returning
+  one per task, and those are merged once they're all done"""
+  filenames = tupleargs[0]
+  func = tupleargs[1]
+  args = tupleargs[2]
+  shape = tupleargs[3]
+  read_opts = tupleargs[4] if len(tupleargs) > 4 else READ_OPTS_DEFAULT
+  raw_lens = []
+  extracted_lens = []
+  sketch_dir = tempfile.mkdtemp(prefix='mmlcs-sketch-')
+  try:
+    for result in scheduledMap(sketchFunc, filenames, [func, args, shape, read_opts, sketch_dir], pool):
+      raw_lens.extend(result[0])
+      extracted_lens.extend(result[1])
+    counts = newSketch(*shape)
+    for filename in os.listdir(sketch_dir):
+      # sketches merge by adding them
+      counts += np.memmap(os.path.join(sketch_dir, filename), dtype=np.int32, mode='r', shape=shape)
+  finally:
+    shutil.rmtree(sketch_dir)
+  assert len(raw_lens) == len(filenames), 'Read %d of %d files' % (len(raw_lens), len(filenames))
+  return (raw_lens, extracted_lens, counts)
@@ -0,0 +1,247 @@
+# itemsets.py
+# Sat Oct 17 18:14:55 PDT 2026
+#
+# FP-growth over file -> substr transactions, aka the file_to_substr relation
+# from cooccurrences.readFile. Every transaction is inserted into a prefix
+# tree in order of decreasing item support, so files that share their most
+# common substrs share a path. Itemsets are then mined per item from the
+# paths that end in it, without ever generating candidate sets.
+#
+# Substrs of a malware family tend to all occur together, and every subset
+# of m such substrs is frequent, so listing frequent itemsets is 2^m. Only
+# the maximal ones are mined then, FPMax style: a conditional tree that's a
+# single path is one itemset, and branches whose every itemset is a subset of
+# one already found are skipped.
+
+import numpy as np
+
+MIN_ITEMSET_SIZE = 2
+
+class _Node(object):
+  "A node of an FP-tree, one item with the count of transactions through it"
+  __slots__ = ['item', 'count', 'parent', 'children']
+  def __init__(self, item, parent):
+    self.item = item
+    self.count = 0
+    self.parent = parent
+    self.children = {}
+
+def _buildTree(transactions, min_support):
+  """Takes a list of (items, count) tuples and returns (root, header,
+  supports). supports maps every frequent item to its support, and header
+  maps it to the tree nodes of that item. Infrequent items are dropped first."""
+  supports = {}
+  for (items, count) in transactions:
+    for item in items:
+      supports[item] = supports.get(item, 0) + count
+  supports = dict((item, s) for (item, s) in supports.iteritems() if s >= min_support)
+  # Map<item, list<node>>
+  header = {}
+  root = _Node(None, None)
+  for (items, count) in transactions:
+    items = [item for item in items if item in supports]
+    # most frequent first, ties by item so the order is total
+    items.sort(key=lambda item: (-supports[item], item))
+    node = root
+    for item in items:
+      child = node.children.get(item)
+      if child is None:
+        child = _Node(item, node)
+        node.children[item] = child
+        header.setdefault(item, []).append(child)
+      child.count += count
+      node = child
+  return (root, header, supports)
+
+def _singlePath(root):
+  "The nodes of a tree from the root down, or None if it branches"
+  path = []
+  node = root
+  while len(node.children) == 1:
+    node = node.children.values()[0]
+    path.append(node)
+  if len(node.children) > 1:
+    return None
+  return path
+
+def _prefixPaths(nodes):
+  "The conditional pattern base of an item, given all of its nodes"
+  paths = []
+  for node in nodes:
+    path = []
+    parent = node.parent
+    while parent.item is not None:
+      path.append(parent.item)
+      parent = parent.parent
+    if len(path) > 0:
+      paths.append( (path, node.count) )
+  return paths
+
+def _mine(transactions, min_support, suffix, max_size, itemsets):
+  (_, header, supports) = _buildTree(transactions, min_support)
+  # least frequent first, so the biggest conditional trees come last
+  for item in sorted(supports, key=lambda item: (supports[item], item)):
+    itemset = suffix + (item,)
+    if len(itemset) >= MIN_ITEMSET_SIZE:
+      itemsets.append( (tuple(sorted(itemset)), supports[item]) )
+    if max_size is None or len(itemset) < max_size:
+      _mine(_prefixPaths(header[item]), min_support, itemset, max_size, itemsets)
+
+class _Maximal(object):
+  """The maximal itemsets found so far, with an index of item to the ones
+  that contain it, so subset checks only intersect a few small sets"""
+  def __init__(self):
+    self.itemsets = []
+    self.containing = {}
+
+  def covers(self, items):
+    "Whether items is a subset of an itemset found so far"
+    found = []
+    for item in items:
+      if item not in self.containing:
+        return False
+      found.append(self.containing[item])
+    if len(found) == 0:
+      return len(self.itemsets) > 0
+    found.sort(key=len)
+    common = set(found[0])
+    for ids in found[1:]:
+      common &= ids
+      if len(common) == 0:
+        return False
+    return True
+
+  def prunes(self, itemset, tail, longest, support):
+    "Whether a branch can only find subsets of itemset + tail"
+    return self.covers(itemset + tail)
+
+  def add(self, itemset, support):
+    if len(itemset) < MIN_ITEMSET_SIZE or self.covers(itemset):
+      return
+    for item in itemset:
+      self.containing.setdefault(item, set()).add(len(self.itemsets))
+    self.itemsets.append( (tuple(sorted(itemset)), support) )
+
+class _Largest(object):
+  """Keeps only the biggest itemset found so far, the most supported among
+  ties, and prunes every branch that can't beat it"""
+  def __init__(self, max_size):
+    self.max_size = max_size
+    self.best = None
+
+  def _key(self, size, support):
+    if self.max_size is not None:
+      size = min(size, self.max_size)
+    return (size, support)
+
+  def prunes(self, itemset, tail, longest, support):
+    # nothing in the branch has more than longest more items, nor is more
+    #  supported than itemset
+    return self.best is not None and \
+      self._key(len(itemset) + longest, support) <= self._key(len(self.best[0]), self.best[1])
+
+  def add(self, itemset, support):
+    if len(itemset) < MIN_ITEMSET_SIZE:
+      return
+    if self.best is None or self._key(len(itemset), support) > self._key(len(self.best[0]), self.best[1]):
+      self.best = (tuple(sorted(itemset)), support)
+
+def _mineMaximal(transactions, min_support, suffix, suffix_support, max_size, maximal):
+  (root, header, supports) = _buildTree(transactions, min_support)
+  if len(supports) == 0:
+    maximal.add(suffix, suffix_support)
+    return
+  path = _singlePath(root)
+  if path is not None:
+    # every subset of a path is frequent, the whole path is the maximal one
+    #  and with a max_size its most frequent items have the most support
+    if max_size is not None:
+      path = path[: max_size - len(suffix)]
+    maximal.add(suffix + tuple(node.item for node in path), path[-1].count)
+    return
+  # the exact reverse of the tree order, so nothing found later is a superset
+  #  of what was found earlier, since later items are above earlier ones
+  for item in sorted(supports, key=lambda item: (-supports[item], item), reverse=True):
+    itemset = suffix + (item,)
+    if max_size is not None and len(itemset) >= max_size:
+      maximal.add(itemset, supports[item])
+      continue
+    paths = _prefixPaths(header[item])
+    tail = {}
+    for (items, count) in paths:
+      for other in items:
+        tail[other] = tail.get(other, 0) + count
+    tail = tuple(other for (other, s) in tail.iteritems() if s >= min_support)
+    # an itemset is in at least min_support paths, so it's no longer than the
+    #  min_support'th longest path, counting only frequent items
+    frequent = set(tail)
+    lengths = sorted(
+      ((sum(1 for other in items if other in frequent), count) for (items, count) in paths),
+      reverse=True
+    )
+    (longest, covered) = (0, 0)
+    for (length, count) in lengths:
+      covered += count
+      if covered >= min_support:
+        longest = length
+        break
+    # skip the branch if it can't find anything new
+    if maximal.prunes(itemset, tail, longest, supports[item]):
+      continue
+    _mineMaximal(paths, min_support, itemset, supports[item], max_size, maximal)
+
+def _transactions(file_to_substr, min_support):
+  """The (items, count) transactions of a CSR file -> substr relation, with
+  substrs in fewer than min_support files dropped and identical transactions
+  merged"""
+  (indptr, indices) = file_to_substr
+  # substrs in fewer files can't be in any frequent itemset
+  keep = np.bincount(indices)[indices] >= min_support
+  rows = np.repeat(np.arange(len(indptr) - 1), np.diff(indptr))[keep]
+  kept = indices[keep]
+  bounds = np.searchsorted(rows, np.arange(len(indptr)))
+  # identical transactions are inserted once, with their multiplicity
+  counts = {}
+  for f in xrange(len(indptr) - 1):
+    items = tuple(kept[bounds[f] : bounds[f + 1]].tolist())
+    if len(items) >= MIN_ITEMSET_SIZE:
+      counts[items] = counts.get(items, 0) + 1
+  return [(list(items), count) for (items, count) in counts.iteritems()]
+
+def frequentItemsets(file_to_substr, min_support, max_size=None):
+  """Returns a list of (sorted tuple of substr ids, support) for every set of
+  at least MIN_ITEMSET_SIZE substrs that occur together in at least
+  min_support files. file_to_substr is a CSR (indptr, indices) tuple. With a
+  max_size, no itemset has more items than that. There are 2^m of them for m
+  substrs that always occur together, see maximalItemsets."""
+  assert min_support > 0, 'min_support must be positive: %d' % min_support
+  itemsets = []
+  _mine(_transactions(file_to_substr, min_support), min_support, (), max_size, itemsets)
+  return itemsets
+
+def maximalItemsets(file_to_substr, min_support, max_size=None):
+  """Like frequentItemsets, but only the itemsets that aren't a subset of
+  another frequent itemset, mined directly instead of filtered from all of
+  them. With a max_size, bigger maximal itemsets are cut down to their
+  max_size most frequent items, rather than listing every subset that size."""
+  assert min_support > 0, 'min_support must be positive: %d' % min_support
+  assert max_size is None or max_size > 0, 'max_size must be positive: %d' % max_size
+  maximal = _Maximal()
+  _mineMaximal(_transactions(file_to_substr, min_support), min_support, (), 0,
+    max_size, maximal)
+  return maximal.itemsets
+
+def largestItemset(file_to_substr, min_support, max_size=None):
+  """The biggest itemset of at most max_size substrs, and the most supported
+  among those, as a (sorted tuple of substr ids, support) tuple, or None if
+  no itemset is frequent. Much faster than picking it from maximalItemsets,
+  since branches that can't find a bigger one are never mined. It's still
+  exponential at worst, for many substrs that each go missing from a few
+  files at random, but substrs that always occur together are a single path
+  in the tree, which is one itemset straight away."""
+  assert min_support > 0, 'min_support must be positive: %d' % min_support
+  assert max_size is None or max_size > 0, 'max_size must be positive: %d' % max_size
+  largest = _Largest(max_size)
+  _mineMaximal(_transactions(file_to_substr, min_support), min_support, (), 0,
+    max_size, largest)
+  return largest.best
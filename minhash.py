@@ -0,0 +1,115 @@
+# minhash.py
+# Sat Oct 17 17:32:18 PDT 2026
+#
+# MinHash signatures and LSH banding over the rows of a CSR relation, like
+# the ones cooccurrences.readFile returns. Two rows agree on any one MinHash
+# with probability equal to the Jaccard similarity of their sets, so rows
+# that agree on a whole band of them are likely similar, and only those are
+# ever compared. That finds similar pairs without looking at every pair.
+
+import numpy as np
+
+NUM_HASHES_DEFAULT = 128
+SEED_DEFAULT = 1
+# how many hash functions are applied to every entry at once
+HASH_BATCH_SIZE = 16
+# what an empty row hashes to, it never agrees with a non-empty one
+EMPTY_HASH = np.uint64((1 << 64) - 1)
+
+def _hashParams(num_hashes, seed):
+  "Random odd multipliers and offsets for multiply shift hashing"
+  rng = np.random.RandomState(seed)
+  a = rng.randint(0, 1 << 62, size=num_hashes).astype(np.uint64) * np.uint64(2) + np.uint64(1)
+  b = rng.randint(0, 1 << 62, size=num_hashes).astype(np.uint64)
+  return (a, b)
+
+def signatures(csr, num_hashes=NUM_HASHES_DEFAULT, seed=SEED_DEFAULT):
+  """Returns a (rows, num_hashes) uint64 array, the MinHash signature of each
+  row of csr, an (indptr, indices) tuple of arrays"""
+  (indptr, indices) = csr
+  num_rows = len(indptr) - 1
+  sigs = np.full((num_rows, num_hashes), EMPTY_HASH, dtype=np.uint64)
+  non_empty = np.flatnonzero(np.diff(indptr) > 0)
+  if len(non_empty) == 0:
+    return sigs
+  (a, b) = _hashParams(num_hashes, seed)
+  x = indices.astype(np.uint64)[:, None]
+  for k in xrange(0, num_hashes, HASH_BATCH_SIZE):
+    with np.errstate(over='ignore'):
+      hashes = (x * a[None, k : k + HASH_BATCH_SIZE] + b[None, k : k + HASH_BATCH_SIZE]) >> np.uint64(16)
+    sigs[non_empty, k : k + HASH_BATCH_SIZE] = np.minimum.reduceat(
+      hashes, indptr[non_empty], axis=0
+    )
+  return sigs
+
+def bands(num_hashes, threshold):
+  """Returns (number of bands, rows per band) for num_hashes, such that pairs
+  with a Jaccard similarity around threshold become candidates half the time"""
+  best = None
+  for rows in xrange(1, num_hashes + 1):
+    if num_hashes % rows != 0:
+      continue
+    num_bands = num_hashes / rows
+    # where the S curve 1 - (1 - s**rows)**num_bands is steepest
+    s = (1.0 / num_bands) ** (1.0 / rows)
+    if best is None or abs(s - threshold) < abs(best[2] - threshold):
+      best = (num_bands, rows, s)
+  return (best[0], best[1])
+
+def buckets(sigs, num_bands, rows_per_band):
+  """Yields an array of row ids for every group of two or more non-empty rows
+  that agree on a whole band"""
+  live = np.flatnonzero(sigs[:, 0] != EMPTY_HASH)
+  if len(live) < 2:
+    return
+  for band in xrange(num_bands):
+    cols = sigs[live, band * rows_per_band : (band + 1) * rows_per_band]
+    (_, inverse, counts) = np.unique(cols, axis=0, return_inverse=True, return_counts=True)
+    order = np.argsort(inverse, kind='mergesort')
+    ends = np.cumsum(counts)
+    for label in np.flatnonzero(counts > 1).tolist():
+      yield live[order[ends[label] - counts[label] : ends[label]]]
+
+def similarity(sigs, i, j):
+  "The estimated Jaccard similarity of rows i and j"
+  return float(np.count_nonzero(sigs[i] == sigs[j])) / sigs.shape[1]
+
+def similarPairs(sigs, threshold, num_bands, rows_per_band):
+  """Returns a dict of (i, j), with i < j, to the estimated Jaccard similarity
+  of every candidate pair of rows that is at least threshold"""
+  pairs = {}
+  for group in buckets(sigs, num_bands, rows_per_band):
+    group = np.sort(group).tolist()
+    for x in xrange(len(group)):
+      for y in xrange(x + 1, len(group)):
+        pair = (group[x], group[y])
+        if pair in pairs:
+          continue
+        pairs[pair] = similarity(sigs, group[x], group[y])
+  return dict((pair, s) for (pair, s) in pairs.iteritems() if s >= threshold)
+
+def _find(parents, i):
+  while parents[i] != i:
+    # path halving
+    parents[i] = parents[parents[i]]
+    i = parents[i]
+  return i
+
+def clusters(sigs, threshold, num_bands, rows_per_band):
+  """Returns a list with the cluster id of every row. Rows end up in the same
+  cluster when a chain of candidate pairs, each with an estimated Jaccard
+  similarity of at least threshold, connects them. Clusters are numbered by
+  their smallest row, and rows with no similar row are clusters of one."""
+  parents = range(len(sigs))
+  for group in buckets(sigs, num_bands, rows_per_band):
+    group = group.tolist()
+    # only compare to the first row of the bucket, not every pair in it
+    root = group[0]
+    for i in group[1:]:
+      if _find(parents, root) == _find(parents, i):
+        continue
+      if similarity(sigs, root, i) < threshold:
+        continue
+      (ri, rr) = (_find(parents, i), _find(parents, root))
+      parents[max(ri, rr)] = min(ri, rr)
+  return [_find(parents, i) for i in xrange(len(sigs))]
@@ -14,120 +14,311 @@ import os
 import sys
 import time
 
+# 3rd party imports
+import numpy as np
+
 # local imports
+from benignindex import (readIndex, withoutBenign, maxBenignDf)
+from corpusindex import (openIndex, indexedFiles, knownHashes, putFile)
+from corpusindex import (filesWithAny, getFrequencies, putFrequencies)
+from corpusindex import (putOccurances, getOccurances)
 from encoding import (bin2hex)
-from extractors import (ngrams, substrings)
+from extractors import (ngrams, substrings_offsets)
 from extractors import (ngrams_set_generator, substrings_list)
+from extractors import (ngram_ids, hist_table, MIN_FILE_COUNT)
+from extractors import (sketched_ngram_ids, with_prefilter)
+from extractors import (multi_ngram_ids, multi_substrings_list)
 from filefuncs import (simpleFunc, multiFunc)
 from filefuncs import (hashedFunc, hashedMultiFunc)
-from sorting import (mergeSort, multiMergeSort)
+from filefuncs import (arrayFunc, arrayMultiFunc, tableSize)
+from filefuncs import (hashedArrayFunc, hashedArrayMultiFunc, mergeCounts)
+from filefuncs import (sketchFunc, sketchMultiFunc)
+from filefuncs import (arraysFunc, arraysMultiFunc)
+from filefuncs import (hashedListsFunc, hashedListsMultiFunc)
+from filefuncs import (cachingArrayFunc, cachingArrayMultiFunc, CACHE_MEMORY_SIZE)
+from filefuncs import (cachedHashedFunc, cachedHashedMultiFunc)
+from filefuncs import (publish, publishArrays, unpublish, setVerbosity)
+from sorting import (mergeSort, multiMergeSort, valueKey, DESCENDING)
+from sketch import (estimate, sketchShape)
+from store import (openStore, putContent)
+from suffixarray import (commonSubstrings, MIN_FILE_COUNT_DEFAULT)
+from tabulardb import (writeTable)
 
 DEBUG = False
 ENABLE_MULTICORE = True
 HASH_FUNC = 'md5'
 NUM_CORES = multiprocessing.cpu_count()
 NGRAMS_DEFAULT = 3
+ENGINE_DEFAULT = 'ngram'
+# RFC does top 25% make sense?
+TOP_K_FRACTION = 0.25
+# when reading in chunks, substrings longer than this may get split
+MAX_SUBSTRING_LEN = 4096
+# the ngrams of about this many files give the top k cutoff of a sketched
+#  ngram pass
+CUTOFF_SAMPLE_FILES = 256
 OUTPUT_FORMAT_DEFAULT = 'tsv'
+# ngrams in more than this fraction of the files of a benign index are dropped
+BENIGN_DF_DEFAULT = 0.1
+TABULAR_OUTPUT_FORMAT_DEFAULT = 'bin'
 
-def __hist_cmp(x, y):
-  if x[1] > y[1]:
-    return 1
-  elif x[1] < y[1]:
-    return -1
-  else:
-    return 0
-
-def __substr_hist_cmp(x, y):
-  # how many occurances
-  if x[1] > y[1]:
-    return 1
-  elif x[1] < y[1]:
-    return -1
-  else:
-    # length of substrs
-    if len(x[0]) > len(y[0]):
-      return 1
-    elif len(x[0]) < len(y[0]):
-      return -1
-    else:
-      return 0
+def substrHistKey(kvtuple):
+  "how many occurances, then length of substrs"
+  return (kvtuple[1], len(kvtuple[0]))
 
-def sortedHist(hist, minT=0):
-  "Actually returns a sorted list of (key, value) tuples"
+def sortedHist(hist, minT=0, pool=None):
+  """Actually returns a sorted list of (key, value) tuples. With a pool, the
+  sort runs on it."""
   tuples = hist.items()
   if minT > 0:
     tuples = filter(lambda kvtuple: kvtuple[1] > minT, tuples)
-  # True implies reverse=True, aka DESCENDING
-  return mergeSort(tuples, __hist_cmp, True)
+  if pool is None:
+    return mergeSort(tuples, valueKey, DESCENDING)
+  return multiMergeSort(tuples, valueKey, DESCENDING, pool)
 
 def sortedSubstrHist(hist, minT=0):
   tuples = hist.items()
   if minT > 0:
     tuples = filter(lambda kvtuple: kvtuple[1] > minT, tuples)
-  # True implies reverse=True, aka DESCENDING
-  return mergeSort(tuples, __substr_hist_cmp, True)
+  return mergeSort(tuples, substrHistKey, DESCENDING)
 
-def multiSortedHist(hist, minT=0):
-  "This seems to be memory bound :("
-  tuples = hist.items()
-  if minT > 0:
-    tuples = filter(lambda kvtuple: kvtuple[1] > minT, tuples)
-  # True implies reverse=True, aka DESCENDING
-  return multiMergeSort(tuples, __hist_cmp, True)
+def topKHist(hist, fraction, minT=0):
+  """Returns a dict of the fraction of keys in hist with the biggest values
+  above minT. Values are bounded by the number of files, so a histogram of
+  values finds the cutoff without sorting any keys. Keys tied at the cutoff
+  are picked arbitrarily, like they were when sorting."""
+  # Map<value, number of keys with it>
+  value_counts = {}
+  for v in hist.itervalues():
+    if v > minT:
+      value_counts[v] = value_counts.get(v, 0) + 1
+  k = int(sum(value_counts.itervalues()) * fraction)
+  if k == 0:
+    return {}
+  num_above = 0
+  for threshold in sorted(value_counts, reverse=True):
+    if num_above + value_counts[threshold] >= k:
+      break
+    num_above += value_counts[threshold]
+  num_ties = k - num_above
+  top = {}
+  for (key, v) in hist.iteritems():
+    if v > threshold:
+      top[key] = v
+    elif v == threshold and num_ties > 0:
+      top[key] = v
+      num_ties -= 1
+  return top
+
+def topKIdHist(hist, fraction, minT=0, num_keys=None):
+  """Like topKHist, but takes and returns a (sorted ids, counts) tuple of
+  arrays, as returned by filefuncs.mergeCounts. The ids stay sorted, so the
+  result is an ngram table. With num_keys, hist is only the candidates of a
+  table with num_keys keys above minT, and k is the fraction of those."""
+  (keys, counts) = hist
+  num_above = np.count_nonzero(counts > minT)
+  k = min(num_above, int((num_above if num_keys is None else num_keys) * fraction))
+  if k == 0:
+    return (keys[:0], counts[:0])
+  value_counts = np.bincount(counts[counts > minT])
+  # at_least[v] is how many keys have a count >= v
+  at_least = np.cumsum(value_counts[::-1])[::-1]
+  threshold = np.flatnonzero(at_least >= k)[-1]
+  mask = counts > threshold
+  num_ties = k - np.count_nonzero(mask)
+  mask[np.flatnonzero(counts == threshold)[:num_ties]] = True
+  return (keys[mask], counts[mask])
+
+def readOpts(chunk_size, overlap, use_mmap=False):
+  "Read opts for filefuncs.readWindows. A chunk_size of None reads whole files"
+  if chunk_size is None:
+    overlap = 0
+  return {'chunk_size': chunk_size, 'overlap': overlap, 'mmap': use_mmap}
 
-def main(path_regex, outfile, outformat, use_multi, N, verbosity):
+def sketchCutoff(filenames, use_multi, N, counts, chunk_size=None,
+    use_mmap=False, pool=None):
+  """Estimates (the number of ngrams in more than one file, the count an
+  ngram needs to make the top k) from the ngrams of a sample of the files.
+  An ngram in s sampled files is in about s / fraction sampled files, but no
+  more than its sketch estimate, and stands for 1 / (the chance it was
+  sampled at all) ngrams. With every file sampled, both are exact. Every
+  ngram in at least as many files as the cutoff has an estimate that's at
+  least as big, so filtering estimates by it keeps the whole top k."""
+  sample = filenames[::max(1, len(filenames) // CUTOFF_SAMPLE_FILES)]
+  if len(sample) == 0:
+    return (0, 2)
+  table_size = tableSize(N)
+  if not use_multi:
+    (_, _, (ids, sample_counts)) = arrayFunc(
+      (sample, ngram_ids, [N], table_size, readOpts(chunk_size, N - 1, use_mmap))
+    )
+  else:
+    (_, _, (ids, sample_counts)) = arrayMultiFunc(
+      (sample, ngram_ids, [N], table_size, readOpts(chunk_size, N - 1, use_mmap)),
+      pool
+    )
+  fraction = len(sample) / float(len(filenames))
+  guesses = np.minimum(
+    estimate(counts, ids),
+    np.round(sample_counts / fraction).astype(np.int64)
+  )
+  # Map<guessed count, number of ngrams with it>
+  num_ngrams = np.bincount(guesses, weights=1.0 / (1.0 - (1.0 - fraction) ** guesses))
+  num_keys = int(round(num_ngrams[2:].sum()))
+  k = int(num_keys * TOP_K_FRACTION)
+  if k == 0:
+    return (num_keys, len(num_ngrams))
+  # at_least[c] is how many ngrams are in c or more files
+  at_least = np.cumsum(num_ngrams[::-1])[::-1]
+  return (num_keys, max(2, int(np.flatnonzero(at_least >= k)[-1])))
+
+def sketchedNgrams(filenames, use_multi, N, sketch, chunk_size=None,
+    use_mmap=False, pool=None):
+  """A bounded memory version of the ngram pass, returns ((sorted ids,
+  counts), num_keys) where the table is like arrayFunc's but only for
+  candidate ngrams, and num_keys is about how many ngrams the full table
+  would have in more than one file, see topKIdHist. The first pass sketches
+  the document frequencies of every ngram in a Count-Min sketch sized to the
+  corpus, and the second only keeps ngrams whose estimate can make the top
+  k, see sketchCutoff. With a sketch of 'exact', the second pass counts the
+  candidates exactly, otherwise they get their estimates."""
   start = time.time()
-  filenames = glob.glob(path_regex)
-  print("Running mmlcs on %d files using %d cores looking for %d-grams" % (
-    len(filenames),
-    NUM_CORES if use_multi else 1,
-    N
-  ))
-  # TODO we could probably select a set instead of a histogram per file
+  # a file has at most as many distinct ngrams as bytes
+  num_pairs = sum(os.path.getsize(filename) for filename in filenames)
+  shape = sketchShape(num_pairs, NUM_CORES + 1 if use_multi else 1)
   if not use_multi:
-    (_, _, common_ngrams) = simpleFunc(
-      (filenames, ngrams, [N])
+    (_, _, counts) = sketchFunc(
+      (filenames, ngram_ids, [N], shape, readOpts(chunk_size, N - 1, use_mmap))
     )
   else:
-    (_, _, common_ngrams) = multiFunc(
-      (filenames, ngrams, [N])
+    (_, _, counts) = sketchMultiFunc(
+      (filenames, ngram_ids, [N], shape, readOpts(chunk_size, N - 1, use_mmap)),
+      pool
     )
   now = time.time()
-  print("[+] Reading %d files complete; time elapsed: %1.3f" % (len(filenames), now - start))
+  print("[+] Sketching %d files into %d counters complete; time elapsed: %1.3f" % (len(filenames), shape[1], now - start))
   start = now
-  # note that the following functions currently take a histogram and return
-  #  a sorted list of (ngram, count) tuples
-  if not use_multi or True:
-    # SLOW because common_ngrams gets huge
-    sorted_common_ngrams = sortedHist(common_ngrams, 1)
-  else:
-    # multi core sorting doesn't work yet...
-    sorted_common_ngrams = multiSortedHist(common_ngrams, 1)
+  (num_keys, cutoff) = sketchCutoff(filenames, use_multi, N, counts, chunk_size, use_mmap, pool)
   now = time.time()
-  print("[+] Sorting %d ngrams complete; time elapsed: %1.3f" % (len(sorted_common_ngrams), now - start))
+  print("[+] Estimating a cutoff of %d files for the top %d of %d ngrams complete; time elapsed: %1.3f" % (
+    cutoff,
+    int(num_keys * TOP_K_FRACTION),
+    num_keys,
+    now - start
+  ))
   start = now
-  # RFC does top 25% make sense?
-  top_k_index = len(sorted_common_ngrams) / 4
-  top_k = dict(sorted_common_ngrams[:top_k_index])
+  table_size = tableSize(N)
+  if not use_multi:
+    (_, _, candidates) = arrayFunc(
+      (filenames, sketched_ngram_ids, [N, counts, cutoff - 1], table_size,
+        readOpts(chunk_size, N - 1, use_mmap))
+    )
+  else:
+    # workers load the sketch once, instead of unpickling it per task
+    counts_ref = publish(counts)
+    (_, _, candidates) = arrayMultiFunc(
+      (filenames, sketched_ngram_ids, [N, counts_ref, cutoff - 1], table_size,
+        readOpts(chunk_size, N - 1, use_mmap)),
+      pool
+    )
+    unpublish(counts_ref)
+  if sketch != 'exact':
+    candidates = (candidates[0], estimate(counts, candidates[0]).astype(np.int64))
+  now = time.time()
+  print("[+] Counting %d candidate ngrams complete; time elapsed: %1.3f" % (len(candidates[0]), now - start))
+  return (candidates, num_keys)
+
+def dropBenign(top_k, benign_path, benign_df):
+  """Returns top_k without the ngrams that are in more than a benign_df
+  fraction of the files of the benign index at benign_path"""
+  start = time.time()
+  (_, num_files, benign) = readIndex(benign_path)
+  max_df = maxBenignDf(num_files, benign_df)
+  num_top_k = len(top_k[0])
+  top_k = withoutBenign(top_k, benign, max_df)
+  now = time.time()
+  print("[+] Dropping %d ngrams in more than %d of %d benign files from the top %d complete; time elapsed: %1.3f" % (
+    num_top_k - len(top_k[0]),
+    max_df,
+    num_files,
+    num_top_k,
+    now - start
+  ))
+  if len(top_k[0]) == 0:
+    print('[-] WARNING: Every top ngram is benign, there are no substrings to extract')
+  return top_k
+
+def main(path_regex, outfile, outformat, use_multi, N, verbosity, chunk_size=None,
+    use_mmap=False, sketch=None, prefilter=False, benign_path=None,
+    benign_df=BENIGN_DF_DEFAULT):
+  start = time.time()
+  setVerbosity(verbosity)
+  filenames = glob.glob(path_regex)
+  print("Running mmlcs on %d files using %d cores looking for %d-grams" % (
+    len(filenames),
+    NUM_CORES if use_multi else 1,
+    N
+  ))
+  # one pool for every stage, instead of one per stage
+  pool = multiprocessing.Pool(NUM_CORES) if use_multi else None
+  if sketch is not None:
+    (common_ngrams, num_keys) = sketchedNgrams(filenames, use_multi, N, sketch,
+      chunk_size, use_mmap, pool)
+    start = time.time()
+    top_k = topKIdHist(common_ngrams, TOP_K_FRACTION, 1, num_keys)
+    now = time.time()
+    print("[+] Selecting top %d of %d ngrams complete; time elapsed: %1.3f" % (len(top_k[0]), len(common_ngrams[0]), now - start))
+  else:
+    # TODO we could probably select a set instead of a histogram per file
+    if not use_multi:
+      (_, _, common_ngrams) = simpleFunc(
+        (filenames, ngrams, [N], readOpts(chunk_size, N - 1, use_mmap))
+      )
+    else:
+      (_, _, common_ngrams) = multiFunc(
+        (filenames, ngrams, [N], readOpts(chunk_size, N - 1, use_mmap)),
+        pool
+      )
+    now = time.time()
+    print("[+] Reading %d files complete; time elapsed: %1.3f" % (len(filenames), now - start))
+    start = now
+    # the order within the top k is never used, so select it without sorting
+    top_k_hist = topKHist(common_ngrams, TOP_K_FRACTION, 1)
+    now = time.time()
+    print("[+] Selecting top %d of %d ngrams complete; time elapsed: %1.3f" % (len(top_k_hist), len(common_ngrams), now - start))
+    # a compact table of (sorted ids, counts) arrays instead of a dict
+    top_k = hist_table(top_k_hist)
+  if benign_path is not None:
+    top_k = dropBenign(top_k, benign_path, benign_df)
+    if len(top_k[0]) == 0:
+      if pool is not None:
+        pool.close()
+        pool.join()
+      return
+  start = time.time()
+  if prefilter:
+    top_k = with_prefilter(top_k)
   if not use_multi:
     # RFC we're ignoring the count of distinct substrings
     (_, _, common_substrings) = simpleFunc(
-      (filenames, substrings, [N, top_k])
+      (filenames, substrings_offsets, [N, top_k], readOpts(chunk_size, MAX_SUBSTRING_LEN, use_mmap))
     )
   else:
+    # workers memory map top_k, instead of unpickling it per task
+    top_k_ref = publishArrays(top_k)
     (_, _, common_substrings) = multiFunc(
-      (filenames, substrings, [N, top_k])
+      (filenames, substrings_offsets, [N, top_k_ref], readOpts(chunk_size, MAX_SUBSTRING_LEN, use_mmap)),
+      pool
     )
+    unpublish(top_k_ref)
   now = time.time()
   print("[+] Extracting %d substrings complete; time elapsed: %1.3f" % (len(common_substrings), now - start))
   start = now
-  if not use_multi or True:
-    # This shouldn't be too slow since its sample size is much smaller than above
-    # Note that this returns a sorted list of (substring, count) tuples
-    sorted_common_substrings = sortedSubstrHist(common_substrings, 1)
-  else:
-    # TODO multicore substr sorting
-    sorted_common_substrings = sortedSubstrHist(common_substrings, 1)
+  # Note that this returns a sorted list of (substring, count) tuples
+  sorted_common_substrings = sortedSubstrHist(common_substrings, 1)
+  if pool is not None:
+    pool.close()
+    pool.join()
   now = time.time()
   print("[+] Sorting %d substrings complete; time elapsed: %1.3f" % (len(sorted_common_substrings), now - start))
   start = now
@@ -156,9 +347,19 @@ def main(path_regex, outfile, outformat, use_multi, N, verbosity):
       print("%d\t%d\t%s" % (kvtuple[1], len(kvtuple[0]) / 2, kvtuple[0][:30]))
   return
 
-def main2(path_regex, outfile, outformat, use_multi, N, verbosity, content_output):
+def ngramSubstrings(filenames, use_multi, N, engine=ENGINE_DEFAULT,
+    chunk_size=None, use_mmap=False, pool=None, sketch=None, prefilter=False,
+    benign_path=None, cache_ids=False, benign_df=BENIGN_DF_DEFAULT):
+  """The ngram pass followed by the substring extension pass. The ids engine
+  keys ngrams by uint64 ids and counts them with arrays instead of dicts.
+  With use_multi, every stage runs on pool. With a sketch, the ngram pass is
+  sketchedNgrams instead. With a benign index, see benignindex.py, its ngrams
+  in more than a benign_df fraction of its files are dropped from the top k
+  before any substring is extended over them.
+  With cache_ids, the ids engine keeps the hash of every file, and on a
+  single core the bytes of up to CACHE_MEMORY_SIZE bytes of files, and the
+  substring pass reads those instead of reading and hashing the files."""
   start = time.time()
-  filenames = glob.glob(path_regex)
   print("Running mmlcs on %d files using %d cores looking for %d-grams" % (
     len(filenames),
     NUM_CORES if use_multi else 1,
@@ -166,45 +367,325 @@ def main2(path_regex, outfile, outformat, use_multi, N, verbosity, content_outpu
   ))
   # SELECT ngram, COUNT(DISTINCT file)
   # GROUP BY ngram
+  cache_entries = None
+  # without a sketch, every key of common_ngrams counts towards k
+  num_keys = None
+  if sketch is not None:
+    (common_ngrams, num_keys) = sketchedNgrams(filenames, use_multi, N, sketch,
+      chunk_size, use_mmap, pool)
+  elif engine == 'ids' and cache_ids:
+    table_size = tableSize(N)
+    caching_args = (filenames, ngram_ids, HASH_FUNC, [N], table_size,
+      readOpts(chunk_size, N - 1, use_mmap), CACHE_MEMORY_SIZE)
+    if not use_multi:
+      (_, _, common_ngrams, cache_entries) = cachingArrayFunc(caching_args)
+    else:
+      (_, _, common_ngrams, cache_entries) = cachingArrayMultiFunc(caching_args, pool)
+  elif engine == 'ids':
+    # packed ngrams this small fit in a flat counting table
+    table_size = tableSize(N)
+    if not use_multi:
+      (_, _, common_ngrams) = arrayFunc(
+        (filenames, ngram_ids, [N], table_size, readOpts(chunk_size, N - 1, use_mmap))
+      )
+    else:
+      (_, _, common_ngrams) = arrayMultiFunc(
+        (filenames, ngram_ids, [N], table_size, readOpts(chunk_size, N - 1, use_mmap)),
+        pool
+      )
+  else:
+    if not use_multi:
+      (_, _, common_ngrams) = simpleFunc(
+        (filenames, ngrams_set_generator, [N], readOpts(chunk_size, N - 1, use_mmap))
+      )
+    else:
+      (_, _, common_ngrams) = multiFunc(
+        (filenames, ngrams_set_generator, [N], readOpts(chunk_size, N - 1, use_mmap)),
+        pool
+      )
+  if sketch is None:
+    now = time.time()
+    print("[+] Reading %d files complete; time elapsed: %1.3f" % (len(filenames), now - start))
+  start = time.time()
+  # WHERE COUNT > 1
+  # the order within the top k is never used, so select it without sorting
+  # a compact table of (sorted ids, counts) arrays instead of a dict
+  if engine == 'ids' or sketch is not None:
+    top_k = topKIdHist(common_ngrams, TOP_K_FRACTION, 1, num_keys)
+    num_ngrams = len(common_ngrams[0])
+  else:
+    top_k = hist_table(topKHist(common_ngrams, TOP_K_FRACTION, 1))
+    num_ngrams = len(common_ngrams)
+  now = time.time()
+  print("[+] Selecting top %d of %d ngrams complete; time elapsed: %1.3f" % (len(top_k[0]), num_ngrams, now - start))
+  start = now
+  if benign_path is not None:
+    top_k = dropBenign(top_k, benign_path, benign_df)
+    start = time.time()
+    if len(top_k[0]) == 0:
+      return ({}, [])
+  if prefilter:
+    top_k = with_prefilter(top_k)
+  if cache_entries is not None and not use_multi:
+    (substr_content, substr_occurances) = cachedHashedFunc(
+      (cache_entries, substrings_list, HASH_FUNC, [N, top_k],
+        readOpts(chunk_size, MAX_SUBSTRING_LEN, use_mmap))
+    )
+  elif cache_entries is not None:
+    top_k_ref = publishArrays(top_k)
+    (substr_content, substr_occurances) = cachedHashedMultiFunc(
+      (cache_entries, substrings_list, HASH_FUNC, [N, top_k_ref],
+        readOpts(chunk_size, MAX_SUBSTRING_LEN, use_mmap)),
+      pool
+    )
+    unpublish(top_k_ref)
+  elif not use_multi:
+    (substr_content, substr_occurances) = hashedFunc(
+      (filenames, substrings_list, HASH_FUNC, [N, top_k],
+        readOpts(chunk_size, MAX_SUBSTRING_LEN, use_mmap))
+    )
+  else:
+    # workers memory map top_k, instead of unpickling it per task
+    top_k_ref = publishArrays(top_k)
+    (substr_content, substr_occurances) = hashedMultiFunc(
+      (filenames, substrings_list, HASH_FUNC, [N, top_k_ref],
+        readOpts(chunk_size, MAX_SUBSTRING_LEN, use_mmap)),
+      pool
+    )
+    unpublish(top_k_ref)
+  now = time.time()
+  print("[+] Extracting %d substrings complete; time elapsed: %1.3f" % (len(substr_content), now - start))
+  return (substr_content, substr_occurances)
+
+def _relevantIds(top_k):
+  """The (ids, counts) of the ngrams of a top k table that substrings_list
+  extends substrings over"""
+  (keys, counts) = top_k
+  relevant = counts > MIN_FILE_COUNT
+  return (keys[relevant], counts[relevant])
+
+def _changedIds(old_top_k, top_k):
+  """The ngrams whose substrings can differ between two top k tables, aka the
+  relevant ones of either that aren't relevant with the same count in both"""
+  (old_keys, old_counts) = _relevantIds(old_top_k)
+  (keys, counts) = _relevantIds(top_k)
+  (both, old_index, index) = np.intersect1d(old_keys, keys, assume_unique=True,
+    return_indices=True)
+  unchanged = both[old_counts[old_index] == counts[index]]
+  return np.setdiff1d(np.union1d(old_keys, keys), unchanged, assume_unique=True)
+
+def incrementalSubstrings(filenames, index_path, use_multi, N, chunk_size=None,
+    use_mmap=False, pool=None, prefilter=False):
+  """Same output as ngramSubstrings with the ids engine, but only files that
+  aren't in the index at index_path yet are read for ngrams. Substrings are
+  extracted again from the new files, plus any indexed file that has an ngram
+  which entered or left the relevant part of the top k, or is relevant and
+  changed counts, since substrings end where counts change. Every other file
+  keeps the substrings it had when it was last extracted."""
+  start = time.time()
+  index = openIndex(index_path, N)
+  indexed = indexedFiles(index)
+  new_filenames = []
+  for filename in filenames:
+    stat = os.stat(filename)
+    if indexed.get(filename) != (stat.st_size, stat.st_mtime):
+      new_filenames.append(filename)
+  print("Running mmlcs on %d new of %d files using %d cores looking for %d-grams" % (
+    len(new_filenames),
+    len(filenames),
+    NUM_CORES if use_multi else 1,
+    N
+  ))
   if not use_multi:
-    (_, _, common_ngrams) = simpleFunc(
-      (filenames, ngrams_set_generator, [N])
+    file_ids = hashedArrayFunc(
+      (new_filenames, ngram_ids, HASH_FUNC, [N], readOpts(chunk_size, N - 1, use_mmap))
     )
   else:
-    (_, _, common_ngrams) = multiFunc(
-      (filenames, ngrams_set_generator, [N])
+    file_ids = hashedArrayMultiFunc(
+      (new_filenames, ngram_ids, HASH_FUNC, [N], readOpts(chunk_size, N - 1, use_mmap)),
+      pool
     )
+  # copies of indexed files, or indexed files that were only touched, count
+  #  towards the frequencies once
+  known = knownHashes(index, [file_hash for (_, file_hash, _) in file_ids])
+  # Map<file hash, filename>
+  extract = {}
+  partials = []
+  for (filename, file_hash, ids) in file_ids:
+    stat = os.stat(filename)
+    if file_hash in known:
+      putFile(index, file_hash, filename, stat.st_size, stat.st_mtime)
+      continue
+    known.add(file_hash)
+    putFile(index, file_hash, filename, stat.st_size, stat.st_mtime, ids)
+    extract[file_hash] = filename
+    partials.append( (ids, np.ones(len(ids), dtype=np.int64)) )
+  file_ids = None
+  old_frequencies = getFrequencies(index)
+  table_size = tableSize(N)
+  common_ngrams = mergeCounts([old_frequencies] + partials, table_size)
+  partials = None
   now = time.time()
-  print("[+] Reading %d files complete; time elapsed: %1.3f" % (len(filenames), now - start))
+  print("[+] Reading %d files complete; time elapsed: %1.3f" % (len(new_filenames), now - start))
   start = now
-  # note that the following functions currently take a histogram and return
-  #  a sorted list of (ngram, count) tuples
-  # WHERE COUNT > 1
-  # ORDER BY COUNT DESC
-  if not use_multi or True:
-    # SLOW because common_ngrams gets huge
-    sorted_common_ngrams = sortedHist(common_ngrams, 1)
-  else:
-    # multi core sorting doesn't work yet...
-    sorted_common_ngrams = multiSortedHist(common_ngrams, 1)
+  old_top_k = topKIdHist(old_frequencies, TOP_K_FRACTION, 1)
+  top_k = topKIdHist(common_ngrams, TOP_K_FRACTION, 1)
+  changed = _changedIds(old_top_k, top_k)
+  num_missing = 0
+  for (file_hash, filename) in filesWithAny(index, changed):
+    if file_hash in extract:
+      continue
+    if not os.path.isfile(filename):
+      num_missing += 1
+      continue
+    extract[file_hash] = filename
+  if num_missing > 0:
+    print("[-] WARNING: %d affected files are no longer readable, keeping their old substrings" % num_missing)
   now = time.time()
-  print("[+] Sorting %d ngrams complete; time elapsed: %1.3f" % (len(sorted_common_ngrams), now - start))
+  print("[+] Selecting top %d of %d ngrams (%d changed) complete; time elapsed: %1.3f" % (len(top_k[0]), len(common_ngrams[0]), len(changed), now - start))
   start = now
-  # RFC does top 25% make sense?
-  top_k_index = len(sorted_common_ngrams) / 4
-  top_k = dict(sorted_common_ngrams[:top_k_index])
+  if prefilter:
+    top_k = with_prefilter(top_k)
   if not use_multi:
     (substr_content, substr_occurances) = hashedFunc(
-      (filenames, substrings_list, HASH_FUNC, [N, top_k])
+      (extract.values(), substrings_list, HASH_FUNC, [N, top_k],
+        readOpts(chunk_size, MAX_SUBSTRING_LEN, use_mmap))
     )
   else:
+    # workers memory map top_k, instead of unpickling it per task
+    top_k_ref = publishArrays(top_k)
     (substr_content, substr_occurances) = hashedMultiFunc(
-      (filenames, substrings_list, HASH_FUNC, [N, top_k])
+      (extract.values(), substrings_list, HASH_FUNC, [N, top_k_ref],
+        readOpts(chunk_size, MAX_SUBSTRING_LEN, use_mmap)),
+      pool
     )
+    unpublish(top_k_ref)
+  with index:
+    putOccurances(index, extract.keys(), substr_occurances)
+    putFrequencies(index, common_ngrams)
+  substr_occurances = getOccurances(index)
+  index.close()
   now = time.time()
-  print("[+] Extracting %d substrings complete; time elapsed: %1.3f" % (len(substr_content), now - start))
+  print("[+] Extracting %d substrings from %d files complete; time elapsed: %1.3f" % (len(substr_content), len(extract), now - start))
+  return (substr_content, substr_occurances)
+
+def sweepSubstrings(filenames, use_multi, ns, chunk_size=None, use_mmap=False,
+    pool=None, prefilter=False):
+  """ngramSubstrings with the ids engine for every n in ns, but each file is
+  read once for the ngrams of all of them, and once for all their substrings.
+  Returns (substr_content, list of substr_occurances, one per n)."""
+  start = time.time()
+  print("Running mmlcs on %d files using %d cores looking for %s-grams" % (
+    len(filenames),
+    NUM_CORES if use_multi else 1,
+    ','.join(str(n) for n in ns)
+  ))
+  table_sizes = [tableSize(n) for n in ns]
+  if not use_multi:
+    (_, _, common_ngrams) = arraysFunc(
+      (filenames, multi_ngram_ids, [ns], table_sizes, readOpts(chunk_size, max(ns) - 1, use_mmap))
+    )
+  else:
+    (_, _, common_ngrams) = arraysMultiFunc(
+      (filenames, multi_ngram_ids, [ns], table_sizes, readOpts(chunk_size, max(ns) - 1, use_mmap)),
+      pool
+    )
+  now = time.time()
+  print("[+] Reading %d files complete; time elapsed: %1.3f" % (len(filenames), now - start))
+  start = now
+  top_ks = []
+  for (n, table) in zip(ns, common_ngrams):
+    top_k = topKIdHist(table, TOP_K_FRACTION, 1)
+    print("[+] Selecting top %d of %d %d-grams" % (len(top_k[0]), len(table[0]), n))
+    top_ks.append(with_prefilter(top_k) if prefilter else top_k)
+  common_ngrams = None
+  now = time.time()
+  print("[+] Selecting top ngrams complete; time elapsed: %1.3f" % (now - start))
   start = now
-  if content_output is not None:
+  if not use_multi:
+    (substr_content, substr_occurances) = hashedListsFunc(
+      (filenames, multi_substrings_list, HASH_FUNC, [ns, top_ks],
+        readOpts(chunk_size, MAX_SUBSTRING_LEN, use_mmap))
+    )
+  else:
+    # workers memory map every top k, instead of unpickling them per task
+    top_k_refs = [publishArrays(top_k) for top_k in top_ks]
+    (substr_content, substr_occurances) = hashedListsMultiFunc(
+      (filenames, multi_substrings_list, HASH_FUNC, [ns, top_k_refs],
+        readOpts(chunk_size, MAX_SUBSTRING_LEN, use_mmap)),
+      pool
+    )
+    for top_k_ref in top_k_refs:
+      unpublish(top_k_ref)
+  if len(substr_occurances) == 0:
+    # no files at all
+    substr_occurances = [[] for _ in ns]
+  now = time.time()
+  print("[+] Extracting %d substrings complete; time elapsed: %1.3f" % (len(substr_content), now - start))
+  return (substr_content, substr_occurances)
+
+def suffixSubstrings(filenames, hash_func, min_files):
+  """Same output as hashedFunc, but from a single generalized suffix array over
+  every file instead of the ngram then extend passes"""
+  blobs = []
+  file_hashes = []
+  for filename in filenames:
+    blob = open(filename).read()
+    blobs.append(blob)
+    file_hashes.append(hashlib.new(hash_func, blob).hexdigest())
+  substr_content = {}
+  substr_indexes = []
+  for (sub, offsets) in commonSubstrings(blobs, min_files):
+    sub_hash = hashlib.new(hash_func, sub).hexdigest()
+    substr_content[sub_hash] = sub
+    for d in offsets:
+      substr_indexes.append( (file_hashes[d], sub_hash, offsets[d]) )
+  substr_indexes.sort()
+  return (substr_content, substr_indexes)
+
+def main2(path_regex, outfile, outformat, use_multi, N, verbosity, content_output,
+    engine=ENGINE_DEFAULT, min_files=MIN_FILE_COUNT_DEFAULT, chunk_size=None,
+    use_mmap=False, index_path=None, sketch=None, prefilter=False,
+    benign_path=None, sweep_ns=None, cache_ids=False, benign_df=BENIGN_DF_DEFAULT):
+  start = time.time()
+  setVerbosity(verbosity)
+  filenames = glob.glob(path_regex)
+  if engine == 'suffix':
+    print("Running mmlcs on %d files using a suffix array looking for substrings in %d+ files" % (
+      len(filenames),
+      min_files
+    ))
+    (substr_content, substr_occurances) = suffixSubstrings(
+      filenames, HASH_FUNC, min_files
+    )
+    now = time.time()
+    print("[+] Extracting %d substrings complete; time elapsed: %1.3f" % (len(substr_content), now - start))
+  else:
+    # one pool for every stage, instead of one per stage
+    pool = multiprocessing.Pool(NUM_CORES) if use_multi else None
+    if sweep_ns is not None:
+      (substr_content, substr_occurances) = sweepSubstrings(
+        filenames, use_multi, sweep_ns, chunk_size, use_mmap, pool, prefilter
+      )
+    elif index_path is not None:
+      (substr_content, substr_occurances) = incrementalSubstrings(
+        filenames, index_path, use_multi, N, chunk_size, use_mmap, pool, prefilter
+      )
+    else:
+      (substr_content, substr_occurances) = ngramSubstrings(
+        filenames, use_multi, N, engine, chunk_size, use_mmap, pool, sketch,
+        prefilter, benign_path, cache_ids, benign_df
+      )
+    if pool is not None:
+      pool.close()
+      pool.join()
+  if content_output is not None and not os.path.isdir(content_output):
+    store = openStore(content_output)
+    num_new = putContent(store, substr_content.iteritems())
+    store.close()
+    print("[+] Wrote %d substrings content (%d new) to %s" % (len(substr_content), num_new, content_output))
+  elif content_output is not None:
+    # the old layout, one file per substring
     print("[+] Writing %d substrings content to %s" % (len(substr_content), content_output))
     for hash_key in substr_content:
       filename = os.path.join(
@@ -217,10 +698,23 @@ def main2(path_regex, outfile, outformat, use_multi, N, verbosity, content_outpu
         continue
       with open(filename, 'w') as f:
         f.write(substr_content[hash_key])
-  if outfile is not None:
-    assert outformat is not None, 'outformat should never be None'
+  if outfile is None:
+    print('No output file was specified')
+  elif sweep_ns is None:
+    writeOccurances(outfile, outformat, substr_occurances)
+  else:
+    # one tabular db per n, next to each other
+    for (n, occurances) in zip(sweep_ns, substr_occurances):
+      writeOccurances("%s.n%d" % (outfile, n), outformat, occurances)
+
+def writeOccurances(outfile, outformat, substr_occurances):
+  assert outformat is not None, 'outformat should never be None'
+  print("[+] Writing %d substring occurances to %s" % (len(substr_occurances), outfile))
+  if outformat == 'bin':
+    # dictionary encoded raw digests, see tabulardb.py
+    writeTable(outfile, substr_occurances, hashlib.new(HASH_FUNC).digest_size)
+  else:
     with open(outfile, 'w') as f:
-      print("[+] Writing %d substring occurances to %s" % (len(substr_occurances), outfile))
       if outformat == 'json':
         print('json tabular output not yet supported')
       elif outformat == 'tsv':
@@ -230,8 +724,6 @@ def main2(path_regex, outfile, outformat, use_multi, N, verbosity, content_outpu
           f.write("%s\t%s\t%d\n" % tup)
       else:
         print("Unknown output format %s" % outformat)
-  else:
-    print('No output file was specified')
 
 def validateInput(args):
   # input directory
@@ -254,11 +746,13 @@ def validateInput(args):
     output = args.output
   # output format
   if args.format is None:
-    output_format = OUTPUT_FORMAT_DEFAULT
+    output_format = TABULAR_OUTPUT_FORMAT_DEFAULT if args.tabular else OUTPUT_FORMAT_DEFAULT
   elif args.format.lower() == 'json':
     output_format = 'json'
   elif args.format.lower() == 'tsv':
     output_format = 'tsv'
+  elif args.format.lower() == 'bin' and args.tabular:
+    output_format = 'bin'
   else:
     print("[-] WARNING: Unknown output format %s, assuming json" % args.format)
     output_format = OUTPUT_FORMAT_DEFAULT
@@ -270,16 +764,73 @@ def validateInput(args):
     verbosity = args.verbose
   if args.n is None:
     N = NGRAMS_DEFAULT
+    sweep_ns = None
+  elif min(args.n) < 1:
+    raise Exception("n must be positive, got %d" % min(args.n))
+  elif len(set(args.n)) == 1:
+    N = args.n[0]
+    sweep_ns = None
   else:
-    N = args.n
+    # every n is swept in a single run
+    sweep_ns = sorted(set(args.n))
+    N = sweep_ns[0]
   if args.content is not None:
     if not args.tabular:
       print('You specified a content output dir, but not running in tabular mode')
-    if not os.path.isdir(args.content):
-      raise Exception("%s is not a directory" % args.input_dir)
+    # a directory means one file per substring, anything else is a store
+    if os.path.exists(args.content) and not os.path.isdir(args.content) and \
+        not os.path.isfile(args.content):
+      raise Exception("%s is neither a store nor a directory" % args.content)
     content_output = args.content
   else:
     content_output = None
+  # engine
+  if args.engine is None:
+    engine = 'ids' if args.index is not None or sweep_ns is not None or args.cache_ids else ENGINE_DEFAULT
+  else:
+    engine = args.engine
+  if args.index is not None and engine != 'ids':
+    raise Exception("An index is only supported by the ids engine, not %s" % engine)
+  if args.index is not None and args.sketch is not None:
+    raise Exception("An index keeps exact counts, it can't be used with a sketch")
+  if args.index is not None and os.path.isdir(args.index):
+    raise Exception("%s is a directory, not an index" % args.index)
+  if engine != 'ngram' and not args.tabular:
+    raise Exception("The %s engine is only supported in tabular mode" % engine)
+  if engine == 'suffix' and (args.sketch is not None or args.prefilter):
+    raise Exception("The suffix engine counts no ngrams, it can't be used with a sketch or a prefilter")
+  if engine == 'suffix' and (args.multi or args.chunk_size is not None or args.mmap):
+    raise Exception("The suffix engine builds one suffix array in memory, it can't be used with -m, a chunk size or mmap")
+  if args.min_files is None:
+    min_files = MIN_FILE_COUNT_DEFAULT
+  elif args.min_files < 2:
+    raise Exception("min files must be at least 2, got %d" % args.min_files)
+  else:
+    min_files = args.min_files
+  if args.chunk_size is not None and args.chunk_size <= MAX_SUBSTRING_LEN:
+    raise Exception("chunk size must be bigger than %d bytes" % MAX_SUBSTRING_LEN)
+  if sweep_ns is not None:
+    if not args.tabular or engine != 'ids':
+      raise Exception("Several values of n are only supported by the ids engine in tabular mode")
+    if args.index is not None or args.sketch is not None or args.benign is not None:
+      raise Exception("Several values of n can't be used with an index, a sketch or a benign index")
+  if args.cache_ids:
+    if not args.tabular or engine != 'ids':
+      raise Exception("Caching ngram ids is only supported by the ids engine in tabular mode")
+    if args.index is not None or args.sketch is not None or sweep_ns is not None:
+      raise Exception("Caching ngram ids can't be used with an index, a sketch or several values of n")
+  if args.benign is not None:
+    if engine == 'suffix':
+      raise Exception("A benign index is only supported by the ngram and ids engines")
+    if args.index is not None:
+      raise Exception("A benign index can't be used with an index, the index would keep stale substrings")
+    if not os.path.isfile(args.benign):
+      raise Exception("%s is not a benign index" % args.benign)
+    (benign_n, _, _) = readIndex(args.benign)
+    if benign_n != N:
+      raise Exception("%s has %d-grams, not %d-grams" % (args.benign, benign_n, N))
+    if not 0 <= args.benign_df <= 1:
+      raise Exception("benign df must be a fraction of the benign files, got %f" % args.benign_df)
   return (
       input_dir,
       output,
@@ -288,7 +839,18 @@ def validateInput(args):
       N,
       verbosity,
       args.tabular,
-      content_output
+      content_output,
+      engine,
+      min_files,
+      args.chunk_size,
+      args.mmap,
+      args.index,
+      args.sketch,
+      args.prefilter,
+      args.benign,
+      sweep_ns,
+      args.cache_ids,
+      args.benign_df
       )
 
 if __name__ == '__main__':
@@ -304,7 +866,7 @@ if __name__ == '__main__':
   parser.add_argument(
     '-f',
     '--format',
-    help='How the output should be formated. TSV or JSON'
+    help='How the output should be formated. TSV or JSON, or BIN (the default) in tabular mode'
   )
   parser.add_argument(
     '-m',
@@ -321,9 +883,67 @@ if __name__ == '__main__':
   parser.add_argument(
     '-c',
     '--content',
-    help='Where to store the content with filename=hex_hash'
+    help='Where to store the content, a store file or a directory with filename=hex_hash'
+  )
+  parser.add_argument(
+    '-n',
+    nargs='+',
+    type=int,
+    help='The value of n for n-grams. With several, the ids engine finds substrings for each in one run, writing OUTPUT.nN'
+  )
+  parser.add_argument(
+    '-e',
+    '--engine',
+    choices=['ngram', 'ids', 'suffix'],
+    help='How tabular substrings are found. ngram (default), ids or suffix'
+  )
+  parser.add_argument(
+    '-k',
+    '--min-files',
+    type=int,
+    help='The suffix engine keeps substrings found in at least this many files'
+  )
+  parser.add_argument(
+    '--chunk-size',
+    type=int,
+    help='Read files in windows of this many bytes instead of all at once'
+  )
+  parser.add_argument(
+    '--mmap',
+    action='store_true',
+    help='Memory map files instead of reading them into each worker'
+  )
+  parser.add_argument(
+    '-i',
+    '--index',
+    help='Keep per file ngrams in this index file, and only read files that are not in it yet'
+  )
+  parser.add_argument(
+    '--sketch',
+    choices=['estimate', 'exact'],
+    help='Find common ngrams with a fixed size Count-Min sketch, then either use its estimates or recount the candidates exactly'
+  )
+  parser.add_argument(
+    '--prefilter',
+    action='store_true',
+    help='Test a bitmap or Bloom filter of the top ngrams before looking them up'
+  )
+  parser.add_argument(
+    '-b',
+    '--benign',
+    help='Drop the ngrams in this benign index, see benignindex.py, before extracting substrings'
+  )
+  parser.add_argument(
+    '--benign-df',
+    type=float,
+    default=BENIGN_DF_DEFAULT,
+    help='Only drop the ngrams in more than this fraction of the benign files, %s by default' % BENIGN_DF_DEFAULT
+  )
+  parser.add_argument(
+    '--cache-ids',
+    action='store_true',
+    help='Keep the hash of every file, and up to 256MB of their bytes on a single core, so the substring pass does not read or hash them again'
   )
-  parser.add_argument('-n', help='The value of n for n-grams', type=int)
   parser.add_argument('-v', '--verbose', action='count')
   (input_dir_regex,
    output,
@@ -332,11 +952,25 @@ if __name__ == '__main__':
    n,
    verbosity,
    tabular,
-   content_output
+   content_output,
+   engine,
+   min_files,
+   chunk_size,
+   use_mmap,
+   index_path,
+   sketch,
+   prefilter,
+   benign_path,
+   sweep_ns,
+   cache_ids,
+   benign_df
    ) = validateInput(
     parser.parse_args()
   )
   if not tabular:
-    main(input_dir_regex, output, outformat, use_multi, n, verbosity)
+    main(input_dir_regex, output, outformat, use_multi, n, verbosity,
+      chunk_size, use_mmap, sketch, prefilter, benign_path, benign_df)
   else:
-    main2(input_dir_regex, output, outformat, use_multi, n, verbosity, content_output)
+    main2(input_dir_regex, output, outformat, use_multi, n, verbosity,
+      content_output, engine, min_files, chunk_size, use_mmap, index_path, sketch,
+      prefilter, benign_path, sweep_ns, cache_ids, benign_df)
@@ -0,0 +1,248 @@
+# scanner.py
+# Sat Oct 17 20:11:26 PDT 2026
+#
+# Counts how many files of a corpus actually contain each substring. Every
+# substring is keyed by one of its ngrams, its anchor, and each file is read
+# once: the ngram at every offset is computed and looked up in the anchors
+# with numpy, and only offsets with a matching anchor are compared to the
+# substrings that have it. Scanning a clean corpus this way measures how often
+# the substrings would false positive. The output is a tabular db like
+# mmlcs.py -t writes, with the first offset of every substring in every file
+# it's in.
+#
+# A pure Python Aho-Corasick automaton, one dict lookup per byte, scanned
+# about 1MB/s, slower than one str.find per substring for anything under
+# a couple thousand substrings. Anchors only leave Python at the candidates,
+# and beat str.find from a few hundred substrings on, below that they're
+# found with str.find instead.
+
+from __future__ import print_function
+
+# stdlib imports
+import argparse
+import glob
+import hashlib
+import multiprocessing
+import os
+import sys
+import time
+
+# 3rd party imports
+import numpy as np
+
+# local imports
+from cooccurrences import (readFile)
+from extractors import (ngram_id_array, gram_id)
+from filefuncs import (readWindows, resolve, scheduledMap, publish, unpublish)
+from store import (openStore, getContent)
+from tabulardb import (writeTable)
+
+HASH_FUNC = 'md5'
+NUM_CORES = multiprocessing.cpu_count()
+SCAN_CHUNK_SIZE = 1 << 24
+# substrings shorter than this are found with str.find instead
+ANCHOR_LEN = 4
+# with at most this many substrings left to find, a str.find per substring is
+#  faster than computing the anchor at every offset
+FIND_MAX_PATTERNS = 256
+
+def _anchorOffset(pattern):
+  """Where the anchor of pattern starts, its ngram with the most distinct
+  bytes, so runs of padding like zeros make for few candidates"""
+  return max(
+    xrange(len(pattern) - ANCHOR_LEN + 1),
+    key=lambda j: (len(set(pattern[j : j + ANCHOR_LEN])), -j)
+  )
+
+def buildMatcher(patterns):
+  """Returns (keys, groups, short) where keys is the sorted array of anchor
+  ids, groups[i] is the list of (pattern index, anchor offset) of every
+  pattern whose anchor is keys[i], and short lists the indexes of patterns
+  shorter than ANCHOR_LEN."""
+  # Map<anchor id, list<(pattern, offset)>>
+  anchors = {}
+  short = []
+  for (i, pattern) in enumerate(patterns):
+    if len(pattern) == 0:
+      continue
+    if len(pattern) < ANCHOR_LEN:
+      short.append(i)
+      continue
+    j = _anchorOffset(pattern)
+    anchors.setdefault(gram_id(pattern[j : j + ANCHOR_LEN]), []).append( (i, j) )
+  keys = sorted(anchors)
+  return (np.array(keys, dtype=np.uint64), [anchors[key] for key in keys], short)
+
+def _findEach(window, offset, owned_end, patterns, indexes, first):
+  "Finds each of indexes that isn't in first yet with str.find"
+  for i in indexes:
+    if i not in first:
+      index = window.find(patterns[i], 0, owned_end - offset + len(patterns[i]) - 1)
+      if index >= 0:
+        first[i] = offset + index
+
+def _scanWindow(window, offset, owned_end, matcher, patterns, first):
+  """Adds the first index of every pattern that starts in window before
+  owned_end, and isn't in first yet, to first"""
+  (keys, groups, short) = matcher
+  _findEach(window, offset, owned_end, patterns, short, first)
+  if len(patterns) - len(first) <= FIND_MAX_PATTERNS:
+    indexes = [i for i in xrange(len(patterns)) if len(patterns[i]) > 0]
+    _findEach(window, offset, owned_end, patterns, indexes, first)
+    return
+  if len(keys) == 0:
+    return
+  ids = ngram_id_array(window, ANCHOR_LEN)
+  pos = np.minimum(np.searchsorted(keys, ids), len(keys) - 1)
+  candidates = np.flatnonzero(keys[pos] == ids)
+  for (p, k) in zip(candidates.tolist(), pos[candidates].tolist()):
+    for (i, j) in groups[k]:
+      start = p - j
+      # a start before the window was owned by the previous one
+      if i in first or start < 0 or offset + start >= owned_end:
+        continue
+      if window.startswith(patterns[i], start):
+        first[i] = offset + start
+
+def scanFunc(tupleargs):
+  """Scans every one of filenames with a published (patterns, pattern hashes,
+  matcher) tuple. Returns a list of (file hash, substr hash, index) tuples,
+  with the first index of every substr within every file."""
+  filenames = tupleargs[0]
+  (patterns, hashes, matcher) = resolve([tupleargs[1]])[0]
+  hash_func = tupleargs[2]
+  chunk_size = tupleargs[3] if len(tupleargs) > 3 else SCAN_CHUNK_SIZE
+  # windows overlap by the longest pattern, so none is split
+  read_opts = {
+    'chunk_size': chunk_size,
+    'overlap': max([len(p) for p in patterns] + [1]) - 1,
+    'mmap': False
+  }
+  substr_indexes = []
+  for filename in filenames:
+    file_size = os.path.getsize(filename)
+    hasher = hashlib.new(hash_func)
+    # Map<pattern, first index>
+    first = {}
+    for (offset, window) in readWindows(filename, read_opts, hasher):
+      if offset + len(window) >= file_size:
+        owned_end = file_size
+      else:
+        owned_end = offset + len(window) - read_opts['overlap']
+      _scanWindow(window, offset, owned_end, matcher, patterns, first)
+    file_hash = hasher.hexdigest()
+    for pattern in sorted(first, key=first.get):
+      substr_indexes.append( (file_hash, hashes[pattern], first[pattern]) )
+  return substr_indexes
+
+def scanMultiFunc(tupleargs, pool=None):
+  filenames = tupleargs[0]
+  matcher_ref = tupleargs[1]
+  hash_func = tupleargs[2]
+  chunk_size = tupleargs[3] if len(tupleargs) > 3 else SCAN_CHUNK_SIZE
+  substr_indexes = []
+  for result in scheduledMap(scanFunc, filenames, [matcher_ref, hash_func, chunk_size], pool):
+    substr_indexes.extend(result)
+  return substr_indexes
+
+def loadPatterns(db_filename, content):
+  """Returns (hex hashes, contents) of every substr in a tabular db, read
+  from a content store or a directory with filename=hex_hash"""
+  (_, _, substr_hexes, _, _) = readFile(db_filename)
+  if not os.path.isdir(content):
+    store = openStore(content)
+    contents = getContent(store, substr_hexes)
+    store.close()
+  else:
+    contents = {}
+    for hex_hash in substr_hexes:
+      filename = os.path.join(content, hex_hash)
+      if os.path.isfile(filename):
+        contents[hex_hash] = open(filename).read()
+  hashes = [hex_hash for hex_hash in substr_hexes if hex_hash in contents]
+  return (hashes, [contents[hex_hash] for hex_hash in hashes])
+
+def main(path_regex, db_filename, content, outfile, outformat, use_multi):
+  start = time.time()
+  filenames = glob.glob(path_regex)
+  (hashes, patterns) = loadPatterns(db_filename, content)
+  if len(hashes) == 0:
+    print("No substrs of %s are in %s" % (db_filename, content), file=sys.stderr)
+    sys.exit(-1)
+  matcher = buildMatcher(patterns)
+  now = time.time()
+  print("[+] Anchoring %d substrs on %d ngrams complete; time elapsed: %1.3f" % (
+    len(patterns),
+    len(matcher[0]),
+    now - start
+  ), file=sys.stderr)
+  start = now
+  # workers load the matcher once, instead of unpickling it per task
+  matcher_ref = publish( (patterns, hashes, matcher) )
+  if not use_multi:
+    substr_indexes = scanFunc((filenames, matcher_ref, HASH_FUNC))
+  else:
+    substr_indexes = scanMultiFunc((filenames, matcher_ref, HASH_FUNC))
+  unpublish(matcher_ref)
+  now = time.time()
+  print("[+] Scanning %d files complete, %d of %d substrs were found; time elapsed: %1.3f" % (
+    len(filenames),
+    len(set(sub_hash for (_, sub_hash, _) in substr_indexes)),
+    len(patterns),
+    now - start
+  ), file=sys.stderr)
+  if outfile is None:
+    # Map<substr hash, number of files>
+    counts = dict((hex_hash, 0) for hex_hash in hashes)
+    for (_, sub_hash, _) in substr_indexes:
+      counts[sub_hash] += 1
+    for hex_hash in hashes:
+      print("%s\t%d" % (hex_hash, counts[hex_hash]))
+  elif outformat == 'bin':
+    writeTable(outfile, substr_indexes, hashlib.new(HASH_FUNC).digest_size)
+  else:
+    with open(outfile, 'w') as f:
+      for tup in substr_indexes:
+        f.write("%s\t%s\t%d\n" % tup)
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(
+    description='Counts the files that contain each substr of a tabular db'
+  )
+  parser.add_argument(
+    'input_dir',
+    help='Where the files to scan are stored, malicious or not'
+  )
+  parser.add_argument(
+    'db_filename',
+    help='The tabular db whose substrs should be scanned for'
+  )
+  parser.add_argument(
+    '-c',
+    '--content',
+    required=True,
+    help='Where the content is stored, a store file or a directory with filename=hex_hash'
+  )
+  parser.add_argument(
+    '-o',
+    '--output',
+    help='Where to write the hits as a tabular db, otherwise print a file count per substr'
+  )
+  parser.add_argument(
+    '-f',
+    '--format',
+    choices=['bin', 'tsv'],
+    default='bin',
+    help='How the output db should be formated'
+  )
+  parser.add_argument(
+    '-m',
+    '--multi',
+    action='store_true',
+    help='Toggles whether or not to use multiple cores'
+  )
+  args = parser.parse_args()
+  if not os.path.isdir(args.input_dir):
+    raise Exception("%s is not a directory" % args.input_dir)
+  main(os.path.join(args.input_dir, '*'), args.db_filename, args.content,
+    args.output, args.format, args.multi)
@@ -0,0 +1,64 @@
+# sketch.py
+# Sat Oct 17 19:02:33 PDT 2026
+#
+# A Count-Min sketch of uint64 ngram ids, aka a depth x width table of
+# counters where every id adds to one counter per row. Estimates are the
+# smallest of an id's counters, which never undercounts and only overcounts
+# by whatever collided with it. Sketches of the same shape merge by adding
+# them, so every worker can sketch its own files.
+#
+# A sketch as wide as there are (ngram, file) pairs leaves about one pair per
+# counter, beyond that every estimate grows by about pairs / width.
+
+import numpy as np
+
+SKETCH_DEPTH = 4
+# every sketch of a run together, aka one per worker and the merged one
+SKETCH_MEMORY_SIZE = 1 << 28
+# one odd multiplier per row, for multiply shift hashing
+ROW_MULTIPLIERS = [
+  0x9e3779b97f4a7c15,
+  0xc2b2ae3d27d4eb4f,
+  0x165667b19e3779f9,
+  0xd6e8feb86659fd93,
+  0xff51afd7ed558ccd,
+  0xc4ceb9fe1a85ec53,
+  0x94d049bb133111eb,
+  0xbf58476d1ce4e5b9,
+]
+
+def sketchShape(num_pairs, num_sketches=1, memory_size=SKETCH_MEMORY_SIZE):
+  """The (depth, width) of a sketch of num_pairs (id, file) pairs, about as
+  wide as there are pairs, but no wider than num_sketches of them fit in
+  memory_size bytes"""
+  width = 1 << max(1, (max(1, num_pairs) - 1).bit_length())
+  while width > 2 and num_sketches * SKETCH_DEPTH * 4 * width > memory_size:
+    width >>= 1
+  return (SKETCH_DEPTH, width)
+
+def newSketch(depth, width):
+  assert depth <= len(ROW_MULTIPLIERS), 'depth %d is more than %d' % (depth, len(ROW_MULTIPLIERS))
+  assert width > 1 and width & (width - 1) == 0, 'width %d must be a power of two' % width
+  # counts are bounded by the number of files
+  return np.zeros((depth, width), dtype=np.int32)
+
+def _cells(sketch, ids, row):
+  "The counter of every id in a row, from the top bits of a multiply shift hash"
+  (_, width) = sketch.shape
+  shift = np.uint64(64 - (width.bit_length() - 1))
+  with np.errstate(over='ignore'):
+    hashes = ids.astype(np.uint64) * np.uint64(ROW_MULTIPLIERS[row])
+  return (hashes >> shift).astype(np.int64)
+
+def addIds(sketch, ids):
+  """Adds one to the count of an id for every time it's in ids. Every call
+  goes over the whole sketch, so add many files' ids at once."""
+  for row in xrange(sketch.shape[0]):
+    sketch[row] += np.bincount(_cells(sketch, ids, row), minlength=sketch.shape[1])
+
+def estimate(sketch, ids):
+  "Returns an upper bound of the count of each of ids"
+  counts = sketch[0][_cells(sketch, ids, 0)]
+  for row in xrange(1, sketch.shape[0]):
+    counts = np.minimum(counts, sketch[row][_cells(sketch, ids, row)])
+  return counts
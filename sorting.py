@@ -7,7 +7,12 @@
 
 from __future__ import print_function
 
+import cPickle
+import heapq
+import itertools
 import multiprocessing
+import os
+import tempfile
 
 NUM_CORES = multiprocessing.cpu_count()
 
@@ -15,72 +20,146 @@ NUM_CORES = multiprocessing.cpu_count()
 ASCENDING = False
 DESCENDING = True
 
-def _merge(a, b, cmp, order):
-  """Returns a single sorted list, derived from two sorted lists, a cmp
-  function to compare items in the input lists, and a boolean to decide
-  between order descending or ascending (the default for list.sort())."""
-  ret = []
-  # is taking the len many times bad?..
-  while len(a) > 0 or len(b) > 0:
-    if len(a) > 0 and len(b) > 0:
-      # Always compare from index zero
-      if not (cmp(a[0], b[0]) > 0) ^ order:
-        # is _merge pass by reference? do we mutate a?
-        ret.append(a.pop(0))
-      else:
-        ret.append(b.pop(0))
-    elif len(a) > 0:  # len(b) == 0
-      ret.append(a.pop(0))
-    elif len(b) > 0:  # len(a) == 0
-      ret.append(b.pop(0))
+# how many items externalSort holds in memory before spilling runs to disk
+MEMORY_BUDGET_DEFAULT = 1 << 22
+# items per pickle when spilling, so the per pickle overhead is amortized
+SPILL_BATCH_SIZE = 1 << 12
+# the most runs merged at once, each is an open file
+MAX_MERGE_FAN_IN = 64
+
+def valueKey(kvtuple):
+  "Sorts (key, value) tuples, aka histogram items, by value"
+  return kvtuple[1]
+
+class _Descending(object):
+  "Wraps a sort key so heapq, which only pops the smallest, pops the biggest"
+  __slots__ = ['key']
+  def __init__(self, key):
+    self.key = key
+  def __lt__(self, other):
+    return other.key < self.key
+  def __eq__(self, other):
+    return self.key == other.key
+
+def kWayMerge(runs, key, order=DESCENDING):
+  """Yields every item of runs, a list of iterables that are each sorted by
+  key in the given order, as one sorted stream. Ties go to the earlier run,
+  so merging runs of a stable sort is stable."""
+  wrap = _Descending if order == DESCENDING else (lambda k: k)
+  iters = [iter(run) for run in runs]
+  heap = []
+  for i in range(len(iters)):
+    for item in iters[i]:
+      heap.append((wrap(key(item)), i, item))
+      break
+  heapq.heapify(heap)
+  while len(heap) > 0:
+    (_, i, item) = heap[0]
+    yield item
+    for item in iters[i]:
+      heapq.heapreplace(heap, (wrap(key(item)), i, item))
+      break
     else:
-      assert False and len(a) == 0 and len(b) == 0, 'Impossible: %d %d' % (len(a), len(b))
-  # assert len(ret) == orig_len_a + orig_len_b
-  return ret
+      heapq.heappop(heap)
 
-def mergeSort(l, cmp, order=DESCENDING, depth=0):
+def mergeSort(l, key, order=DESCENDING):
   """Returns a new list that is a sorted list of l. Python's sort by default
   uses reverse=False to imply that the ordering is ascending. The default
   here is to be descending."""
   assert l is not None, 'Cant sort None, try an empty list'
-  if len(l) <= 1:
-    return l
-  # This is a major cheat
-  copy = list(l)
-  copy.sort(cmp=cmp, reverse=order)
-  return copy
-  # This is a cheat to improve memory consumption.. Maybe
-  if depth > 5:
-    copy = list(l)
-    copy.sort(cmp=cmp, reverse=order)
-    return copy
-  elif depth == 0:
-    print("Warning: mergeSort seems to be slow...")
-  mid = int(len(l) / 2)
-  # these could be done in parallel..
-  a = mergeSort(l[:mid], cmp, order, depth+1)
-  b = mergeSort(l[mid:], cmp, order, depth+1)
-  return _merge(a, b, cmp, order)
-
-def _mergeSort(args):
-  return mergeSort(args[0], args[1], args[2])
-
-def multiMergeSort(l, cmp, order=DESCENDING):
-  partitions = []
-  partition_size = len(l) / NUM_CORES
-  # off by one fix dependent on python's slicing
-  for i in range(NUM_CORES+1):
-    partitions.append(
-      [l[i * partition_size : (i+1) * partition_size], cmp, order]
-    )
-  pool = multiprocessing.Pool(NUM_CORES)
-  partial_results = pool.map(_mergeSort, partitions)
-  # why are we doing these?
-  pool.close()
-  pool.join()
-  ret = []
-  for i in range(len(partial_results)):
-    # do we need to access _merge() here?
-    ret = _merge(ret, partial_results[i], cmp, order)
+  return sorted(l, key=key, reverse=order)
+
+def _partitions(l, num_partitions):
+  partition_size = (len(l) + num_partitions - 1) / num_partitions
+  return [
+    l[i * partition_size : (i+1) * partition_size]
+    for i in range(num_partitions)
+  ]
+
+def _spill(run):
+  "Writes a sorted run to a temp file and returns its path"
+  (fd, path) = tempfile.mkstemp(prefix='mmlcs-sort-')
+  with os.fdopen(fd, 'wb') as f:
+    batch = []
+    for item in run:
+      batch.append(item)
+      if len(batch) == SPILL_BATCH_SIZE:
+        cPickle.dump(batch, f, cPickle.HIGHEST_PROTOCOL)
+        batch = []
+    if len(batch) > 0:
+      cPickle.dump(batch, f, cPickle.HIGHEST_PROTOCOL)
+  return path
+
+def _spilledRun(args):
+  "Sorts a run and spills it, in a worker, so only its path comes back"
+  (items, key, order) = args
+  items.sort(key=key, reverse=order)
+  return _spill(items)
+
+def _readRun(path):
+  "Yields the items of a spilled run, then deletes it"
+  try:
+    with open(path, 'rb') as f:
+      while True:
+        try:
+          batch = cPickle.load(f)
+        except EOFError:
+          break
+        for item in batch:
+          yield item
+  finally:
+    os.remove(path)
+
+def _mergeRuns(paths, key, order):
+  """Merges the spilled runs at paths into one sorted stream, first merging
+  them MAX_MERGE_FAN_IN at a time into fewer, longer runs until that many
+  files can be open at once"""
+  while len(paths) > MAX_MERGE_FAN_IN:
+    paths = [
+      _spill(kWayMerge([_readRun(path) for path in paths[i : i + MAX_MERGE_FAN_IN]], key, order))
+      for i in xrange(0, len(paths), MAX_MERGE_FAN_IN)
+    ]
+  return kWayMerge([_readRun(path) for path in paths], key, order)
+
+def externalSort(items, key, order=DESCENDING, pool=None,
+    memory_budget=MEMORY_BUDGET_DEFAULT):
+  """Returns an iterator over items sorted by key. Inputs of up to
+  memory_budget items are sorted in memory, since pickling them to other
+  processes costs more than sorting them. Bigger inputs are cut into runs of
+  memory_budget items that are sorted and spilled to disk, in parallel on
+  pool if one is given, then lazily k-way merged from there."""
+  num_workers = NUM_CORES if pool is not None else 1
+  run_size = max(1, memory_budget / num_workers)
+  items = iter(items)
+  first = list(itertools.islice(items, memory_budget))
+  rest = list(itertools.islice(items, 1))
+  if len(rest) == 0:
+    # it all fits in memory
+    first.sort(key=key, reverse=order)
+    return iter(first)
+  paths = []
+  wave = _partitions(first + rest, num_workers)
+  first = None
+  rest = None
+  while len(wave) > 0:
+    args = [(run, key, order) for run in wave]
+    if pool is None:
+      paths.extend(map(_spilledRun, args))
+    else:
+      paths.extend(pool.map(_spilledRun, args))
+    args = None
+    wave = []
+    for i in range(num_workers):
+      run = list(itertools.islice(items, run_size))
+      if len(run) == 0:
+        break
+      wave.append(run)
+  return _mergeRuns(paths, key, order)
+
+def multiMergeSort(l, key, order=DESCENDING, pool=None,
+    memory_budget=MEMORY_BUDGET_DEFAULT):
+  """Like mergeSort, but with externalSort, so inputs past memory_budget
+  items are sorted in runs on pool"""
+  ret = list(externalSort(l, key, order, pool, memory_budget))
   assert len(l) == len(ret), 'len of input %d should be equal to output %d' % (len(l), len(ret))
   return ret
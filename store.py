@@ -0,0 +1,54 @@
+# store.py
+# Sat Oct 17 13:40:02 PDT 2026
+#
+# A hash based local database of substrings (or samples), aka a table between
+# hash and content, in a single SQLite file. Digests are passed around as hex
+# everywhere else, but stored raw.
+
+import binascii
+import sqlite3
+
+# SQLite limits how many parameters a single statement can have
+LOOKUP_BATCH_SIZE = 500
+
+def openStore(path):
+  "Returns a connection to the store at path, creating it if needed"
+  conn = sqlite3.connect(path)
+  # the store is rebuildable, so favor bulk write speed over durability
+  conn.execute('PRAGMA journal_mode = WAL')
+  conn.execute('PRAGMA synchronous = OFF')
+  conn.execute(
+    'CREATE TABLE IF NOT EXISTS content ('
+    '  hash BLOB PRIMARY KEY,'
+    '  content BLOB NOT NULL'
+    ')'
+  )
+  conn.commit()
+  return conn
+
+def putContent(conn, items):
+  """Inserts (hex digest, content) tuples in a single transaction, skipping
+  digests that are already stored. Returns how many were new."""
+  before = conn.total_changes
+  with conn:
+    conn.executemany(
+      'INSERT OR IGNORE INTO content (hash, content) VALUES (?, ?)',
+      ((sqlite3.Binary(binascii.unhexlify(hex_hash)), sqlite3.Binary(content))
+        for (hex_hash, content) in items)
+    )
+  return conn.total_changes - before
+
+def getContent(conn, hex_hashes):
+  """Returns a dict of hex digest to content for every one of hex_hashes that
+  is in the store, looking them up LOOKUP_BATCH_SIZE at a time"""
+  hex_hashes = list(hex_hashes)
+  ret = {}
+  for i in xrange(0, len(hex_hashes), LOOKUP_BATCH_SIZE):
+    batch = hex_hashes[i : i + LOOKUP_BATCH_SIZE]
+    rows = conn.execute(
+      'SELECT hash, content FROM content WHERE hash IN (%s)' % ','.join('?' * len(batch)),
+      [sqlite3.Binary(binascii.unhexlify(hex_hash)) for hex_hash in batch]
+    )
+    for (raw_hash, content) in rows:
+      ret[binascii.hexlify(raw_hash)] = str(content)
+  return ret
@@ -0,0 +1,193 @@
+# suffixarray.py
+# Sat Oct 17 09:12:40 PDT 2026
+#
+# A generalized suffix array over the concatenation of every input file. Each
+# file is followed by a separator symbol that is unique to it, so no common
+# prefix can ever span two files. Maximal substrings that are shared by at
+# least K files fall out of a single bottom up walk over the LCP intervals.
+
+import numpy as np
+
+MIN_FILE_COUNT_DEFAULT = 2
+# same as extractors.MIN_SUBSTRING_LEN
+MIN_SUBSTRING_LEN_DEFAULT = 8
+
+def _smallestInt(max_value):
+  "The smallest signed int dtype that holds every value up to max_value"
+  for dtype in (np.int16, np.int32):
+    if max_value <= np.iinfo(dtype).max:
+      return dtype
+  return np.int64
+
+def concatenate(blobs):
+  """Returns (text, starts, doc_ids) where text is an array of all the blobs,
+  each followed by the separator 256 + doc_id, in the smallest dtype that
+  holds them. starts[d] is the offset of blob d within text and doc_ids maps
+  every text position to its blob."""
+  lens = np.array([len(blob) + 1 for blob in blobs], dtype=np.int64)
+  starts = np.zeros(len(blobs) + 1, dtype=np.int64)
+  np.cumsum(lens, out=starts[1:])
+  text = np.empty(starts[-1], dtype=_smallestInt(256 + len(blobs)))
+  for d, blob in enumerate(blobs):
+    text[starts[d] : starts[d + 1] - 1] = np.frombuffer(blob, dtype=np.uint8)
+    text[starts[d + 1] - 1] = 256 + d
+  doc_ids = np.repeat(np.arange(len(blobs), dtype=_smallestInt(len(blobs))), lens)
+  return (text, starts[:-1], doc_ids)
+
+def suffixArray(text):
+  "Prefix doubling, every round is a vectorized sort over rank pairs"
+  n = len(text)
+  if n == 0:
+    return np.zeros(0, dtype=np.int64)
+  dtype = _smallestInt(n)
+  rank = np.unique(text, return_inverse=True)[1].astype(dtype)
+  k = 1
+  while True:
+    # both ranks in one int64, so each round is a single argsort
+    pairs = rank.astype(np.int64) * (n + 1)
+    pairs[:n - k] += rank[k:] + 1
+    sa = np.argsort(pairs)
+    pairs = pairs[sa]
+    boundary = np.ones(n, dtype=bool)
+    boundary[1:] = pairs[1:] != pairs[:-1]
+    new_rank = np.cumsum(boundary, dtype=dtype) - 1
+    rank = np.empty(n, dtype=dtype)
+    rank[sa] = new_rank
+    if new_rank[-1] == n - 1 or k >= n:
+      return sa
+    k *= 2
+
+def lcpArray(text, sa, inverse):
+  """lcp[i] is the length of the longest common prefix of the suffixes at
+  sa[i-1] and sa[i], and lcp[0] is 0, where inverse[sa[i]] is i. Kasai et
+  al: going through the suffixes in text order, the next one shares at least
+  one less than this one with its predecessor in sa, so every comparison
+  starts from there and all of them together are linear. The separators are
+  unique, so a match never runs off the end of the text."""
+  n = len(sa)
+  if n < 2:
+    return np.zeros(n, dtype=np.int64)
+  text = text.tolist()
+  order = sa.tolist()
+  inverse = inverse.tolist()
+  lcp = [0] * n
+  h = 0
+  for i in xrange(n):
+    r = inverse[i]
+    if r == 0:
+      h = 0
+      continue
+    j = order[r - 1]
+    while text[i + h] == text[j + h]:
+      h += 1
+    lcp[r] = h
+    if h > 0:
+      h -= 1
+  return np.array(lcp, dtype=np.int64)
+
+def _firstOffsets(sa, doc_ids, starts, lb, rb):
+  "Returns the first offset of the interval's substring within each file"
+  offsets = {}
+  for pos in sa[lb : rb + 1].tolist():
+    d = doc_ids[pos]
+    offset = pos - starts[d]
+    if d not in offsets or offset < offsets[d]:
+      offsets[d] = offset
+  return offsets
+
+def _heavyIntervals(lcp, doc_of, lo, hi, min_files, min_len, candidates):
+  """Walks the lcp intervals within sa[lo : hi + 1] bottom up, every lcp in
+  it but lcp[lo] being above min_len, and appends (lb, rb, lcp) to candidates
+  for every one in at least min_files docs that's right maximal: no child
+  interval reaches min_files"""
+  # each stack entry is [lcp, lb, docs, has_heavy_child, children]
+  stack = [[0, lo, None, False, []]]
+  for i in xrange(lo + 1, hi + 2):
+    cur = lcp[i - lo] if i <= hi else -1
+    lb = i - 1
+    last = None
+    while stack and cur < stack[-1][0]:
+      last = stack.pop()
+      (interval_lcp, interval_lb, _, has_heavy_child, children) = last
+      # union the child doc sets, small to large, plus the direct leaves
+      docs = set()
+      covered = interval_lb
+      for child in children:
+        for leaf in xrange(covered, child[1]):
+          docs.add(doc_of[leaf - lo])
+        if len(child[2]) > len(docs):
+          (docs, child_docs) = (child[2], docs)
+        else:
+          child_docs = child[2]
+        docs.update(child_docs)
+        covered = child[5] + 1
+      for leaf in xrange(covered, i):
+        docs.add(doc_of[leaf - lo])
+      last[2] = docs
+      last[4] = None
+      last.append(i - 1)
+      heavy = len(docs) >= min_files
+      if heavy and not has_heavy_child and interval_lcp > min_len:
+        candidates.append((interval_lb, i - 1, interval_lcp))
+      lb = interval_lb
+      if stack and cur <= stack[-1][0]:
+        stack[-1][4].append(last)
+        if heavy:
+          stack[-1][3] = True
+        last = None
+    if i <= hi and cur > stack[-1][0]:
+      if last is not None:
+        stack.append([cur, lb, None, len(last[2]) >= min_files, [last]])
+      else:
+        stack.append([cur, lb, None, False, []])
+
+def commonSubstrings(blobs, min_files=MIN_FILE_COUNT_DEFAULT,
+    min_len=MIN_SUBSTRING_LEN_DEFAULT):
+  """Returns a list of (substring, {file index: first offset}) for every
+  substring that is longer than min_len, occurs in at least min_files blobs,
+  and can't be extended to the left or the right without dropping below
+  min_files blobs."""
+  assert min_files >= 2, 'min_files must be at least two: %d' % min_files
+  if len(blobs) < min_files:
+    return []
+  (text, starts, doc_ids) = concatenate(blobs)
+  sa = suffixArray(text)
+  inverse = np.empty(len(sa), dtype=np.int64)
+  inverse[sa] = np.arange(len(sa))
+  lcp = lcpArray(text, sa, inverse)
+  text = None
+  doc_of = doc_ids[sa]
+  # every candidate is an interval whose lcps are all above min_len, so only
+  #  the runs of those are walked, not every suffix
+  long_enough = np.zeros(len(sa) + 2, dtype=np.int8)
+  long_enough[1:-1] = lcp > min_len
+  edges = np.diff(long_enough)
+  candidates = []
+  for (first, last) in zip(np.flatnonzero(edges == 1).tolist(), np.flatnonzero(edges == -1).tolist()):
+    # the run is lcp[first : last], its interval starts one suffix earlier
+    _heavyIntervals(lcp[first - 1 : last].tolist(), doc_of[first - 1 : last].tolist(),
+      first - 1, last - 1, min_files, min_len, candidates)
+  if len(candidates) == 0:
+    return []
+  # candidates never nest, since a heavy interval's parent has a heavy child,
+  #  so sorted by lb their intervals are disjoint
+  candidates.sort()
+  (lbs, rbs, lens) = np.array(candidates, dtype=np.int64).T
+  # a candidate whose string minus its first byte is also a candidate makes
+  #  that one not left maximal. The shorter string occurs one byte later, so
+  #  its interval is the one holding the suffix after the longer one's
+  after = inverse[sa[lbs] + 1]
+  shorter = np.maximum(np.searchsorted(lbs, after, side='right') - 1, 0)
+  hit = (lbs[shorter] <= after) & (rbs[shorter] >= after) & (lens[shorter] == lens - 1)
+  maximal = np.ones(len(lbs), dtype=bool)
+  maximal[shorter[hit]] = False
+  inverse = None
+  starts = starts.tolist()
+  doc_ids = doc_ids.tolist()
+  ret = []
+  for (lb, rb, length) in zip(lbs[maximal].tolist(), rbs[maximal].tolist(), lens[maximal].tolist()):
+    pos = int(sa[lb])
+    offset = pos - starts[doc_ids[pos]]
+    sub = blobs[doc_ids[pos]][offset : offset + length]
+    ret.append((sub, _firstOffsets(sa, doc_ids, starts, lb, rb)))
+  return ret
@@ -0,0 +1,106 @@
+# tabulardb.py
+# Sat Oct 17 16:05:12 PDT 2026
+#
+# A binary, columnar version of the tabular db, aka the list of (file hash,
+# substr hash, index) occurances that mmlcs.py -t writes. Hashes are
+# dictionary encoded: each distinct digest is stored raw once, and every row
+# refers to it by a uint32 id. Every column is at a fixed offset, so readers
+# memory map the whole table instead of parsing it.
+#
+# Layout, all little endian:
+#   header         magic, version, digest size, #files, #substrs, #rows
+#   file digests   #files x digest size bytes
+#   substr digests #substrs x digest size bytes
+#   offsets        #rows uint64
+#   file ids       #rows uint32
+#   substr ids     #rows uint32
+
+import binascii
+import struct
+
+import numpy as np
+
+MAGIC = 'MMLCSOCC'
+VERSION = 1
+HEADER_FORMAT = '<8sIIQQQ'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+
+def isTable(filename):
+  "Whether filename is a binary tabular db, as opposed to a TSV one"
+  with open(filename, 'rb') as f:
+    return f.read(len(MAGIC)) == MAGIC
+
+def _encode(ids, digest_size):
+  "Returns the raw digests of the dict of hex hash to id, ordered by id"
+  hexes = [None] * len(ids)
+  for hex_hash in ids:
+    hexes[ids[hex_hash]] = hex_hash
+  digests = np.frombuffer(binascii.unhexlify(''.join(hexes)), dtype=np.uint8)
+  return digests.reshape(len(hexes), digest_size)
+
+def writeTable(filename, substr_indexes, digest_size):
+  """Writes a list of (file hash, substr hash, index) tuples, with hex hashes
+  of digest_size bytes, as a binary tabular db"""
+  # Map<hex hash, id>, in order of first appearance
+  file_ids = {}
+  substr_ids = {}
+  file_col = []
+  substr_col = []
+  offset_col = []
+  for (file_hash, sub_hash, index) in substr_indexes:
+    file_col.append(file_ids.setdefault(file_hash, len(file_ids)))
+    substr_col.append(substr_ids.setdefault(sub_hash, len(substr_ids)))
+    offset_col.append(index)
+  with open(filename, 'wb') as f:
+    f.write(struct.pack(
+      HEADER_FORMAT,
+      MAGIC,
+      VERSION,
+      digest_size,
+      len(file_ids),
+      len(substr_ids),
+      len(substr_indexes)
+    ))
+    f.write(_encode(file_ids, digest_size).tobytes())
+    f.write(_encode(substr_ids, digest_size).tobytes())
+    f.write(np.array(offset_col, dtype='<u8').tobytes())
+    f.write(np.array(file_col, dtype='<u4').tobytes())
+    f.write(np.array(substr_col, dtype='<u4').tobytes())
+
+def readTable(filename):
+  """Memory maps a binary tabular db. Returns a tuple of (file digests,
+  substr digests, file ids, substr ids, offsets) arrays, where the digests
+  are uint8 arrays with a row per distinct hash and the ids index them."""
+  with open(filename, 'rb') as f:
+    header = f.read(HEADER_SIZE)
+  (magic, version, digest_size, num_files, num_substrs, num_rows) = \
+    struct.unpack(HEADER_FORMAT, header)
+  assert magic == MAGIC, '%s is not a binary tabular db' % filename
+  assert version == VERSION, 'unsupported tabular db version %d' % version
+  columns = [
+    ('<u1', (num_files, digest_size)),
+    ('<u1', (num_substrs, digest_size)),
+    ('<u8', (num_rows,)),
+    ('<u4', (num_rows,)),
+    ('<u4', (num_rows,)),
+  ]
+  arrays = []
+  offset = HEADER_SIZE
+  for (dtype, shape) in columns:
+    size = np.dtype(dtype).itemsize * int(np.prod(shape))
+    if size == 0:
+      # can't memory map nothing
+      arrays.append(np.zeros(shape, dtype=dtype))
+    else:
+      arrays.append(np.memmap(filename, dtype=dtype, mode='r', offset=offset, shape=shape))
+    offset += size
+  (file_digests, substr_digests, offsets, file_ids, substr_ids) = arrays
+  return (file_digests, substr_digests, file_ids, substr_ids, offsets)
+
+def hexDigests(digests):
+  "Returns the list of hex hashes for a digests array from readTable"
+  if len(digests) == 0:
+    return []
+  width = 2 * digests.shape[1]
+  hexes = binascii.hexlify(digests.tobytes())
+  return [hexes[i : i + width] for i in xrange(0, len(hexes), width)]
@@ -0,0 +1,71 @@
+# test_extractors.py
+# Sat Oct 17 11:02:47 PDT 2026
+#
+# The vectorized extractors against the per byte loops they replaced.
+
+import random
+import unittest
+
+import numpy as np
+
+from extractors import (_substring_spans, ngram_counts, ngrams, hist_table)
+
+def baselineSpans(counts, n, min_count, min_len, require_equal_counts):
+  """The greedy extension loop _substring_spans replaced, one offset at a
+  time, returning a list of (start, end)"""
+  spans = []
+  i = 0
+  while i < len(counts):
+    if counts[i] <= min_count:
+      i += 1
+      continue
+    end = i + n
+    count = counts[i]
+    for j in xrange(i + 1, len(counts)):
+      if (not require_equal_counts and counts[j] > min_count) or \
+          (require_equal_counts and counts[j] == count):
+        end += 1
+      else:
+        break
+    if end - i > min_len:
+      spans.append( (i, end) )
+      i = end
+    i += 1
+  return spans
+
+class SubstringSpansTest(unittest.TestCase):
+  def testMatchesBaseline(self):
+    rand = random.Random(25)
+    for _ in xrange(2000):
+      # few distinct counts, so runs of them are long and frequent
+      counts = [rand.choice([0, 3, 11, 12, 12, 13]) for _ in xrange(rand.randint(0, 80))]
+      n = rand.randint(1, 5)
+      min_len = rand.randint(0, 12)
+      for require_equal_counts in (True, False):
+        self.assertEqual(
+          list(_substring_spans(np.array(counts, dtype=np.int64), n, 10, min_len,
+            require_equal_counts)),
+          baselineSpans(counts, n, 10, min_len, require_equal_counts)
+        )
+
+  def testEmpty(self):
+    self.assertEqual(list(_substring_spans(np.zeros(0, dtype=np.int64), 3, 10, 8, True)), [])
+
+class NgramCountsTest(unittest.TestCase):
+  def testDictMatchesTable(self):
+    rand = random.Random(8)
+    # small alphabet, so ngrams repeat
+    data = ''.join(chr(rand.randint(0, 15)) for _ in xrange(3000))
+    for n in (1, 3, 8, 9, 12):
+      hist = ngrams(data, n)
+      # only some of them, so there are misses too
+      hist = dict((gram, count) for (gram, count) in hist.iteritems() if rand.random() < 0.5)
+      expected = [hist.get(data[i : i + n], 0) for i in xrange(len(data) - n + 1)]
+      self.assertEqual(list(ngram_counts(data, n, hist)), expected)
+      self.assertEqual(list(ngram_counts(memoryview(data), n, hist)), expected)
+      if n <= 8:
+        # hashed ids of a table can collide, packed ones can't
+        self.assertEqual(list(ngram_counts(data, n, hist_table(hist))), expected)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,131 @@
+# test_mmlcs.py
+# Sat Oct 17 09:14:02 PDT 2026
+#
+# Every route to the substrings of a corpus should find the same ones. The
+# corpus is noise from bytes 0-63 with two blocks from bytes 128-255 planted
+# in it, one in every file and one in all but one, each between bytes that
+# are unique to its file. No ngram of the noise is in enough files to be
+# extended over, so the ngram engines find exactly the blocks, and they're
+# the only maximal substrings the suffix engine finds too.
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+import unittest
+from StringIO import StringIO
+
+import mmlcs
+from extractors import (MIN_FILE_COUNT)
+from mmlcs import (ngramSubstrings, sweepSubstrings, suffixSubstrings, HASH_FUNC)
+
+NUM_FILES = MIN_FILE_COUNT + 2
+# bigger than CHUNK_SIZE, so every file is read in several windows
+FILE_SIZE = 20000
+# mmlcs.py won't chunk below MAX_SUBSTRING_LEN
+CHUNK_SIZE = 8192
+# the windows after the first start this far before a multiple of CHUNK_SIZE
+OVERLAP = mmlcs.MAX_SUBSTRING_LEN
+
+def quietly(func, *args, **kwargs):
+  "Calls func without its progress prints"
+  stdout = sys.stdout
+  sys.stdout = StringIO()
+  try:
+    return func(*args, **kwargs)
+  finally:
+    sys.stdout = stdout
+
+def writeCorpus(dirname, seed):
+  "Writes the planted block corpus to dirname, returns the filenames"
+  rand = random.Random(seed)
+  blocks = [
+    ''.join(chr(rand.randint(128, 255)) for _ in xrange(600)),
+    ''.join(chr(rand.randint(128, 255)) for _ in xrange(300))
+  ]
+  filenames = []
+  for i in xrange(NUM_FILES):
+    noise = [chr(rand.randint(0, 63)) for _ in xrange(FILE_SIZE)]
+    # both blocks straddle the start of a window, so it starts mid block
+    at = CHUNK_SIZE - OVERLAP - 300 + 40 * i
+    noise[at : at] = [chr(64 + i)] + list(blocks[0]) + [chr(64 + i)]
+    if i > 0:
+      at = 2 * CHUNK_SIZE - OVERLAP - 150 + 20 * i
+      noise[at : at] = [chr(64 + i)] + list(blocks[1]) + [chr(64 + i)]
+    filename = os.path.join(dirname, 'f%03d' % i)
+    with open(filename, 'wb') as f:
+      f.write(''.join(noise))
+    filenames.append(filename)
+  return filenames
+
+class EquivalenceTest(unittest.TestCase):
+  @classmethod
+  def setUpClass(cls):
+    cls.dirname = tempfile.mkdtemp(prefix='mmlcs-test-')
+    cls.filenames = writeCorpus(cls.dirname, 25)
+    cls.expected = quietly(ngramSubstrings, cls.filenames, False, 3, 'ids')
+
+  @classmethod
+  def tearDownClass(cls):
+    shutil.rmtree(cls.dirname)
+
+  def assertSameSubstrings(self, expected, actual):
+    (expected_content, expected_occurances) = expected
+    (actual_content, actual_occurances) = actual
+    self.assertEqual(expected_content, actual_content)
+    self.assertEqual(sorted(expected_occurances), sorted(actual_occurances))
+
+  def testFindsBlocks(self):
+    (content, occurances) = self.expected
+    self.assertEqual(sorted(len(sub) for sub in content.itervalues()), [300, 600])
+    self.assertEqual(len(occurances), 2 * NUM_FILES - 1)
+
+  def testNgramEngine(self):
+    self.assertSameSubstrings(self.expected,
+      quietly(ngramSubstrings, self.filenames, False, 3, 'ngram'))
+
+  def testSuffixEngine(self):
+    self.assertSameSubstrings(self.expected,
+      quietly(suffixSubstrings, self.filenames, HASH_FUNC, NUM_FILES - 1))
+
+  def testSweep(self):
+    ns = [3, 4, 9]
+    (content, occurances) = quietly(sweepSubstrings, self.filenames, False, ns)
+    expected_content = {}
+    for (n, n_occurances) in zip(ns, occurances):
+      expected = quietly(ngramSubstrings, self.filenames, False, n, 'ids')
+      self.assertEqual(sorted(expected[1]), sorted(n_occurances))
+      expected_content.update(expected[0])
+    self.assertEqual(expected_content, content)
+
+  def testCached(self):
+    self.assertSameSubstrings(self.expected,
+      quietly(ngramSubstrings, self.filenames, False, 3, 'ids', cache_ids=True))
+
+  def testCachedHashesOnly(self):
+    cache_memory_size = mmlcs.CACHE_MEMORY_SIZE
+    # half the files fit, the rest are read again
+    mmlcs.CACHE_MEMORY_SIZE = (NUM_FILES // 2) * os.path.getsize(self.filenames[0])
+    try:
+      self.assertSameSubstrings(self.expected,
+        quietly(ngramSubstrings, self.filenames, False, 3, 'ids', cache_ids=True))
+    finally:
+      mmlcs.CACHE_MEMORY_SIZE = cache_memory_size
+
+  def testCachedMulti(self):
+    self.assertSameSubstrings(self.expected,
+      quietly(ngramSubstrings, self.filenames, True, 3, 'ids', cache_ids=True))
+
+  def testChunked(self):
+    for engine in ('ids', 'ngram'):
+      for use_mmap in (False, True):
+        self.assertSameSubstrings(self.expected,
+          quietly(ngramSubstrings, self.filenames, False, 3, engine, CHUNK_SIZE, use_mmap))
+
+  def testChunkedCached(self):
+    self.assertSameSubstrings(self.expected,
+      quietly(ngramSubstrings, self.filenames, False, 3, 'ids', CHUNK_SIZE, cache_ids=True))
+
+if __name__ == '__main__':
+  unittest.main()
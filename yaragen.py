@@ -7,9 +7,18 @@ from __future__ import print_function
 # stdlib imports
 import argparse
 import datetime
+import itertools
 import os
 
+# 3rd party imports
+import numpy as np
+
+from cooccurrences import (readFile)
 from encoding import (bin2hex)
+from itemsets import (largestItemset)
+from sorting import (externalSort, valueKey, DESCENDING)
+from store import (openStore, getContent)
+from tabulardb import (isTable, readTable, hexDigests)
 
 RULE_TEMPLATE = """
 rule TODO
@@ -36,13 +45,23 @@ CHAR_OFFSET = ord('a')
 STRING_TEMPLATE = "    $%(identifier)s = {%(hex_content)s}"
 TOP_K_DEFAULT = 25
 
-def __hist_cmp(x, y):
-  if x[1] > y[1]:
-    return 1
-  elif x[1] < y[1]:
-    return -1
-  else:
-    return 0
+def substrCounts(filename):
+  """Returns a dict of substr hash to how many rows it has in a binary tabular
+  db, straight from the memory mapped columns"""
+  (_, substr_digests, _, substr_ids, _) = readTable(filename)
+  counts = np.bincount(substr_ids, minlength=len(substr_digests))
+  return dict(itertools.izip(hexDigests(substr_digests), counts.tolist()))
+
+def bestItemset(filename, min_support, max_size):
+  """Returns [(substr hash, support)] for the biggest set of at most max_size
+  substrs that all occur together in at least min_support files, preferring
+  the most support among the biggest ones"""
+  (_, _, substr_hexes, file_to_substr, _) = readFile(filename)
+  best = largestItemset(file_to_substr, min_support, max_size)
+  if best is None:
+    return []
+  (itemset, support) = best
+  return [(substr_hexes[item], support) for item in itemset]
 
 def parseDBFile(filename):
   rows = []
@@ -68,7 +87,7 @@ if __name__ == '__main__':
   parser.add_argument(
     '-c',
     '--content',
-    help='Where to store the content with filename=hex_hash',
+    help='Where the content is stored, a store file or a directory with filename=hex_hash',
     type=str
   )
   parser.add_argument(
@@ -82,33 +101,67 @@ if __name__ == '__main__':
     action='store_true',
     help='Whether or not to generate a yara rule'
   )
+  parser.add_argument(
+    '-s',
+    '--support',
+    help='Use the biggest set of up to K substrs that all occur in at least this many files, and require all of them',
+    type=int
+  )
   args = parser.parse_args()
   if args.k is not None:
     K = args.k
   else:
     K = TOP_K_DEFAULT
-  # read file
-  db = parseDBFile(args.db_filename)
-  # calculate some stats
-  substr_hashes = {}
-  for row in db:
-    if row['substr_hash'] in substr_hashes:
-      substr_hashes[row['substr_hash']] += 1
+  if args.support is not None:
+    # strings that jointly occur, instead of the most common ones
+    substr_hash_list = bestItemset(args.db_filename, args.support, K)
+    num_strings = len(substr_hash_list)
+  else:
+    if isTable(args.db_filename):
+      substr_hashes = substrCounts(args.db_filename)
     else:
-      substr_hashes[row['substr_hash']] = 1
-  substr_hash_list = substr_hashes.items()
-  # this could be slow if theres 1M+ items in the db
-  substr_hash_list.sort(__hist_cmp, reverse=True)
+      # read file
+      db = parseDBFile(args.db_filename)
+      # calculate some stats
+      substr_hashes = {}
+      for row in db:
+        if row['substr_hash'] in substr_hashes:
+          substr_hashes[row['substr_hash']] += 1
+        else:
+          substr_hashes[row['substr_hash']] = 1
+    # only the top K are kept, so this stays cheap with 1M+ items in the db
+    substr_hash_list = list(itertools.islice(
+      externalSort(substr_hashes.iteritems(), valueKey, DESCENDING),
+      K
+    ))
+    num_strings = K / 2
   # generate output
   i = 0
   str_conditions = []
+  if args.content is not None and not os.path.exists(args.content):
+    # openStore would create an empty store instead
+    raise Exception("%s does not exist" % args.content)
+  if args.content is not None and not os.path.isdir(args.content):
+    # one batched lookup instead of a file per substr
+    store = openStore(args.content)
+    contents = getContent(store, [kv[0] for kv in substr_hash_list])
+    store.close()
+  else:
+    contents = None
   for kv in substr_hash_list[:K]:
     if args.content is None:
       print("%s\t%d" % (kv[0], kv[1]))
       continue
-    substr_content_filename = os.path.join(args.content, kv[0])
-    # TODO should we verify the hash?
-    substr_content = open(substr_content_filename).read()
+    if contents is not None:
+      if kv[0] not in contents:
+        raise Exception("The content of substr %s is not in %s" % (kv[0], args.content))
+      substr_content = contents[kv[0]]
+    else:
+      substr_content_filename = os.path.join(args.content, kv[0])
+      if not os.path.isfile(substr_content_filename):
+        raise Exception("The content of substr %s is not in %s" % (kv[0], args.content))
+      # TODO should we verify the hash?
+      substr_content = open(substr_content_filename).read()
     if not args.gen:
       print("%s\t%d\t%d" % (kv[0], kv[1], len(substr_content)))
       continue
@@ -123,5 +176,5 @@ if __name__ == '__main__':
     print(RULE_TEMPLATE % {
       'ds' : datetime.datetime.now().strftime('%Y-%m-%d'),
       'string_list' : "\n".join(str_conditions),
-      'num_strings' : K / 2,
+      'num_strings' : num_strings,
     })